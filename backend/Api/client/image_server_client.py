@@ -1,31 +1,138 @@
+import asyncio
+import json
+import random
 from Api.config import Settings
 from shared.data_classes import ImageData, GetProcessedResponse
+from shared.payloads import NDJSON_CONTENT_TYPE, PAYLOAD_CONTENT_TYPES, encode_payload, decode_payload
 from fastapi import HTTPException
 from pydantic import ValidationError
-import http3
+import httpx
+
+# the image server is restarting, warming up or its queue is full
+RETRY_STATUS_CODES = {502, 503, 504}
+# failures where the request can safely be sent again. Processing is
+# idempotent (outputs are keyed by image hash and paint id), so even a
+# connection that dropped mid-response is retried
+RETRY_EXCEPTIONS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.ReadError,
+    httpx.WriteError,
+    httpx.RemoteProtocolError,
+)
+
+
 class ImageServerClient:
+    """
+    Client for the image server, shared by every request for the lifetime of
+    the Api so connections are pooled and kept alive instead of set up per
+    call. HTTP/2 is used when the server negotiates it (over TLS), and
+    transient failures are retried with exponential backoff and jitter.
+    """
+
     def __init__(self, env: Settings):
-        self.base_url = env.image_server_url
-        self.client = http3.AsyncClient()
+        self.content_type = PAYLOAD_CONTENT_TYPES[env.image_server_payload_format]
+        self.max_retries = env.image_server_max_retries
+        self.retry_backoff = env.image_server_retry_backoff_s
+        self.client = httpx.AsyncClient(
+            base_url=env.image_server_url,
+            http2=env.image_server_http2,
+            limits=httpx.Limits(
+                max_connections=env.image_server_max_connections,
+                max_keepalive_connections=env.image_server_max_keepalive_connections,
+                keepalive_expiry=env.image_server_keepalive_expiry_s,
+            ),
+            timeout=httpx.Timeout(
+                env.image_server_timeout_s, connect=env.image_server_connect_timeout_s
+            ),
+        )
 
-    async def send_image_process_request(self, image_data: ImageData):
-        json_data = image_data.model_dump_json()
-        url = self.base_url + "/image/generate"
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _post(self, path: str, data):
+        content = encode_payload(data, self.content_type)
+        headers = {"Content-Type": self.content_type, "Accept": self.content_type}
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                resp = await self.client.post(path, content=content, headers=headers)
+                if resp.status_code not in RETRY_STATUS_CODES or is_last_attempt:
+                    resp.raise_for_status()
+                    return decode_payload(resp.content, resp.headers.get("content-type"))
+                reason = f"status {resp.status_code}"
+            except RETRY_EXCEPTIONS as e:
+                if is_last_attempt:
+                    raise
+                reason = repr(e)
+            delay = self.retry_backoff * (2**attempt) * random.uniform(0.5, 1.5)
+            print(f"Image server call to {path} failed ({reason}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def _call(self, path: str, data):
         try:
-            print("sending request to: ", url)
-            print("sending data: ", json_data)
-            resp  = await self.client.post(url, data=json_data, headers={"Content-Type": "application/json"}, timeout=60)
-            resp.raise_for_status()
-            processed_data = resp.json()
-            print("received data from server: ", processed_data)
-            processed_resp = [GetProcessedResponse(**image_response) for image_response in processed_data]
-            return processed_resp
-        except ValidationError as e:
-            HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
-        except http3.exceptions.HttpError as e:
-            HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
+            print("sending request to: ", self.client.base_url.join(path))
+            return await self._post(path, data)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
         except Exception as e:
-            HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
+            raise HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
+
+    @staticmethod
+    def _to_processed_responses(processed_data):
+        try:
+            return [GetProcessedResponse(**image_response) for image_response in processed_data]
+        except ValidationError as e:
+            raise HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
 
+    async def send_image_process_request(self, image_data: ImageData):
+        """Segments the image if needed and recolors it into every color."""
+        processed_data = await self._call("/image/generate", image_data.model_dump())
+        print("received data from server: ", processed_data)
+        return self._to_processed_responses(processed_data)
 
+    async def _open_stream(self, path: str, data):
+        """Starts a streamed POST, retried like `_post` until the response starts."""
+        content = encode_payload(data, self.content_type)
+        headers = {"Content-Type": self.content_type, "Accept": NDJSON_CONTENT_TYPE}
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                request = self.client.build_request("POST", path, content=content, headers=headers)
+                resp = await self.client.send(request, stream=True)
+                if resp.status_code not in RETRY_STATUS_CODES or is_last_attempt:
+                    if resp.is_error:
+                        await resp.aread()
+                        await resp.aclose()
+                        resp.raise_for_status()
+                    return resp
+                await resp.aclose()
+                reason = f"status {resp.status_code}"
+            except RETRY_EXCEPTIONS as e:
+                if is_last_attempt:
+                    raise
+                reason = repr(e)
+            delay = self.retry_backoff * (2**attempt) * random.uniform(0.5, 1.5)
+            print(f"Image server call to {path} failed ({reason}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
 
+    async def stream_image_process_request(self, image_data: ImageData):
+        """
+        Like `send_image_process_request`, but yields every processed image
+        as soon as the image server has stored it instead of waiting for
+        all colors.
+        """
+        path = "/image/generate"
+        try:
+            print("sending request to: ", self.client.base_url.join(path))
+            resp = await self._open_stream(path, image_data.model_dump())
+            try:
+                async for line in resp.aiter_lines():
+                    if line.strip():
+                        yield GetProcessedResponse(**json.loads(line))
+            finally:
+                await resp.aclose()
+        except (ValidationError, ValueError) as e:
+            raise HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=500, detail=f"Internal server error when calling Image Processor: {e}")
@@ -6,4 +6,24 @@ class Settings(BaseSettings):
     use_firebase_emulator: str
     firebase_storage_bucket_url: str
     image_server_url: str
+    # pooled client for the image server, shared by all requests
+    image_server_http2: bool = True
+    image_server_max_connections: int = 100
+    image_server_max_keepalive_connections: int = 20
+    image_server_keepalive_expiry_s: float = 30
+    image_server_connect_timeout_s: float = 5
+    image_server_timeout_s: float = 60
+    image_server_max_retries: int = 3
+    image_server_retry_backoff_s: float = 0.2
+    # "json" or "msgpack"
+    image_server_payload_format: str = "json"
+    # background processing jobs, kept in memory by this process
+    job_store_max_jobs: int = 1000
+    job_ttl_s: float = 3600
+    job_events_keepalive_s: float = 15
+    # local cache of immutable storage objects, shared with the image server
+    # when both run on the same machine
+    blob_cache_dir: str = "cache/blobs"
+    blob_cache_memory_mb: int = 64
+    blob_cache_disk_mb: int = 2048
     model_config = SettingsConfigDict(env_file=".env")
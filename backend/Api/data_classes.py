@@ -20,6 +20,15 @@ class ImageRequestListResponse(BaseModel):
     processed_images: List[GetProcessedResponse]
 
 
+class ProcessingJobResponse(BaseModel):
+    job_id: str
+    # queued, running, done or failed
+    status: str
+    original_image: str
+    processed_images: List[GetProcessedResponse] = []
+    error: str | None = None
+
+
 class History(BaseModel):
     base_image: str
     last_accessed: datetime
@@ -10,8 +10,10 @@ from Api.repository.gallery_repository import GalleryRepository
 from Api.service.history_service import HistoryService
 from Api.service.user_authentication_service import UserAuthenticationService
 from shared.repository.image_repository import ImageRepository
+from shared.repository.blob_cache import BlobCache
 from shared.service.image_service import ImageService
 from Api.client.image_server_client import ImageServerClient
+from Api.job_store import JobStore
 from Api.repository.favorites_repository import FavoritesRepository
 from Api.service.favorites_service import FavoritesService
 
@@ -32,12 +34,28 @@ def get_authentication_service(
     return UserAuthenticationService(repository)
 
 
+@lru_cache()
+def get_blob_cache():
+    env = getEnv()
+    return BlobCache(
+        env.blob_cache_dir,
+        max_memory_bytes=env.blob_cache_memory_mb << 20,
+        max_disk_bytes=env.blob_cache_disk_mb << 20,
+    )
+
 def get_image_repository():
-    return ImageRepository()
+    return ImageRepository(get_blob_cache())
+
+
+@lru_cache()
+def get_image_server_client():
+    return ImageServerClient(env=getEnv())
 
 
-def get_image_server_client(env: Annotated[Settings, Depends(getEnv)]):
-    return ImageServerClient(env=env)
+@lru_cache()
+def get_job_store():
+    env = getEnv()
+    return JobStore(max_jobs=env.job_store_max_jobs, ttl_s=env.job_ttl_s)
 
 
 def get_image_service(
@@ -0,0 +1,98 @@
+from fastapi import Request, Response
+
+from shared.data_classes import Image
+
+# images are named after their content (sha256 or raw-paint_id) and never
+# change, so clients may keep them forever. They belong to a signed in user,
+# hence private
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+def image_etag(image_hash: str) -> str:
+    """Strong ETag of a content addressed image."""
+    return f'"{image_hash}"'
+
+
+def _cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # weak comparison, W/"x" matches "x"
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified_response(request: Request, etag: str) -> Response | None:
+    """
+    Returns a 304 response if the client already has the image, so the
+    caller can answer before touching storage.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None or not _etag_matches(if_none_match, etag):
+        return None
+    return Response(status_code=304, headers=_cache_headers(etag))
+
+
+def _parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single `bytes=start-end` range into inclusive offsets. Returns
+    None for headers to ignore (other units, multiple ranges, invalid
+    syntax such as `start > end`) and raises ValueError for ranges starting
+    past the end of the image.
+    """
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in byte_range:
+        return None
+    start, _, end = byte_range.strip().partition("-")
+    try:
+        if start and end:
+            start, end = int(start), int(end)
+            if start > end:
+                # invalid, RFC 9110 says to ignore it and send the whole image
+                return None
+        elif start:
+            # open ended, up to the end of the image
+            start, end = int(start), size - 1
+        elif end:
+            # suffix range, the last `end` bytes
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def image_response(request: Request, image: Image, etag: str) -> Response:
+    """Full or partial (Range) response for an image with caching headers."""
+    headers = _cache_headers(etag)
+    headers["Accept-Ranges"] = "bytes"
+    content = image.image_bytes
+    size = len(content)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # a stale If-Range means the client wants the whole image again
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return Response(
+                content=content[start : end + 1],
+                status_code=206,
+                headers=headers,
+                media_type=image.contentType,
+            )
+
+    return Response(content=content, headers=headers, media_type=image.contentType)
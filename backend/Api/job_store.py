@@ -0,0 +1,142 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from shared.data_classes import GetProcessedResponse
+from Api.data_classes import ProcessingJobResponse
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class ProcessingJob:
+    """
+    State of one background image processing request. Every change bumps
+    `version` and wakes up `wait_for_change`, which the event stream uses
+    to push updates as they happen.
+    """
+
+    def __init__(self, uid: str, original_image: str, processed_images: list[GetProcessedResponse]):
+        self.job_id = uuid.uuid4().hex
+        self.uid = uid
+        self.status = QUEUED
+        self.original_image = original_image
+        self.processed_images = list(processed_images)
+        self.error = None
+        self.finished_at = None
+        self.version = 0
+        self._changed = asyncio.Event()
+        self._task = None
+
+    @property
+    def is_finished(self):
+        return self.status in (DONE, FAILED)
+
+    def _notify(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def set_running(self):
+        self.status = RUNNING
+        self._notify()
+
+    def add_processed(self, processed_images: list[GetProcessedResponse]):
+        self.processed_images.extend(processed_images)
+        self._notify()
+
+    def finish(self, error: str | None = None):
+        self.status = FAILED if error is not None else DONE
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    async def wait_for_change(self, version: int, timeout: float):
+        """Waits until the job is past `version`, at most `timeout` seconds."""
+        if self.version != version:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_response(self):
+        return ProcessingJobResponse(
+            job_id=self.job_id,
+            status=self.status,
+            original_image=self.original_image,
+            processed_images=self.processed_images,
+            error=self.error,
+        )
+
+
+class JobStore:
+    """
+    Small in-memory store of processing jobs, local to this Api process.
+    Finished jobs are kept for `ttl_s` seconds so clients can still poll
+    the result, and at most `max_jobs` jobs are kept overall (the oldest
+    finished ones go first). Once `max_jobs` jobs are still unfinished, new
+    ones are rejected with a 503.
+    """
+
+    def __init__(self, max_jobs=1000, ttl_s=3600) -> None:
+        self.max_jobs = max_jobs
+        self.ttl_s = ttl_s
+        self._jobs = OrderedDict()
+
+    def ensure_capacity(self):
+        """Raises a 503 if there is no room for another job."""
+        self._evict()
+        if len(self._jobs) >= self.max_jobs:
+            raise HTTPException(
+                status_code=503, detail="Too many processing jobs, try again later"
+            )
+
+    def create(self, uid: str, original_image: str, processed_images: list[GetProcessedResponse]):
+        self.ensure_capacity()
+        job = ProcessingJob(uid, original_image, processed_images)
+        self._jobs[job.job_id] = job
+        return job
+
+    def get(self, uid: str, job_id: str) -> ProcessingJob | None:
+        job = self._jobs.get(job_id)
+        # jobs are only visible to the user that started them
+        if job is None or job.uid != uid:
+            return None
+        return job
+
+    def run(self, job: ProcessingJob, coro):
+        """Runs `coro` in the background, the job fails if it raises."""
+
+        async def run_job():
+            job.set_running()
+            try:
+                await coro
+            except Exception as e:
+                print(f"Processing job {job.job_id} failed: {e!r}")
+                job.finish(error=getattr(e, "detail", None) or str(e))
+                return
+            job.finish()
+
+        # the store keeps a reference so the task isn't garbage collected
+        job._task = asyncio.create_task(run_job())
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.is_finished and now - job.finished_at > self.ttl_s
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if len(self._jobs) < self.max_jobs:
+            return
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[: len(self._jobs) - self.max_jobs + 1]:
+            del self._jobs[job_id]
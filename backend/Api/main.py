@@ -7,7 +7,8 @@ from contextlib import asynccontextmanager
 
 sys.path.append(os.path.join(os.sep.join(os.path.dirname(__file__).split(os.sep)[:-1])))
 from Api.routes import login, image, history, gallery, favorites
-from Api.dependencies import getEnv
+from Api.dependencies import getEnv, get_image_server_client
+from shared.repository.storage_calls import storage_call_middleware
 
 
 @asynccontextmanager
@@ -21,12 +22,15 @@ async def lifespan(app: FastAPI):
     firebase_admin.initialize_app(
         cred, {"storageBucket": env.firebase_storage_bucket_url}
     )
+    image_server_client = get_image_server_client()
     yield
+    await image_server_client.aclose()
     print("good bye")
 
 
 # initialize fastAPI
 app = FastAPI(lifespan=lifespan)
+app.middleware("http")(storage_call_middleware)
 app.include_router(login.router)
 app.include_router(image.router)
 app.include_router(history.router)
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, Response, UploadFile, HTTPException, File, Form
+from fastapi import APIRouter, Depends, Request, Response, UploadFile, HTTPException, File, Form
 from typing import Annotated
 from pydantic import ValidationError
 import json
@@ -7,6 +7,7 @@ from Api.dependencies import get_user, get_gallery_service
 from Api.repository.user_authentication_repository import User
 from Api.data_classes import ReviewImageDto, ReviewDto
 from Api.service.gallery_service import GalleryService
+from Api.http_caching import image_etag, image_response, not_modified_response
 
 router = APIRouter(
     # specify sub-route. All routes in this file will be in the form of /gallery/{whatever}
@@ -41,12 +42,32 @@ async def get_all_reviews(
     return {"reviews": reviews.reviews}
 
 
+@router.get("/image/{paint_id}/{image_hash}")
+def get_review_image(
+    gallery_service: Annotated["GalleryService", Depends(get_gallery_service)],
+    user: Annotated["User", Depends(get_user)],
+    paint_id: str,
+    image_hash: str,
+    request: Request,
+):
+    # review images are named by their sha256, so they never change
+    etag = image_etag(image_hash)
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+    image = gallery_service.get_image_by_hash(paint_id, image_hash)
+
+    return image_response(request, image, etag)
+
+
 @router.post("/get-image")
 def get_image_by_hash(
     gallery_service: Annotated["GalleryService", Depends(get_gallery_service)],
     user: Annotated["User", Depends(get_user)],
     review_dto: ReviewImageDto,
 ):
+    # POST responses aren't cached, conditional and range requests go
+    # through GET /gallery/image/{paint_id}/{image_hash}
     print("Review DTO: ", review_dto.model_dump())
     image = gallery_service.get_image_by_hash(
         review_dto.paint_id, review_dto.image_hash
@@ -1,11 +1,16 @@
-from fastapi import APIRouter, Depends, UploadFile, Form, File, HTTPException, Response
+from fastapi import APIRouter, Depends, UploadFile, Form, File, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from shared.data_classes import ColorDTO
 from pydantic import ValidationError
 from shared.service.image_service import ImageService
 from typing import Annotated
-from Api.dependencies import get_image_service, get_user, get_history_service
+from Api.dependencies import get_image_service, get_user, get_history_service, get_job_store, getEnv
 from Api.repository.user_authentication_repository import User
 from Api.service.history_service import HistoryService
+from Api.http_caching import image_etag, image_response, not_modified_response
+from Api.job_store import JobStore, ProcessingJob
+from Api.config import Settings
+from shared.renditions import RENDITION_SIZES
 import json
 
 router = APIRouter(
@@ -18,23 +23,105 @@ router = APIRouter(
 )
 
 
+def _parse_colors(colors: str):
+    try:
+        raw_colors = json.loads(colors)
+        return [ColorDTO(**color) for color in raw_colors]
+    except (SyntaxError, ValidationError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid 'colors' input: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"invalid color input: {e}")
+
+
+def _get_job(job_store: JobStore, uid: str, job_id: str):
+    job = job_store.get(uid, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No processing job with id: {job_id}")
+    return job
+
+
+def _sse(event: str, data: str):
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def _job_events(job: ProcessingJob, keepalive_s: float):
+    # every processed color once, then the final status
+    sent = 0
+    while True:
+        version = job.version
+        for processed in job.processed_images[sent:]:
+            yield _sse("processed", processed.model_dump_json())
+        sent = len(job.processed_images)
+        if job.is_finished:
+            yield _sse(job.status, job.to_response().model_dump_json())
+            return
+        await job.wait_for_change(version, keepalive_s)
+        if job.version == version:
+            # comment line, keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+
+
+@router.post("/jobs", status_code=202)
+async def submit_processing_job(image_service: Annotated['ImageService', Depends(get_image_service)],
+                                history_service: Annotated['HistoryService', Depends(get_history_service)],
+                                job_store: Annotated['JobStore', Depends(get_job_store)],
+                                user: Annotated['User', Depends(get_user)],
+                                file: UploadFile = File(...),
+                                colors: str = Form(...)):
+    # returns as soon as the image is stored, poll /image/jobs/{job_id} or
+    # stream /image/jobs/{job_id}/events for the processed images
+    color_list = _parse_colors(colors)
+    job = await image_service.submit_processing_job(user.uid, file, color_list, job_store)
+    await history_service.update_history(user, job.original_image, color_list)
+    return job.to_response()
+
+
+@router.get("/jobs/{job_id}")
+async def get_processing_job(job_store: Annotated['JobStore', Depends(get_job_store)],
+                             user: Annotated['User', Depends(get_user)],
+                             job_id: str):
+    return _get_job(job_store, user.uid, job_id).to_response()
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_processing_job(job_store: Annotated['JobStore', Depends(get_job_store)],
+                                env: Annotated[Settings, Depends(getEnv)],
+                                user: Annotated['User', Depends(get_user)],
+                                job_id: str):
+    # server-sent events: a "processed" event per finished color, then "done" or "failed"
+    job = _get_job(job_store, user.uid, job_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(_job_events(job, env.job_events_keepalive_s), headers=headers, media_type="text/event-stream")
+
+
 @router.get("/{image_hash}")
-def get_image_by_hash(image_service: Annotated['ImageService', Depends(get_image_service)],
+async def get_image_by_hash(image_service: Annotated['ImageService', Depends(get_image_service)],
                       user: Annotated['User', Depends(get_user)],
-                      image_hash: str
+                      image_hash: str,
+                      request: Request,
+                      size: int | None = None
                       ):
-    image = image_service.get_image_by_hash(user.uid, image_hash)
-    return Response(content=image.image_bytes, media_type=image.contentType)
+    # size selects a downscaled rendition instead of the full resolution image
+    if size is not None and size not in RENDITION_SIZES:
+        raise HTTPException(status_code=422, detail=f"Invalid size {size}, expected one of {list(RENDITION_SIZES)}")
+    # images are content addressed, the hash alone says if the client is up to date
+    etag = image_etag(image_hash if size is None else f"{image_hash}-{size}")
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+    image = await image_service.get_image_by_hash(user.uid, image_hash, size)
+    return image_response(request, image, etag)
 
 @router.get("/bulk/{image_hash}")
-def get_all_images_for_hash(image_service: Annotated['ImageService', Depends(get_image_service)],
+async def get_all_images_for_hash(image_service: Annotated['ImageService', Depends(get_image_service)],
                             user: Annotated['User', Depends(get_user)],
                             image_hash: str):
-    zip_file = image_service.get_image_zip_from_raw_hash(user.uid, image_hash)
+    zip_file = await image_service.get_image_zip_from_raw_hash(user.uid, image_hash)
     headers = {
         "Content-Disposition": "attachment; filename=images.zip"
     }
-    return Response(zip_file.getvalue(), headers=headers, media_type="application/zip")
+    # the archive is written while the images are downloaded
+    return StreamingResponse(zip_file, headers=headers, media_type="application/zip")
 
 @router.get("/list/{image_hash}")
 async def list_image_for_hash(image_service: Annotated['ImageService', Depends(get_image_service)],
@@ -42,7 +129,7 @@ async def list_image_for_hash(image_service: Annotated['ImageService', Depends(g
                         user: Annotated['User', Depends(get_user)],
                         image_hash: str
                         ):
-    summary = image_service.get_image_summary_by_hash(user.uid, image_hash)
+    summary = await image_service.get_image_summary_by_hash(user.uid, image_hash)
     await history_service.update_history(user, summary.original_image, [])
     return summary
 
@@ -54,13 +141,7 @@ async def upload_file(image_service: Annotated['ImageService', Depends(get_image
                       file: UploadFile = File(...),
                       colors: str = Form(...)):
     print("Upload Received Colors: ", colors)
-    try:
-        raw_colors = json.loads(colors)
-        color_list = [ColorDTO(**color) for color in raw_colors]
-    except (SyntaxError, ValidationError, TypeError) as e:
-        raise HTTPException(status_code=422, detail=f"Invalid 'colors' input: {e}")
-    except Exception as e:
-        raise HTTPException(status_code=422, detail=f"invalid color input: {e}")
+    color_list = _parse_colors(colors)
     images = await image_service.upload_and_process_image(user.uid, file, color_list)
     await history_service.update_history(user, images.original_image, color_list)
     return images
\ No newline at end of file
@@ -15,6 +15,7 @@
 # Copyright (c) 2020 SenseTime. All Rights Reserved.
 # ------------------------------------------------------------------------
 import copy
+from collections import OrderedDict
 from typing import List
 
 import torch
@@ -128,6 +129,10 @@ class GroundingDINO(nn.Module):
             ["[CLS]", "[SEP]", ".", "?"]
         )
 
+        # encoded captions, see get_text_dict
+        self._text_cache = OrderedDict()
+        self.text_cache_size = 16
+
         # prepare input projection layers
         if num_feature_levels > 1:
             num_backbone_outs = len(backbone.num_channels)
@@ -229,30 +234,11 @@ class GroundingDINO(nn.Module):
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, self.query_dim)
 
-    def forward(self, samples: NestedTensor, targets: List = None, **kw):
-        """The forward expects a NestedTensor, which consists of:
-           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
-           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
-
-        It returns a dict with the following elements:
-           - "pred_logits": the classification logits (including no-object) for all queries.
-                            Shape= [batch_size x num_queries x num_classes]
-           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                           (center_x, center_y, width, height). These values are normalized in [0, 1],
-                           relative to the size of each individual image (disregarding possible padding).
-                           See PostProcess for information on how to retrieve the unnormalized bounding box.
-           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                            dictionnaries containing the two above keys for each decoder layer.
-        """
-        if targets is None:
-            captions = kw["captions"]
-        else:
-            captions = [t["caption"] for t in targets]
-        len(captions)
-
+    def encode_text(self, captions, device):
+        """Tokenizes the captions and runs them through the BERT text encoder."""
         # encoder texts
         tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
+            device
         )
         (
             text_self_attention_masks,
@@ -310,10 +296,59 @@ class GroundingDINO(nn.Module):
             "text_self_attention_masks": text_self_attention_masks,  # bs, 195,195
         }
 
-        # import ipdb; ipdb.set_trace()
+        return text_dict
+
+    def get_text_dict(self, captions, device):
+        """
+        Returns the encoded text features for `captions`. In eval mode the
+        result is kept in a small LRU cache, so a repeated caption skips the
+        tokenizer and the BERT forward pass.
+        """
+        if self.training:
+            return self.encode_text(captions, device)
+
+        key = (tuple(captions), str(device))
+        text_dict = self._text_cache.get(key)
+        if text_dict is None:
+            with torch.no_grad():
+                text_dict = self.encode_text(captions, device)
+            self._text_cache[key] = text_dict
+            while len(self._text_cache) > self.text_cache_size:
+                self._text_cache.popitem(last=False)
+        else:
+            self._text_cache.move_to_end(key)
+
+        # the transformer writes the fused text features back into the dict
+        return dict(text_dict)
 
+    def forward(self, samples: NestedTensor, targets: List = None, **kw):
+        """The forward expects a NestedTensor, which consists of:
+           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+        Captions are passed as `captions=[...]`, or already encoded as `text_dict=` (see get_text_dict).
+
+        It returns a dict with the following elements:
+           - "pred_logits": the classification logits (including no-object) for all queries.
+                            Shape= [batch_size x num_queries x num_classes]
+           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
+                           (center_x, center_y, width, height). These values are normalized in [0, 1],
+                           relative to the size of each individual image (disregarding possible padding).
+                           See PostProcess for information on how to retrieve the unnormalized bounding box.
+           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+                            dictionnaries containing the two above keys for each decoder layer.
+        """
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
+
+        text_dict = kw.get("text_dict", None)
+        if text_dict is None:
+            if targets is None:
+                captions = kw["captions"]
+            else:
+                captions = [t["caption"] for t in targets]
+            text_dict = self.get_text_dict(captions, samples.device)
+
         features, poss = self.backbone(samples)
 
         srcs = []
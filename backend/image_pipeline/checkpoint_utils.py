@@ -0,0 +1,134 @@
+"""
+Helpers for loading model checkpoints memory-mapped.
+
+`convert_checkpoint` rewrites a training checkpoint into a flat, cleaned
+state dict saved next to the original as `<name>.mmap.pth`. When that file
+exists, `Dino` and `SAM` build the model with its parameters on the meta
+device and load it with `torch.load(..., mmap=True)` and
+`load_state_dict(..., assign=True)`, so the weights are mapped straight from
+disk into the module parameters. No randomly initialized copy of the model is
+allocated first, and the checkpoint isn't read into a second copy either.
+
+Run this file to convert the default models:
+    python image_pipeline/checkpoint_utils.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+import torch
+
+MMAP_SUFFIX = ".mmap.pth"
+
+
+def mmap_checkpoint_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + MMAP_SUFFIX
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, if known."""
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB everywhere else
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def load_mmap_state_dict(checkpoint_path):
+    return torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+@contextlib.contextmanager
+def meta_parameters():
+    """
+    Moves every parameter registered inside the block to the meta device, so
+    building a model allocates no weights and its weight initialization does
+    nothing. Buffers stay on the CPU: the non-persistent ones (e.g. SAM's
+    pixel mean and std) are not in the checkpoint and keep the values the
+    model computed for them.
+    """
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        if param is not None and not param.is_meta:
+            param = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    torch.nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def build_from_mmap(build, checkpoint_path, strict=True):
+    """
+    Builds a model with `build()` under `meta_parameters` and assigns the
+    memory-mapped state dict from `checkpoint_path` to it. Returns the model
+    and the `load_state_dict` result.
+    """
+    with meta_parameters():
+        model = build()
+    load_res = model.load_state_dict(
+        load_mmap_state_dict(checkpoint_path), strict=strict, assign=True
+    )
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(
+            f"{checkpoint_path} has no weights for {', '.join(missing)}, convert it again"
+        )
+    return model, load_res
+
+
+def convert_checkpoint(src_path, dst_path=None, state_dict_key=None):
+    """
+    Converts `src_path` into a memory-mappable state dict. `state_dict_key`
+    selects the state dict inside training checkpoints (e.g. "model").
+    """
+    if dst_path is None:
+        dst_path = mmap_checkpoint_path(src_path)
+
+    checkpoint = torch.load(src_path, map_location="cpu")
+    if state_dict_key is not None:
+        checkpoint = checkpoint[state_dict_key]
+
+    state_dict = {}
+    for key, value in checkpoint.items():
+        # strip DataParallel prefixes, same as clean_state_dict in GroundingDINO
+        if key.startswith("module."):
+            key = key[len("module."):]
+        state_dict[key] = value.contiguous()
+
+    tmp_path = f"{dst_path}.tmp"
+    torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+if __name__ == "__main__":
+    cur_path = os.path.dirname(__file__)
+    parser = argparse.ArgumentParser(
+        description="Convert model checkpoints for memory-mapped loading"
+    )
+    parser.add_argument(
+        "--gd-checkpoint",
+        default=os.path.join(cur_path, "models/groundingdino_swint_ogc.pth"),
+    )
+    parser.add_argument(
+        "--sam-checkpoint",
+        default=os.path.join(cur_path, "models/sam_vit_h_4b8939.pth"),
+    )
+    args = parser.parse_args()
+
+    for src_path, key in ((args.gd_checkpoint, "model"), (args.sam_checkpoint, None)):
+        start = time.time()
+        dst_path = convert_checkpoint(src_path, state_dict_key=key)
+        print(f"Converted {src_path} -> {dst_path} in {time.time() - start:.1f} seconds")
@@ -5,6 +5,8 @@ https://github.com/lovro-i/CIEDE2000/tree/master
 
 import math
 
+import numpy as np
+
 
 def calc_delta_CIEDE2000(Lab_1, Lab_2):
     """Calculates CIEDE2000 color distance between two CIE L*a*b* colors"""
@@ -96,3 +98,97 @@ def calc_delta_CIEDE2000(Lab_1, Lab_2):
 
     dE_00 = math.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
     return dE_00
+
+
+def calc_delta_CIEDE2000_matrix(Lab_1, Lab_2):
+    """
+    Vectorized calc_delta_CIEDE2000. Takes (N, 3) and (M, 3) arrays of CIE
+    L*a*b* colors and returns the (N, M) matrix of pairwise distances.
+    """
+    C_25_7 = 6103515625  # 25**7
+
+    Lab_1 = np.asarray(Lab_1, dtype=np.float64).reshape(-1, 3)[:, None, :]
+    Lab_2 = np.asarray(Lab_2, dtype=np.float64).reshape(-1, 3)[None, :, :]
+
+    L1, a1, b1 = Lab_1[..., 0], Lab_1[..., 1], Lab_1[..., 2]
+    L2, a2, b2 = Lab_2[..., 0], Lab_2[..., 1], Lab_2[..., 2]
+    C1 = np.sqrt(a1**2 + b1**2)
+    C2 = np.sqrt(a2**2 + b2**2)
+    C_ave = (C1 + C2) / 2
+    G = 0.5 * (1 - np.sqrt(C_ave**7 / (C_ave**7 + C_25_7)))
+
+    L1_, L2_ = L1, L2
+    a1_, a2_ = (1 + G) * a1, (1 + G) * a2
+    b1_, b2_ = b1, b2
+
+    C1_ = np.sqrt(a1_**2 + b1_**2)
+    C2_ = np.sqrt(a2_**2 + b2_**2)
+
+    h1_ = np.arctan2(b1_, a1_)
+    h1_ = np.where(a1_ >= 0, h1_, h1_ + 2 * np.pi)
+    h1_ = np.where((b1_ == 0) & (a1_ == 0), 0.0, h1_)
+
+    h2_ = np.arctan2(b2_, a2_)
+    h2_ = np.where(a2_ >= 0, h2_, h2_ + 2 * np.pi)
+    h2_ = np.where((b2_ == 0) & (a2_ == 0), 0.0, h2_)
+
+    dL_ = L2_ - L1_
+    dC_ = C2_ - C1_
+    dh_ = h2_ - h1_
+    dh_ = np.where(dh_ > np.pi, dh_ - 2 * np.pi, np.where(dh_ < -np.pi, dh_ + 2 * np.pi, dh_))
+    dh_ = np.where(C1_ * C2_ == 0, 0.0, dh_)
+    dH_ = 2 * np.sqrt(C1_ * C2_) * np.sin(dh_ / 2)
+
+    L_ave = (L1_ + L2_) / 2
+    C_ave = (C1_ + C2_) / 2
+
+    _dh = np.abs(h1_ - h2_)
+    _sh = h1_ + h2_
+    C1C2 = C1_ * C2_
+
+    h_ave = np.select(
+        [
+            (_dh <= np.pi) & (C1C2 != 0),
+            (_dh > np.pi) & (_sh < 2 * np.pi) & (C1C2 != 0),
+            (_dh > np.pi) & (_sh >= 2 * np.pi) & (C1C2 != 0),
+        ],
+        [
+            (h1_ + h2_) / 2,
+            (h1_ + h2_) / 2 + np.pi,
+            (h1_ + h2_) / 2 - np.pi,
+        ],
+        default=h1_ + h2_,
+    )
+
+    T = (
+        1
+        - 0.17 * np.cos(h_ave - np.pi / 6)
+        + 0.24 * np.cos(2 * h_ave)
+        + 0.32 * np.cos(3 * h_ave + np.pi / 30)
+        - 0.2 * np.cos(4 * h_ave - 63 * np.pi / 180)
+    )
+
+    h_ave_deg = h_ave * 180 / np.pi
+    h_ave_deg = np.where(
+        h_ave_deg < 0,
+        h_ave_deg + 360,
+        np.where(h_ave_deg > 360, h_ave_deg - 360, h_ave_deg),
+    )
+    dTheta = 30 * np.exp(-(((h_ave_deg - 275) / 25) ** 2))
+
+    R_C = 2 * np.sqrt(C_ave**7 / (C_ave**7 + C_25_7))
+    S_C = 1 + 0.045 * C_ave
+    S_H = 1 + 0.015 * C_ave * T
+
+    Lm50s = (L_ave - 50) ** 2
+    S_L = 1 + 0.015 * Lm50s / np.sqrt(20 + Lm50s)
+    R_T = -np.sin(dTheta * np.pi / 90) * R_C
+
+    k_L, k_C, k_H = 1, 1, 1
+
+    f_L = dL_ / k_L / S_L
+    f_C = dC_ / k_C / S_C
+    f_H = dH_ / k_H / S_H
+
+    dE_00 = np.sqrt(f_L**2 + f_C**2 + f_H**2 + R_T * f_C * f_H)
+    return dE_00
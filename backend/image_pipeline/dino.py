@@ -10,11 +10,13 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "GroundingDino"))
 # Grounding DINO
 import GroundingDINO.groundingdino.datasets.transforms as T
 from GroundingDINO.groundingdino.models import build_model
+from GroundingDINO.groundingdino.util.misc import nested_tensor_from_tensor_list
 from GroundingDINO.groundingdino.util.slconfig import SLConfig
 from GroundingDINO.groundingdino.util.utils import (
     clean_state_dict,
     get_phrases_from_posmap,
 )
+from checkpoint_utils import mmap_checkpoint_path, build_from_mmap
 
 
 class Dino:
@@ -27,11 +29,18 @@ class Dino:
     def _load_gd_model(self):
         args = SLConfig.fromfile(self.config_file)
         args.device = self.device
-        model = build_model(args)
-        checkpoint = torch.load(self.model_file, map_location="cpu")
-        load_res = model.load_state_dict(
-            clean_state_dict(checkpoint["model"]), strict=False
-        )
+        mmap_file = mmap_checkpoint_path(self.model_file)
+        if os.path.exists(mmap_file):
+            # converted checkpoint, map the weights straight into the model
+            model, load_res = build_from_mmap(
+                lambda: build_model(args), mmap_file, strict=False
+            )
+        else:
+            model = build_model(args)
+            checkpoint = torch.load(self.model_file, map_location="cpu")
+            load_res = model.load_state_dict(
+                clean_state_dict(checkpoint["model"]), strict=False
+            )
         _ = model.eval()
         return model
 
@@ -89,23 +98,17 @@ class Dino:
 
         return image
 
-    def run_inference(
-        self, image_pil, caption, box_threshold, text_threshold, with_logits=True
-    ):
-        image = self.transform_img(image_pil)
-
+    @staticmethod
+    def _format_caption(caption):
         caption = caption.lower()
         caption = caption.strip()
         if not caption.endswith("."):
             caption = caption + "."
-        self.gd_model = self.gd_model.to(self.device)
-        image = image.to(self.device)
-        with torch.no_grad():
-            outputs = self.gd_model(image[None], captions=[caption])
-        logits = outputs["pred_logits"].cpu().sigmoid()[0]  # (nq, 256)
-        boxes = outputs["pred_boxes"].cpu()[0]  # (nq, 4)
-        logits.shape[0]
+        return caption
 
+    def _build_pred_dict(
+        self, image_pil, logits, boxes, caption, box_threshold, text_threshold, with_logits
+    ):
         # filter output
         logits_filt = logits.clone()
         boxes_filt = boxes.clone()
@@ -136,3 +139,54 @@ class Dino:
         }
 
         return pred_dict
+
+    def run_inference(
+        self, image_pil, caption, box_threshold, text_threshold, with_logits=True
+    ):
+        image = self.transform_img(image_pil)
+
+        caption = self._format_caption(caption)
+        self.gd_model = self.gd_model.to(self.device)
+        image = image.to(self.device)
+        with torch.no_grad():
+            outputs = self.gd_model(image[None], captions=[caption])
+        logits = outputs["pred_logits"].cpu().sigmoid()[0]  # (nq, 256)
+        boxes = outputs["pred_boxes"].cpu()[0]  # (nq, 4)
+        logits.shape[0]
+
+        return self._build_pred_dict(
+            image_pil, logits, boxes, caption, box_threshold, text_threshold, with_logits
+        )
+
+    def run_inference_batch(
+        self, images_pil, caption, box_threshold, text_threshold, with_logits=True
+    ):
+        """
+        Runs a single GroundingDINO forward pass over several images. The
+        images are padded to a common size with `nested_tensor_from_tensor_list`
+        and the predicted boxes stay normalized to each image's own (unpadded)
+        size.
+        """
+        images = nested_tensor_from_tensor_list(
+            [self.transform_img(image_pil).to(self.device) for image_pil in images_pil]
+        )
+
+        caption = self._format_caption(caption)
+        self.gd_model = self.gd_model.to(self.device)
+        with torch.no_grad():
+            outputs = self.gd_model(images, captions=[caption] * len(images_pil))
+        logits = outputs["pred_logits"].cpu().sigmoid()  # (bs, nq, 256)
+        boxes = outputs["pred_boxes"].cpu()  # (bs, nq, 4)
+
+        return [
+            self._build_pred_dict(
+                image_pil,
+                logits[i],
+                boxes[i],
+                caption,
+                box_threshold,
+                text_threshold,
+                with_logits,
+            )
+            for i, image_pil in enumerate(images_pil)
+        ]
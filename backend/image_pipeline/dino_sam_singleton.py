@@ -1,8 +1,6 @@
 import os
-import copy
 from PIL import Image
 import cv2
-import skimage.exposure
 import numpy as np
 import torch
 import time
@@ -11,9 +9,13 @@ import sys
 cur_path = os.path.join(os.path.dirname(__file__))
 sys.path.append(cur_path)
 
-from color_helper import calc_delta_CIEDE2000
+from mask_buckets import create_buckets
+from recolor_engine import FeatheredMasks
+from wall_recolorer import WallRecolorer
 from dino import Dino
 from sam import SAM
+from embedding_cache import EmbeddingCache
+from checkpoint_utils import peak_rss_mb
 
 
 SAM_DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -23,6 +25,11 @@ GD_CONFIG_FILENAME = os.path.join(cur_path, "models/GroundingDINO_SwinT_OGC.py")
 SAM_FILENAME =  os.path.join(cur_path, "models/sam_vit_h_4b8939.pth")
 SAM_TYPE = "vit_h"
 
+# SAM image embedding cache, keyed by raw image hash
+EMBEDDING_CACHE_DIR = os.path.join(cur_path, "cache", f"sam_{SAM_TYPE}_embeddings")
+EMBEDDING_CACHE_MEMORY_ENTRIES = 8
+EMBEDDING_CACHE_DISK_ENTRIES = 512
+
 # hyper-param for GroundingDINO
 CAPTION = "wall"
 BOX_THRESHOLD = 0.30
@@ -31,6 +38,13 @@ TEXT_THRESHOLD = 0.35
 # Parameter for Mask Bucketing
 MAX_DELTA = 30
 
+# Number of images sent through the SAM image encoder together
+SAM_BATCH_SIZE = 2
+
+# Default resolution policy, see `DinoSAMSingleton.set_resolution_policy`
+WORKING_MAX_MEGAPIXELS = 2.0
+FULL_RESOLUTION_OUTPUT = True
+
 
 class Singleton:
     """
@@ -74,26 +88,58 @@ class Singleton:
 @Singleton
 class DinoSAMSingleton:
     def __init__(self):
+        self.embedding_cache = EmbeddingCache(
+            EMBEDDING_CACHE_DIR,
+            EMBEDDING_CACHE_MEMORY_ENTRIES,
+            EMBEDDING_CACHE_DISK_ENTRIES,
+        )
+        start = time.time()
         self.gd_predictor = Dino(GD_FILENAME, GD_CONFIG_FILENAME, GD_DEVICE)
-        print("GroundingDINO Model Loaded")
-        self.sam_predictor = SAM(SAM_FILENAME, SAM_TYPE, SAM_DEVICE)
-        print("SAM Model Loaded")
+        print(f"GroundingDINO Model Loaded ({self._load_stats(start)})")
+        start = time.time()
+        self.sam_predictor = SAM(
+            SAM_FILENAME, SAM_TYPE, SAM_DEVICE, self.embedding_cache
+        )
+        print(f"SAM Model Loaded ({self._load_stats(start)})")
+        self.set_resolution_policy(WORKING_MAX_MEGAPIXELS, FULL_RESOLUTION_OUTPUT)
+
+    def set_resolution_policy(self, max_megapixels, full_resolution_output):
+        """See `WallRecolorer`, which feathers and recolors for the pipeline."""
+        self.recolorer = WallRecolorer(max_megapixels, full_resolution_output)
+
+    def working_image(self, image_cv):
+        return self.recolorer.working_image(image_cv)
+
+    @staticmethod
+    def _load_stats(start):
+        stats = f"{time.time() - start:.1f}s"
+        peak_rss = peak_rss_mb()
+        if peak_rss is not None:
+            stats += f", peak RSS {peak_rss:.0f} MB"
+        return stats
 
     def run_pipeline(self, image_cv, image_name, colors):
         print(f"=== Starting Grounded SAM Pipeline for Image {image_name} ===\n")
-        image_pil = Image.fromarray(cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)) 
+        working_cv = self.working_image(image_cv)
+        image_pil = Image.fromarray(cv2.cvtColor(working_cv, cv2.COLOR_BGR2RGB)) 
 
         try:
             pred_dict = self.gd_predictor.run_inference(
                 image_pil, CAPTION, BOX_THRESHOLD, TEXT_THRESHOLD
             )
-            masks = self.sam_predictor.run_inference(image_pil, pred_dict)
+            masks = self.sam_predictor.run_inference(image_pil, pred_dict, image_name)
         except RuntimeError as e:
             print(f"Error running ML Pipeline: {e}")
             print(f"Restarting models")
             self.gd_predictor = Dino(GD_FILENAME, GD_CONFIG_FILENAME, GD_DEVICE)
-            self.sam_predictor = SAM(SAM_FILENAME, SAM_TYPE, SAM_DEVICE)
-            return [],[image_cv for i in range(len(colors))]
+            self.sam_predictor = SAM(
+                SAM_FILENAME, SAM_TYPE, SAM_DEVICE, self.embedding_cache
+            )
+            return (
+                [],
+                FeatheredMasks.from_masks(image_cv, []),
+                [image_cv for i in range(len(colors))],
+            )
 
         boxed_image = self.gd_predictor.apply_boxes_to_image(image_pil, pred_dict)
         # boxed_image.save(
@@ -105,63 +151,98 @@ class DinoSAMSingleton:
         # )
 
         print("\n=== Starting Image Recoloring ===\n")
-        buckets = self.create_buckets(image_cv, masks)
-
-        masks = self.merge_masks(buckets, masks)
+        masks, feathered_masks, colored_images = self.bucket_and_recolor(
+            image_cv, masks, colors
+        )
         masked_image = self.sam_predictor.apply_mask_to_image(image_pil, masks)
         # masked_image.save(
         #     f"{os.path.splitext(os.path.basename(image_name))[0]}_mask_merged.jpg"
         # )
 
-        colored_images = []
-        
-        for color in colors:
-            recolored_image = self.recolor(image_cv, color, masks)
-            color_string = "-".join([str(val) for val in color])
-            # cv2.imwrite(
-            #     f"{os.path.splitext(os.path.basename(image_name))[0]}_recolored_{color_string}.png",
-            #     recolored_image,
-            # )
-            colored_images.append(recolored_image)
-        
         print("\n=== Pipeline Finished ===\n")
-                
-        return masks, colored_images
+
+        return masks, feathered_masks, colored_images
+
+    def run_pipeline_batch(self, images_cv, image_names, colors_per_image):
+        """
+        Batched version of `run_pipeline`. Runs one GroundingDINO forward pass
+        for all images and the SAM image encoder in micro-batches of
+        `SAM_BATCH_SIZE`, then buckets and recolors each image separately.
+        Returns a list of `(masks, feathered_masks, colored_images)` in the
+        order of `images_cv`.
+        """
+        print(f"=== Starting Batched Grounded SAM Pipeline for {len(images_cv)} Images ===\n")
+        images_pil = [
+            Image.fromarray(cv2.cvtColor(self.working_image(image_cv), cv2.COLOR_BGR2RGB))
+            for image_cv in images_cv
+        ]
+
+        try:
+            pred_dicts = self.gd_predictor.run_inference_batch(
+                images_pil, CAPTION, BOX_THRESHOLD, TEXT_THRESHOLD
+            )
+            masks_per_image = self.sam_predictor.run_inference_batch(
+                images_pil, pred_dicts, image_names, SAM_BATCH_SIZE
+            )
+        except RuntimeError as e:
+            print(f"Error running ML Pipeline: {e}")
+            print(f"Restarting models")
+            self.gd_predictor = Dino(GD_FILENAME, GD_CONFIG_FILENAME, GD_DEVICE)
+            self.sam_predictor = SAM(
+                SAM_FILENAME, SAM_TYPE, SAM_DEVICE, self.embedding_cache
+            )
+            return [
+                (
+                    [],
+                    FeatheredMasks.from_masks(image_cv, []),
+                    [image_cv for i in range(len(colors))],
+                )
+                for image_cv, colors in zip(images_cv, colors_per_image)
+            ]
+
+        print("\n=== Starting Image Recoloring ===\n")
+        results = [
+            self.bucket_and_recolor(image_cv, masks, colors)
+            for image_cv, masks, colors in zip(images_cv, masks_per_image, colors_per_image)
+        ]
+
+        print("\n=== Pipeline Finished ===\n")
+
+        return results
+
+    def warmup(self, width=1600, height=1200):
+        """
+        Runs every stage of the pipeline once on a synthetic image so the
+        first real request doesn't pay for tokenizer loading, kernel
+        selection and allocator growth.
+        """
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)
+        image_cv = np.dstack([np.tile(gradient, (height, 1))] * 3)
+        working_cv = self.working_image(image_cv)
+        image_pil = Image.fromarray(cv2.cvtColor(working_cv, cv2.COLOR_BGR2RGB))
+
+        self.gd_predictor.run_inference(
+            image_pil, CAPTION, BOX_THRESHOLD, TEXT_THRESHOLD
+        )
+        self.sam_predictor.set_image(np.array(image_pil))
+        self.sam_predictor.sam_model.reset_image()
+
+        mask_height, mask_width = working_cv.shape[:2]
+        mask = np.zeros((mask_height, mask_width), dtype=bool)
+        mask[mask_height // 4 : 3 * mask_height // 4, mask_width // 4 : 3 * mask_width // 4] = True
+        self.recolorer.recolor(image_cv, [128, 128, 128], [mask])
+
+    def bucket_and_recolor(self, image_cv, masks, colors):
+        buckets = self.create_buckets(self.recolorer.image_for_masks(image_cv, masks), masks)
+        masks = self.merge_masks(buckets, masks)
+
+        feathered_masks = self.recolorer.feather_masks(image_cv, masks)
+        colored_images = self.recolorer.recolor_many(image_cv, colors, feathered_masks)
+
+        return masks, feathered_masks, colored_images
 
     def create_buckets(self, image_cv, masks):
-        buckets = {}
-
-        image_lab = cv2.cvtColor(image_cv, cv2.COLOR_BGR2LAB)
-
-        for i in range(len(masks)):
-            mask = (masks[i].astype(np.uint8) * 255).astype(np.uint8)
-            ave_color = cv2.mean(image_lab, mask=mask)[:3]
-
-            if not buckets:
-                buckets[len(buckets) + 1] = {"avg": list(ave_color), "masks": [i]}
-            else:
-                smallest_delta = float("inf")
-                best_bucket = -1
-
-                for key in buckets.keys():
-                    ave_bucket_color = buckets[key]["avg"]
-                    distance = calc_delta_CIEDE2000(ave_bucket_color, ave_color)
-                    if distance < smallest_delta:
-                        smallest_delta = distance
-                        best_bucket = key
-
-                if best_bucket != -1:
-                    if smallest_delta > MAX_DELTA:
-                        buckets[len(buckets) + 1] = {
-                            "avg": list(ave_color),
-                            "masks": [i],
-                        }
-                    else:
-                        buckets[key]["avg"] = np.mean(
-                            np.array([buckets[key]["avg"], ave_color]), axis=0
-                        ).tolist()
-                        buckets[key]["masks"].append(i)
-        return buckets
+        return create_buckets(image_cv, masks, MAX_DELTA)
 
     def merge_masks(self, buckets, masks):
         new_masks = []
@@ -177,42 +258,6 @@ class DinoSAMSingleton:
             new_masks.append(new_mask)
         return new_masks
 
-    def recolor(self, image_cv, color_rgb, masks):
-        image = copy.deepcopy(image_cv).astype(np.int16)
-        color_bgr = color_rgb[::-1]
-        desired_color = np.asarray(color_bgr, dtype=np.float64)
-
-        for wallmask in masks:
-            mask = (wallmask.astype(np.uint8) * 255).astype(np.uint8)
-
-            # get average bgr color of masked section
-            ave_color = cv2.mean(image, mask=mask)[:3]
-            # print(f"Average color = {ave_color}")
-
-            # compute difference colors and make into an image the same size as input
-            diff_color = desired_color - ave_color
-            diff_color = np.full_like(image, diff_color, dtype=np.int16)
-
-            # shift input image color
-            # cv2.add clips automatically
-            new_image = cv2.add(image, diff_color)
-
-            # antialias mask, convert to float in range 0 to 1 and make 3-channels
-            mask = cv2.GaussianBlur(
-                mask, (0, 0), sigmaX=3, sigmaY=3, borderType=cv2.BORDER_DEFAULT
-            )
-            mask = skimage.exposure.rescale_intensity(
-                mask, in_range=(100, 150), out_range=(0, 1)
-            ).astype(np.float32)
-            mask = cv2.merge([mask, mask, mask])
-
-            # combine img and new_img using mask
-            result = image * (1 - mask) + new_image * mask
-            result = result.clip(0, 255).astype(np.int16)
-            image = result
-
-        return image
-
 
 if __name__ == "__main__":
     print("Running pipeline test")
@@ -0,0 +1,121 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Two level cache for SAM image embeddings keyed by raw image hash.
+
+    Recently used embeddings are kept in memory with LRU eviction. Every
+    embedding is also written to `cache_dir` as a `.npy` file (plus a small
+    `.json` sidecar holding the image sizes) so that it survives evictions and
+    server restarts. Disk entries are opened memory-mapped, so a hit on disk
+    only pages in the ~4MB embedding instead of re-running the image encoder.
+    """
+
+    def __init__(self, cache_dir, max_memory_entries=8, max_disk_entries=512):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, image_hash):
+        base = os.path.join(self.cache_dir, image_hash)
+        return f"{base}.npy", f"{base}.json"
+
+    def get(self, image_hash):
+        """
+        Returns `(features, original_size, input_size)` for the image or
+        None if it has never been embedded.
+        """
+        with self._lock:
+            entry = self._entries.get(image_hash)
+            if entry is not None:
+                self._entries.move_to_end(image_hash)
+                return entry
+
+        entry = self._load_from_disk(image_hash)
+        if entry is not None:
+            self._remember(image_hash, entry)
+        return entry
+
+    def put(self, image_hash, features, original_size, input_size):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        entry = (features, tuple(original_size), tuple(input_size))
+        self._remember(image_hash, entry)
+        self._write_to_disk(image_hash, entry)
+
+    def _remember(self, image_hash, entry):
+        with self._lock:
+            self._entries[image_hash] = entry
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def _load_from_disk(self, image_hash):
+        npy_path, json_path = self._paths(image_hash)
+        if not os.path.exists(npy_path) or not os.path.exists(json_path):
+            return None
+        try:
+            with open(json_path, "r") as f:
+                sizes = json.load(f)
+            features = np.load(npy_path, mmap_mode="r")
+            # touch the entry so disk eviction follows last use
+            os.utime(npy_path)
+        except (OSError, ValueError) as e:
+            print(f"Discarding unreadable embedding cache entry {image_hash}: {e}")
+            return None
+        return features, tuple(sizes["original_size"]), tuple(sizes["input_size"])
+
+    def _write_to_disk(self, image_hash, entry):
+        features, original_size, input_size = entry
+        npy_path, json_path = self._paths(image_hash)
+        # write to temp files first so concurrent readers never see partial data
+        tmp_npy = f"{npy_path}.{os.getpid()}.tmp"
+        tmp_json = f"{json_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_npy, "wb") as f:
+                np.save(f, features)
+            with open(tmp_json, "w") as f:
+                json.dump(
+                    {"original_size": original_size, "input_size": input_size}, f
+                )
+            os.replace(tmp_json, json_path)
+            os.replace(tmp_npy, npy_path)
+        except OSError as e:
+            print(f"Could not persist embedding for {image_hash}: {e}")
+            return
+        self._evict_disk()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def _evict_disk(self):
+        try:
+            npy_files = [
+                os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith(".npy")
+            ]
+        except OSError:
+            return
+        if len(npy_files) <= self.max_disk_entries:
+            return
+        npy_files.sort(key=self._mtime)
+        for npy_path in npy_files[: len(npy_files) - self.max_disk_entries]:
+            json_path = f"{os.path.splitext(npy_path)[0]}.json"
+            for path in (npy_path, json_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+from color_helper import calc_delta_CIEDE2000_matrix
+
+# number of pixels multiplied per chunk when averaging masks. Small enough for
+# the chunk buffers to stay in cache, and 2**11 * 255 fits in float32's 24 bit
+# mantissa so every per-chunk sum is exact
+PIXEL_CHUNK_SIZE = 1 << 11
+
+
+def mask_mean_colors(image, masks):
+    """
+    Returns the (N, C) mean color of `image` under each of the N masks,
+    equivalent to calling `cv2.mean(image, mask=mask)` for every mask.
+    Empty masks get a mean of 0, like `cv2.mean`.
+    """
+    masks = np.asarray(masks)
+    num_masks = masks.shape[0]
+    flat_masks = masks.reshape(num_masks, -1)
+    if flat_masks.dtype != bool:
+        flat_masks = flat_masks != 0
+    channels = image.reshape(-1, image.shape[-1])
+    num_pixels, num_channels = channels.shape
+
+    # one matrix product per chunk gives the per-mask channel sums; the extra
+    # column of ones in the pixel buffer gives the per-mask pixel counts
+    mask_buffer = np.empty((num_masks, PIXEL_CHUNK_SIZE), dtype=np.float32)
+    pixel_buffer = np.ones((PIXEL_CHUNK_SIZE, num_channels + 1), dtype=np.float32)
+    sums = np.zeros((num_masks, num_channels + 1), dtype=np.float64)
+    for start in range(0, num_pixels, PIXEL_CHUNK_SIZE):
+        end = min(start + PIXEL_CHUNK_SIZE, num_pixels)
+        size = end - start
+        np.copyto(mask_buffer[:, :size], flat_masks[:, start:end])
+        np.copyto(pixel_buffer[:size, :num_channels], channels[start:end])
+        sums += mask_buffer[:, :size] @ pixel_buffer[:size]
+
+    counts = sums[:, num_channels:]
+    means = np.zeros((num_masks, num_channels), dtype=np.float64)
+    np.divide(sums[:, :num_channels], counts, out=means, where=counts > 0)
+    return means
+
+
+def create_buckets(image_cv, masks, max_delta):
+    """
+    Groups masks whose average Lab colors are within `max_delta` (CIEDE2000)
+    of each other. The mean colors of all masks are computed in one pass and
+    each mask is compared against every bucket with a single vectorized
+    distance call.
+
+    Produces the same buckets as the original greedy loop. That includes its
+    quirk: a mask close enough to some bucket joins the most recently created
+    bucket, not necessarily the closest one.
+    """
+    buckets = {}
+    if len(masks) == 0:
+        return buckets
+
+    image_lab = cv2.cvtColor(image_cv, cv2.COLOR_BGR2LAB)
+    ave_colors = mask_mean_colors(image_lab, masks)
+
+    bucket_avgs = np.empty((len(masks), 3), dtype=np.float64)
+    num_buckets = 0
+    for i, ave_color in enumerate(ave_colors):
+        if num_buckets > 0:
+            distances = calc_delta_CIEDE2000_matrix(
+                bucket_avgs[:num_buckets], ave_color
+            )[:, 0]
+            if distances.min() <= max_delta:
+                key = num_buckets
+                bucket_avgs[key - 1] = (bucket_avgs[key - 1] + ave_color) / 2
+                buckets[key]["avg"] = bucket_avgs[key - 1].tolist()
+                buckets[key]["masks"].append(i)
+                continue
+
+        bucket_avgs[num_buckets] = ave_color
+        num_buckets += 1
+        buckets[num_buckets] = {"avg": ave_color.tolist(), "masks": [i]}
+
+    return buckets
@@ -0,0 +1,35 @@
+import struct
+import zlib
+
+import numpy as np
+
+# magic, format version, mask count, height, width
+HEADER = struct.Struct("<4sHHII")
+MAGIC = b"MSKP"
+VERSION = 1
+
+
+def pack_masks(masks):
+    """
+    Packs a stack of binary masks into one compact blob: a small header with
+    the mask count and shape, followed by the zlib compressed bits of all
+    masks (`np.packbits`, 8 pixels per byte). Wall masks are large flat
+    regions, so the compressed bits are a small fraction of 1 bit per pixel.
+    """
+    masks = np.stack([np.asarray(mask) != 0 for mask in masks])
+    count, height, width = masks.shape
+    bits = np.packbits(masks.reshape(count, -1), axis=1)
+    return HEADER.pack(MAGIC, VERSION, count, height, width) + zlib.compress(
+        bits.tobytes()
+    )
+
+
+def unpack_masks(data):
+    """Decodes a blob from `pack_masks` into a (count, height, width) bool array."""
+    magic, version, count, height, width = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported mask file (magic {magic!r}, version {version})")
+    bits = np.frombuffer(zlib.decompress(data[HEADER.size :]), dtype=np.uint8)
+    bits = bits.reshape(count, -1)
+    masks = np.unpackbits(bits, axis=1, count=height * width)
+    return masks.reshape(count, height, width).view(bool)
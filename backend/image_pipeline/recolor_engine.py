@@ -0,0 +1,179 @@
+import io
+
+import cv2
+import skimage.exposure
+import numpy as np
+
+from mask_buckets import mask_mean_colors
+from resolution import upsample_alphas
+
+# pixels blended per band, bounds the temporary float buffers
+PIXEL_BAND_SIZE = 1 << 18
+
+
+def mask_overlaps(alphas, masks):
+    """
+    (masks, masks) matrix of the mean alpha of every mask under every binary
+    mask, in 0..1. Row i says how much recoloring each mask shifts the
+    average color under mask i.
+    """
+    if len(masks) == 0:
+        return np.zeros((0, 0), dtype=np.float64)
+    return mask_mean_colors(alphas, masks) / 255
+
+
+def feather_mask(mask):
+    """Antialiases a binary mask into a uint8 alpha, 255 being fully opaque."""
+    mask = (np.asarray(mask) > 0).astype(np.uint8) * 255
+    mask = cv2.GaussianBlur(
+        mask, (0, 0), sigmaX=3, sigmaY=3, borderType=cv2.BORDER_DEFAULT
+    )
+    alpha = skimage.exposure.rescale_intensity(
+        mask, in_range=(100, 150), out_range=(0, 1)
+    )
+    return np.rint(alpha * 255).astype(np.uint8)
+
+
+class FeatheredMasks:
+    """
+    Everything the recolor needs from the wall masks of one image: the
+    quantized feathered alpha of every mask, stored pixel-major as
+    (height, width, masks) uint8, the average BGR color under every mask and
+    the (masks, masks) overlaps, `overlaps[i, j]` being the mean alpha of
+    mask j under mask i.
+
+    All of them only depend on the image and its masks, so they are computed
+    once after segmentation and persisted with `to_bytes` / `from_bytes`.
+    """
+
+    def __init__(self, alphas, ave_colors, overlaps):
+        self.alphas = alphas
+        self.ave_colors = ave_colors
+        self.overlaps = overlaps
+        self._overlapping_pixels = None
+
+    @classmethod
+    def from_masks(cls, image_cv, masks):
+        height, width = image_cv.shape[:2]
+        if len(masks) == 0:
+            return cls(
+                np.zeros((height, width, 0), dtype=np.uint8),
+                np.zeros((0, 3), dtype=np.float64),
+                np.zeros((0, 0), dtype=np.float64),
+            )
+        alphas = np.stack([feather_mask(mask) for mask in masks], axis=-1)
+        return cls(alphas, mask_mean_colors(image_cv, masks), mask_overlaps(alphas, masks))
+
+    def __len__(self):
+        return self.alphas.shape[-1]
+
+    @property
+    def overlapping_pixels(self):
+        """Flat indices of the pixels covered by more than one mask."""
+        if self._overlapping_pixels is None:
+            coverage = np.count_nonzero(self.alphas, axis=-1)
+            self._overlapping_pixels = np.flatnonzero(coverage > 1)
+        return self._overlapping_pixels
+
+    @property
+    def size(self):
+        """(width, height) the masks were feathered at."""
+        return self.alphas.shape[1], self.alphas.shape[0]
+
+    def upsampled(self, image_cv):
+        """
+        Returns these masks at the resolution of `image_cv`, see
+        `upsample_alphas`. The average wall colors carry over unchanged.
+        """
+        return FeatheredMasks(
+            upsample_alphas(self.alphas, image_cv), self.ave_colors, self.overlaps
+        )
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        # alphas are mostly 0 and 255, they compress very well
+        np.savez_compressed(
+            buffer, alphas=self.alphas, ave_colors=self.ave_colors, overlaps=self.overlaps
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data)) as npz:
+            return cls(npz["alphas"], npz["ave_colors"], npz["overlaps"])
+
+
+class RecolorEngine:
+    """
+    Recolors one image/mask set into any number of paint colors.
+
+    Shifting a wall to a color is `image + alpha * diff`, so all colors are
+    produced together by a single (pixels x masks) @ (masks x 3 * colors)
+    product per band of pixels. `masks` is either a list of binary masks or
+    precomputed `FeatheredMasks`.
+
+    Like the original per-mask loop, every mask is shifted relative to the
+    image already recolored by the masks before it: where masks overlap, the
+    average under mask i has moved by `sum_j<i overlaps[i, j] * diff_j`.
+    That keeps the diffs linear in the colors, so they are solved up front
+    and overlapping walls are not shifted twice.
+    """
+
+    def __init__(self, image_cv, masks):
+        if not isinstance(masks, FeatheredMasks):
+            masks = FeatheredMasks.from_masks(image_cv, masks)
+        self.image = image_cv
+        self.feathered = masks
+
+    def recolor(self, colors_rgb):
+        """Returns one uint8 BGR image per RGB color in `colors_rgb`."""
+        num_colors = len(colors_rgb)
+        if num_colors == 0:
+            return []
+        height, width = self.image.shape[:2]
+        num_masks = len(self.feathered)
+        if num_masks == 0:
+            # no walls found, nothing to recolor
+            return [self.image.copy() for _ in range(num_colors)]
+
+        desired_colors = np.asarray(
+            [color_rgb[::-1] for color_rgb in colors_rgb], dtype=np.float64
+        )
+        # (masks, colors, 3) per-mask color shift, truncated to whole values
+        # like the int16 shift image of the per-color recolor. Each mask
+        # starts from its average after the masks before it were recolored
+        overlaps = self.feathered.overlaps
+        diffs = desired_colors[None, :, :] - self.feathered.ave_colors[:, None, :]
+        for i in range(num_masks):
+            if i > 0:
+                diffs[i] -= np.tensordot(overlaps[i, :i], diffs[:i], axes=1)
+            diffs[i] = np.trunc(diffs[i])
+        # fold the alpha scale into the shifts
+        scaled_diffs = diffs.reshape(num_masks, num_colors * 3).astype(np.float32) / 255
+
+        pixels = self.image.reshape(-1, 3)
+        alphas = self.feathered.alphas.reshape(-1, num_masks)
+        results = np.empty((num_colors, height * width, 3), dtype=np.uint8)
+        for start in range(0, height * width, PIXEL_BAND_SIZE):
+            end = min(start + PIXEL_BAND_SIZE, height * width)
+            band = alphas[start:end].astype(np.float32)
+            shift = (band @ scaled_diffs).reshape(-1, num_colors, 3)
+            shift += pixels[start:end, None, :]
+            np.clip(shift, 0, 255, out=shift)
+            results[:, start:end] = shift.transpose(1, 0, 2)
+
+        # where masks overlap the loop clipped between masks, redo those few
+        # pixels mask by mask
+        overlapping = self.feathered.overlapping_pixels
+        if len(overlapping):
+            shifted = np.repeat(
+                pixels[overlapping, None, :].astype(np.float32), num_colors, axis=1
+            )
+            for i in range(num_masks):
+                mask_alpha = alphas[overlapping, i, None, None].astype(np.float32) / 255
+                shifted += mask_alpha * diffs[i].astype(np.float32)
+                np.clip(shifted, 0, 255, out=shifted)
+                np.trunc(shifted, out=shifted)
+            results[:, overlapping] = shifted.transpose(1, 0, 2)
+
+        return list(results.reshape(num_colors, height, width, 3))
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+
+# guided filter window radius, in working resolution pixels, and regularization.
+# A larger eps makes the upsampled alpha smoother and less edge-following
+GUIDE_RADIUS = 2
+GUIDE_EPS = 1e-3
+
+
+def working_size(shape, max_megapixels):
+    """
+    (width, height) of an image of `shape` scaled down to at most
+    `max_megapixels`, keeping the aspect ratio. Smaller images and a
+    `max_megapixels` of None or 0 keep their size.
+    """
+    height, width = shape[:2]
+    max_pixels = (max_megapixels or 0) * 1e6
+    if not max_pixels or height * width <= max_pixels:
+        return width, height
+    scale = (max_pixels / (height * width)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def resize_image(image_cv, size):
+    """Resizes `image_cv` to `size` (width, height), a no-op if it already is."""
+    if (image_cv.shape[1], image_cv.shape[0]) == tuple(size):
+        return image_cv
+    # area interpolation averages when shrinking instead of aliasing
+    if size[0] * size[1] < image_cv.shape[0] * image_cv.shape[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return cv2.resize(image_cv, tuple(size), interpolation=interpolation)
+
+
+def _box(image):
+    size = 2 * GUIDE_RADIUS + 1
+    return cv2.boxFilter(image, -1, (size, size), borderType=cv2.BORDER_REFLECT)
+
+
+def upsample_alphas(alphas, guide_cv):
+    """
+    Upsamples (height, width, masks) uint8 alphas to the resolution of the
+    BGR image `guide_cv` with a fast guided filter.
+
+    A local linear model `alpha = a * luma + b` is fitted at the alpha
+    resolution, its coefficients are upsampled (they vary slowly) and then
+    applied to the full resolution luma, so alpha edges snap to the edges
+    of the image instead of being smeared by plain interpolation.
+    """
+    height, width = guide_cv.shape[:2]
+    low_height, low_width, num_masks = alphas.shape
+    if (low_height, low_width) == (height, width):
+        return alphas
+    result = np.empty((height, width, num_masks), dtype=np.uint8)
+    if num_masks == 0:
+        return result
+
+    luma = cv2.cvtColor(guide_cv, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255
+    low_luma = cv2.resize(luma, (low_width, low_height), interpolation=cv2.INTER_AREA)
+    mean_luma = _box(low_luma)
+    var_luma = _box(low_luma * low_luma) - mean_luma * mean_luma
+
+    for i in range(num_masks):
+        alpha = alphas[:, :, i].astype(np.float32) / 255
+        mean_alpha = _box(alpha)
+        cov = _box(low_luma * alpha) - mean_luma * mean_alpha
+        a = cov / (var_luma + GUIDE_EPS)
+        b = mean_alpha - a * mean_luma
+        a = cv2.resize(_box(a), (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(_box(b), (width, height), interpolation=cv2.INTER_LINEAR)
+        upsampled = a * luma
+        upsampled += b
+        upsampled *= 255
+        np.clip(upsampled, 0, 255, out=upsampled)
+        result[:, :, i] = np.rint(upsampled)
+    return result
@@ -6,21 +6,27 @@ import numpy as np
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "segment_anything"))
 from segment_anything import sam_model_registry, SamPredictor
+from checkpoint_utils import mmap_checkpoint_path, build_from_mmap
 
 
 class SAM:
-    def __init__(self, model_file, model_type, device):
+    def __init__(self, model_file, model_type, device, embedding_cache=None):
         self.model_file = model_file
         self.model_type = model_type
         self.device = device
+        self.embedding_cache = embedding_cache
         self.sam_model = self._load_sam_model()
 
     def _load_sam_model(self):
-        return SamPredictor(
-            sam_model_registry[self.model_type](checkpoint=self.model_file).to(
-                device=self.device
+        mmap_file = mmap_checkpoint_path(self.model_file)
+        if os.path.exists(mmap_file):
+            # converted checkpoint, map the weights straight into the model
+            sam, _ = build_from_mmap(
+                lambda: sam_model_registry[self.model_type](checkpoint=None), mmap_file
             )
-        )
+        else:
+            sam = sam_model_registry[self.model_type](checkpoint=self.model_file)
+        return SamPredictor(sam.to(device=self.device))
 
     def apply_mask_to_image(self, image_pil, masks):
         image = copy.deepcopy(image_pil)
@@ -42,14 +48,78 @@ class SAM:
 
         return image
 
-    def run_inference(self, image_pil, pred_dict):
-        size = image_pil.size
-        H, W = size[1], size[0]
+    def _restore_embedding(self, features, original_size, input_size):
+        # restore the state set_torch_image would have produced
+        self.sam_model.reset_image()
+        self.sam_model.original_size = tuple(original_size)
+        self.sam_model.input_size = tuple(input_size)
+        self.sam_model.features = features.to(self.device)
+        # the vanilla SAM mask decoder does not use intermediate embeddings
+        self.sam_model.interm_features = None
+        self.sam_model.is_image_set = True
+
+    def _get_cached_embedding(self, sam_image, image_hash):
+        if self.embedding_cache is None or image_hash is None:
+            return None
+        cached = self.embedding_cache.get(image_hash)
+        if cached is None or tuple(cached[1]) != tuple(sam_image.shape[:2]):
+            return None
+        return cached
+
+    def _cache_embedding(self, image_hash, features, original_size, input_size):
+        if self.embedding_cache is None or image_hash is None:
+            return
+        self.embedding_cache.put(
+            image_hash, features.cpu().numpy(), original_size, input_size
+        )
 
-        boxes_filt = copy.deepcopy(pred_dict["boxes"])
+    def set_image(self, sam_image, image_hash=None):
+        cached = self._get_cached_embedding(sam_image, image_hash)
+        if cached is not None:
+            features, original_size, input_size = cached
+            self._restore_embedding(
+                torch.from_numpy(np.array(features)), original_size, input_size
+            )
+            print(f"Reusing cached SAM embedding for {image_hash}")
+            return
 
-        sam_image = np.array(image_pil)
         self.sam_model.set_image(sam_image)
+        self._cache_embedding(
+            image_hash,
+            self.sam_model.features,
+            self.sam_model.original_size,
+            self.sam_model.input_size,
+        )
+
+    @torch.no_grad()
+    def _encode_batch(self, sam_images):
+        """
+        Runs the image encoder once for a batch of HWC uint8 RGB images and
+        returns a list of (features, original_size, input_size) per image.
+        """
+        input_images = []
+        sizes = []
+        for sam_image in sam_images:
+            input_image = self.sam_model.transform.apply_image(sam_image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[
+                None, :, :, :
+            ]
+            # preprocess pads every image to the same square encoder input
+            input_images.append(self.sam_model.model.preprocess(input_image_torch))
+            sizes.append((sam_image.shape[:2], tuple(input_image_torch.shape[-2:])))
+
+        features, _ = self.sam_model.model.image_encoder(torch.cat(input_images))
+
+        return [
+            (features[i : i + 1], original_size, input_size)
+            for i, (original_size, input_size) in enumerate(sizes)
+        ]
+
+    def _predict_masks(self, sam_image, pred_dict):
+        H, W = sam_image.shape[:2]
+
+        boxes_filt = copy.deepcopy(pred_dict["boxes"])
 
         for i in range(boxes_filt.size(0)):
             boxes_filt[i] = boxes_filt[i] * torch.Tensor([W, H, W, H])
@@ -72,3 +142,50 @@ class SAM:
         masks = np.squeeze(masks, axis=1)
 
         return masks
+
+    def run_inference(self, image_pil, pred_dict, image_hash=None):
+        sam_image = np.array(image_pil)
+        self.set_image(sam_image, image_hash)
+
+        return self._predict_masks(sam_image, pred_dict)
+
+    def run_inference_batch(
+        self, images_pil, pred_dicts, image_hashes=None, batch_size=2
+    ):
+        """
+        Segments several images, running the ViT image encoder over
+        micro-batches of `batch_size` images instead of one image at a time.
+        Images with a cached embedding skip the encoder entirely.
+        """
+        if image_hashes is None:
+            image_hashes = [None] * len(images_pil)
+        sam_images = [np.array(image_pil) for image_pil in images_pil]
+
+        embeddings = [None] * len(sam_images)
+        to_encode = []
+        for i, (sam_image, image_hash) in enumerate(zip(sam_images, image_hashes)):
+            cached = self._get_cached_embedding(sam_image, image_hash)
+            if cached is not None:
+                features, original_size, input_size = cached
+                embeddings[i] = (
+                    torch.from_numpy(np.array(features)),
+                    original_size,
+                    input_size,
+                )
+            else:
+                to_encode.append(i)
+
+        for start in range(0, len(to_encode), batch_size):
+            indices = to_encode[start : start + batch_size]
+            encoded = self._encode_batch([sam_images[i] for i in indices])
+            for i, embedding in zip(indices, encoded):
+                embeddings[i] = embedding
+                self._cache_embedding(image_hashes[i], *embedding)
+
+        all_masks = []
+        for sam_image, pred_dict, embedding in zip(sam_images, pred_dicts, embeddings):
+            self._restore_embedding(*embedding)
+            all_masks.append(self._predict_masks(sam_image, pred_dict))
+        self.sam_model.reset_image()
+
+        return all_masks
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark for mask bucketing: the original per-mask greedy loop versus
+the vectorized mask_buckets.create_buckets. Also checks that both produce
+the same buckets.
+
+Run from the image_pipeline directory:
+    python tests/benchmark_buckets.py
+"""
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from color_helper import calc_delta_CIEDE2000
+from mask_buckets import create_buckets
+
+MAX_DELTA = 30
+NUM_MASKS = 24
+REPEATS = 3
+
+
+def create_buckets_loop(image_cv, masks):
+    # original implementation from DinoSAMSingleton.create_buckets
+    buckets = {}
+
+    image_lab = cv2.cvtColor(image_cv, cv2.COLOR_BGR2LAB)
+
+    for i in range(len(masks)):
+        mask = (masks[i].astype(np.uint8) * 255).astype(np.uint8)
+        ave_color = cv2.mean(image_lab, mask=mask)[:3]
+
+        if not buckets:
+            buckets[len(buckets) + 1] = {"avg": list(ave_color), "masks": [i]}
+        else:
+            smallest_delta = float("inf")
+            best_bucket = -1
+
+            for key in buckets.keys():
+                ave_bucket_color = buckets[key]["avg"]
+                distance = calc_delta_CIEDE2000(ave_bucket_color, ave_color)
+                if distance < smallest_delta:
+                    smallest_delta = distance
+                    best_bucket = key
+
+            if best_bucket != -1:
+                if smallest_delta > MAX_DELTA:
+                    buckets[len(buckets) + 1] = {
+                        "avg": list(ave_color),
+                        "masks": [i],
+                    }
+                else:
+                    buckets[key]["avg"] = np.mean(
+                        np.array([buckets[key]["avg"], ave_color]), axis=0
+                    ).tolist()
+                    buckets[key]["masks"].append(i)
+    return buckets
+
+
+def make_test_case(height, width, num_masks, seed=0):
+    rng = np.random.default_rng(seed)
+    # a handful of flat "walls" with some noise, so that masks covering the
+    # same wall end up sharing a bucket
+    wall_colors = rng.integers(0, 256, (6, 3))
+    wall_width = width // len(wall_colors)
+    image = np.zeros((height, width, 3), dtype=np.int16)
+    for i, color in enumerate(wall_colors):
+        image[:, i * wall_width : (i + 1) * wall_width] = color
+    image += rng.integers(-10, 11, image.shape, dtype=np.int16)
+    image = image.clip(0, 255).astype(np.uint8)
+
+    masks = np.zeros((num_masks, height, width), dtype=bool)
+    for i in range(num_masks):
+        wall = rng.integers(0, len(wall_colors))
+        x0 = wall * wall_width + rng.integers(0, wall_width // 4)
+        x1 = (wall + 1) * wall_width - rng.integers(0, wall_width // 4)
+        y0 = rng.integers(0, height // 4)
+        y1 = height - rng.integers(0, height // 4)
+        masks[i, y0:y1, x0:x1] = True
+    return image, masks
+
+
+def time_it(fn, *args):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    for height, width in ((768, 1024), (3024, 4032)):
+        image, masks = make_test_case(height, width, NUM_MASKS)
+
+        loop_time, expected = time_it(create_buckets_loop, image, masks)
+        vector_time, actual = time_it(create_buckets, image, masks, MAX_DELTA)
+
+        assert [b["masks"] for b in expected.values()] == [
+            b["masks"] for b in actual.values()
+        ], "bucket assignment differs"
+        for key in expected:
+            assert np.allclose(expected[key]["avg"], actual[key]["avg"], atol=1e-9)
+
+        print(
+            f"{width}x{height}, {NUM_MASKS} masks, {len(actual)} buckets: "
+            f"loop {loop_time * 1000:.1f} ms, vectorized {vector_time * 1000:.1f} ms "
+            f"({loop_time / vector_time:.1f}x)"
+        )
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark for recoloring: the original per-color, per-mask loop versus
+recolor_engine.RecolorEngine producing all colors in one pass. Also reports
+how far the two outputs are apart, for separated walls and for walls whose
+masks overlap.
+
+Run from the image_pipeline directory:
+    python tests/benchmark_recolor.py
+"""
+
+import copy
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import skimage.exposure
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from recolor_engine import RecolorEngine
+
+NUM_COLORS = 5
+REPEATS = 3
+
+
+def recolor_loop(image_cv, color_rgb, masks):
+    # original implementation from DinoSAMSingleton.recolor
+    image = copy.deepcopy(image_cv).astype(np.int16)
+    color_bgr = color_rgb[::-1]
+    desired_color = np.asarray(color_bgr, dtype=np.float64)
+
+    for wallmask in masks:
+        mask = (wallmask.astype(np.uint8) * 255).astype(np.uint8)
+        ave_color = cv2.mean(image, mask=mask)[:3]
+        diff_color = desired_color - ave_color
+        diff_color = np.full_like(image, diff_color, dtype=np.int16)
+        new_image = cv2.add(image, diff_color)
+        mask = cv2.GaussianBlur(
+            mask, (0, 0), sigmaX=3, sigmaY=3, borderType=cv2.BORDER_DEFAULT
+        )
+        mask = skimage.exposure.rescale_intensity(
+            mask, in_range=(100, 150), out_range=(0, 1)
+        ).astype(np.float32)
+        mask = cv2.merge([mask, mask, mask])
+        result = image * (1 - mask) + new_image * mask
+        result = result.clip(0, 255).astype(np.int16)
+        image = result
+
+    return image
+
+
+def recolor_all_loop(image_cv, colors, masks):
+    return [recolor_loop(image_cv, color, masks) for color in colors]
+
+
+def recolor_all_engine(image_cv, colors, masks):
+    return RecolorEngine(image_cv, masks).recolor(colors)
+
+
+def make_test_case(height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    # three separated walls with some noise, like the merged bucket masks
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    masks = np.zeros((3, height, width), dtype=bool)
+    wall_width = width // 3
+    for i in range(3):
+        x0 = i * wall_width + 16
+        x1 = (i + 1) * wall_width - 16
+        masks[i, 16 : height - 16, x0:x1] = True
+        image[masks[i]] = rng.integers(0, 256, 3)
+    noise = rng.integers(-10, 11, image.shape, dtype=np.int16)
+    image = (image + noise).clip(0, 255).astype(np.uint8)
+    colors = rng.integers(0, 256, (NUM_COLORS, 3)).tolist()
+    return image, colors, masks
+
+
+def make_overlapping_case(height, width, seed=0):
+    # like make_test_case, but the second and third walls' masks also cover
+    # the right half of the wall before them, as the merged masks of
+    # overlapping DINO boxes do
+    image, colors, masks = make_test_case(height, width, seed)
+    wall_width = width // 3
+    for i in range(1, 3):
+        x0 = (i - 1) * wall_width + wall_width // 2
+        x1 = i * wall_width - 16
+        masks[i, 16 : height - 16, x0:x1] = True
+    return image, colors, masks
+
+
+def time_it(fn, *args):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    # the loop truncates after every mask, so overlapping masks may round
+    # one more level apart
+    cases = [
+        (make_test_case, 768, 1024, 1),
+        (make_test_case, 1536, 2048, 1),
+        (make_overlapping_case, 768, 1024, 2),
+    ]
+    for make_case, height, width, max_allowed in cases:
+        image, colors, masks = make_case(height, width)
+
+        loop_time, expected = time_it(recolor_all_loop, image, colors, masks)
+        engine_time, actual = time_it(recolor_all_engine, image, colors, masks)
+
+        max_error = max(
+            np.abs(e.astype(np.int16) - a.astype(np.int16)).max()
+            for e, a in zip(expected, actual)
+        )
+        assert max_error <= max_allowed, f"recolored images differ by {max_error}"
+
+        print(
+            f"{make_case.__name__} {width}x{height}, {len(masks)} masks, {NUM_COLORS} colors: "
+            f"loop {loop_time * 1000:.1f} ms, engine {engine_time * 1000:.1f} ms "
+            f"({loop_time / engine_time:.1f}x), max difference {max_error}"
+        )
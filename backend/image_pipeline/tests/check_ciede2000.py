@@ -0,0 +1,55 @@
+"""
+Checks that color_helper.calc_delta_CIEDE2000_matrix matches the scalar
+calc_delta_CIEDE2000 on a randomized corpus of Lab colors, including the
+neutral (a = b = 0) and hue wrap-around edge cases.
+
+Run from the image_pipeline directory:
+    python tests/check_ciede2000.py
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from color_helper import calc_delta_CIEDE2000, calc_delta_CIEDE2000_matrix
+
+TOLERANCE = 1e-9
+
+
+def random_labs(rng, count):
+    labs = rng.uniform([0, -128, -128], [100, 128, 128], (count, 3))
+    # neutral colors and colors right around the hue discontinuities
+    edge_cases = np.array(
+        [
+            [50, 0, 0],
+            [0, 0, 0],
+            [100, 0, 0],
+            [50, 0, 10],
+            [50, 0, -10],
+            [50, 10, 0],
+            [50, -10, 0],
+            [50, -10, 1e-12],
+            [50, -10, -1e-12],
+            [50, 10, -1e-12],
+        ]
+    )
+    return np.concatenate([labs, edge_cases])
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(446)
+    labs_1 = random_labs(rng, 400)
+    labs_2 = np.concatenate([labs_1[:100], random_labs(rng, 200)])
+
+    expected = np.array(
+        [[calc_delta_CIEDE2000(lab_1, lab_2) for lab_2 in labs_2] for lab_1 in labs_1]
+    )
+    actual = calc_delta_CIEDE2000_matrix(labs_1, labs_2)
+
+    error = np.abs(actual - expected).max()
+    print(f"{expected.size} pairs, max abs error {error:.3e}")
+    assert actual.shape == expected.shape
+    assert error < TOLERANCE, f"max error {error} exceeds {TOLERANCE}"
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+
+cur_path = os.path.join(os.path.dirname(__file__))
+sys.path.append(cur_path)
+
+from recolor_engine import FeatheredMasks, RecolorEngine
+from resolution import resize_image, working_size
+
+
+class WallRecolorer:
+    """
+    The part of the pipeline that doesn't need the models: feathering wall
+    masks and recoloring images with them, following a resolution policy.
+
+    Detection, segmentation and feathering run on the image downscaled to
+    at most `max_megapixels` (None or 0 for no limit), so masks are stored
+    at that working size. Recolored images are produced at full resolution
+    with the alphas upsampled along the image edges when
+    `full_resolution_output` is set, otherwise at the working size.
+    """
+
+    def __init__(self, max_megapixels, full_resolution_output):
+        self.max_megapixels = max_megapixels
+        self.full_resolution_output = full_resolution_output
+
+    def working_image(self, image_cv):
+        return resize_image(image_cv, working_size(image_cv.shape, self.max_megapixels))
+
+    def image_for_masks(self, image_cv, masks):
+        # masks are at the working size, or at full size for images
+        # segmented before there was one
+        if len(masks) == 0:
+            return self.working_image(image_cv)
+        height, width = np.shape(masks[0])
+        return resize_image(image_cv, (width, height))
+
+    def feather_masks(self, image_cv, masks):
+        return FeatheredMasks.from_masks(self.image_for_masks(image_cv, masks), masks)
+
+    def output_size(self, image_cv, masks):
+        """(width, height) `recolor_many` produces for `image_cv` and `FeatheredMasks`."""
+        if self.full_resolution_output:
+            return image_cv.shape[1], image_cv.shape[0]
+        return masks.size
+
+    def output_masks(self, image_cv, masks):
+        """
+        Returns the `FeatheredMasks` at the output size, upsampled if they are
+        smaller. That costs more than the recolor itself, so callers
+        recoloring an image again and again should keep the result.
+        """
+        if self.output_size(image_cv, masks) != masks.size:
+            return masks.upsampled(image_cv)
+        return masks
+
+    def recolor_many(self, image_cv, colors, masks):
+        """
+        Recolors the masked walls of `image_cv` into every RGB color in
+        `colors`. `masks` are binary masks or `FeatheredMasks`; the feathering
+        and average wall colors are shared by all colors, see `RecolorEngine`.
+        The output resolution follows the resolution policy.
+        """
+        if not isinstance(masks, FeatheredMasks):
+            masks = self.feather_masks(image_cv, masks)
+        masks = self.output_masks(image_cv, masks)
+        return RecolorEngine(resize_image(image_cv, masks.size), masks).recolor(colors)
+
+    def recolor(self, image_cv, color_rgb, masks):
+        return self.recolor_many(image_cv, [color_rgb], masks)[0]
@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import OrderedDict
+
+from image_pipeline.dino_sam_singleton import FeatheredMasks
+
+
+class AlphaMaskCache:
+    """
+    Local two level cache for the feathered masks of raw images, keyed by
+    user id and raw image hash.
+
+    Recently recolored images keep their `FeatheredMasks` in memory with LRU
+    eviction. Every entry is also written to `cache_dir` in its serialized
+    form so a repeat recolor after an eviction or restart reads a local file
+    instead of downloading and re-feathering the stored masks.
+
+    Masks upsampled to an output size are cached next to the stored ones
+    under that (width, height) `size`, so they are only upsampled once.
+    """
+
+    def __init__(self, cache_dir, max_memory_entries=16, max_disk_entries=1024):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _key(uid, raw_image_hash, size):
+        if size is None:
+            return uid, raw_image_hash
+        return uid, raw_image_hash, f"{size[0]}x{size[1]}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{'-'.join(key)}.npz")
+
+    def get(self, uid, raw_image_hash, size=None):
+        key = self._key(uid, raw_image_hash, size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = FeatheredMasks.from_bytes(f.read())
+            # touch the entry so disk eviction follows last use
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Discarding unreadable alpha mask cache entry {path}: {e}")
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, uid, raw_image_hash, feathered_masks, data=None, size=None):
+        """`data` is the serialized form of `feathered_masks` if already known."""
+        key = self._key(uid, raw_image_hash, size)
+        self._remember(key, feathered_masks)
+        if data is None:
+            data = feathered_masks.to_bytes()
+
+        path = self._path(key)
+        # write to a temp file first so concurrent readers never see partial data
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not persist alpha masks for {raw_image_hash}: {e}")
+            return
+        self._evict_disk()
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def _evict_disk(self):
+        try:
+            files = [
+                os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith(".npz")
+            ]
+        except OSError:
+            return
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=self._mtime)
+        for path in files[: len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
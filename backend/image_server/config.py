@@ -2,4 +2,38 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     firebase_storage_bucket_url: str
+    # inference scheduler
+    inference_queue_size: int = 32
+    inference_max_batch_size: int = 4
+    inference_max_wait_ms: int = 50
+    # number of forked model processes, 1 runs in-process
+    inference_pool_size: int = 1
+    # recolors run on their own thread pool and queue, next to segmentation
+    recolor_workers: int = 4
+    recolor_queue_size: int = 64
+    # recolored images are encoded on their own threads as jpeg,
+    # progressive_jpeg or webp, and at most max_in_flight_uploads of them
+    # are uploaded at once
+    output_format: str = "jpeg"
+    output_quality: int = 95
+    encode_workers: int = 4
+    max_in_flight_uploads: int = 16
+    # resolution of the dummy image used to warm up the models
+    warmup_width: int = 1600
+    warmup_height: int = 1200
+    # segmentation runs on uploads downscaled to this many megapixels (0 for
+    # no limit); recolored images are upsampled back to the upload's size
+    # unless full_resolution_output is off
+    working_max_megapixels: float = 2.0
+    full_resolution_output: bool = True
+    # local cache of feathered masks for repeat recolors, masks upsampled
+    # for full resolution output are kept as separate entries
+    alpha_cache_dir: str = "image_server/cache/alpha_masks"
+    alpha_cache_memory_entries: int = 16
+    alpha_cache_disk_entries: int = 1024
+    # local cache of immutable storage objects, shared with the Api when both
+    # run on the same machine
+    blob_cache_dir: str = "cache/blobs"
+    blob_cache_memory_mb: int = 64
+    blob_cache_disk_mb: int = 2048
     model_config = SettingsConfigDict(env_file=".env")
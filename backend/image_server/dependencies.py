@@ -1,11 +1,112 @@
 from functools import lru_cache
+from fastapi import HTTPException
 from image_server.config import Settings
+from image_server.scheduler import InferenceScheduler
+from image_server.recolor_pool import RecolorPool
+from image_server.output_encoder import OutputEncoder
+from image_server.worker_pool import InferenceProcessPool
+from image_server.warmup import ModelWarmup
+from image_server.alpha_cache import AlphaMaskCache
+from image_server.single_flight import SingleFlight
+from image_pipeline.dino_sam_singleton import DinoSAMSingleton
+from image_pipeline.wall_recolorer import WallRecolorer
 from shared.repository.image_repository import ImageRepository
+from shared.repository.blob_cache import BlobCache
 
 
 @lru_cache()
 def getEnv():
     return Settings()
 
+@lru_cache()
+def get_pipeline():
+    env = getEnv()
+    pipeline = DinoSAMSingleton.instance()
+    pipeline.set_resolution_policy(env.working_max_megapixels, env.full_resolution_output)
+    return pipeline
+
+@lru_cache()
+def get_inference_pool():
+    env = getEnv()
+    if env.inference_pool_size <= 1:
+        return None
+    return InferenceProcessPool(
+        env.inference_pool_size,
+        env.working_max_megapixels,
+        env.full_resolution_output,
+        (env.warmup_width, env.warmup_height),
+    )
+
+@lru_cache()
+def get_inference_scheduler():
+    env = getEnv()
+    pool = get_inference_pool()
+    return InferenceScheduler(
+        pool if pool is not None else get_pipeline(),
+        max_queue_size=env.inference_queue_size,
+        max_batch_size=env.inference_max_batch_size,
+        max_wait_ms=env.inference_max_wait_ms,
+        num_workers=max(1, env.inference_pool_size),
+    )
+
+@lru_cache()
+def get_recolor_pool():
+    env = getEnv()
+    # recoloring doesn't need the models, it always runs in this process
+    # without loading them
+    return RecolorPool(
+        WallRecolorer(env.working_max_megapixels, env.full_resolution_output),
+        num_workers=env.recolor_workers,
+        max_queue_size=env.recolor_queue_size,
+    )
+
+@lru_cache()
+def get_output_encoder():
+    env = getEnv()
+    return OutputEncoder(
+        env.output_format,
+        quality=env.output_quality,
+        num_workers=env.encode_workers,
+        max_in_flight_uploads=env.max_in_flight_uploads,
+    )
+
+@lru_cache()
+def get_model_warmup():
+    return ModelWarmup()
+
+@lru_cache()
+def get_alpha_mask_cache():
+    env = getEnv()
+    return AlphaMaskCache(
+        env.alpha_cache_dir,
+        max_memory_entries=env.alpha_cache_memory_entries,
+        max_disk_entries=env.alpha_cache_disk_entries,
+    )
+
+@lru_cache()
+def get_segmentation_flights():
+    return SingleFlight()
+
+def _check_ready():
+    if not get_model_warmup().is_ready():
+        raise HTTPException(status_code=503, detail="Image server is warming up")
+
+def get_ready_inference_scheduler():
+    _check_ready()
+    return get_inference_scheduler()
+
+def get_ready_recolor_pool():
+    _check_ready()
+    return get_recolor_pool()
+
+@lru_cache()
+def get_blob_cache():
+    env = getEnv()
+    return BlobCache(
+        env.blob_cache_dir,
+        max_memory_bytes=env.blob_cache_memory_mb << 20,
+        max_disk_bytes=env.blob_cache_disk_mb << 20,
+    )
+
 def get_image_repository():
-    return ImageRepository()
\ No newline at end of file
+    return ImageRepository(get_blob_cache())
\ No newline at end of file
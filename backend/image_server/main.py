@@ -7,24 +7,62 @@ import sys
 
 sys.path.append(os.path.join(os.sep.join(os.path.dirname(__file__).split(os.sep)[:-1])))
 sys.path.append(os.path.join(os.path.dirname(__file__)))
-from routes import image_processing
-from dependencies import getEnv
-from image_pipeline.dino_sam_singleton import DinoSAMSingleton
+from routes import image_processing, health
+from dependencies import getEnv, get_inference_scheduler, get_inference_pool, get_model_warmup, get_pipeline, get_recolor_pool, get_output_encoder
+from shared.repository.storage_calls import storage_call_middleware
+
+
+def start_pool():
+    # fork the model processes while this is the only thread of the server,
+    # the workers load their models themselves
+    pool = get_inference_pool()
+    if pool is not None:
+        pool.start()
+
+def load_models():
+    # builds the DinoSAMSingleton, unless the pool workers hold the models,
+    # and the scheduler around it
+    get_recolor_pool()
+    get_inference_scheduler().start()
+
+def warmup_inference():
+    env = getEnv()
+    pool = get_inference_pool()
+    if pool is not None:
+        pool.wait_until_warm()
+    else:
+        get_pipeline().warmup(env.warmup_width, env.warmup_height)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_pool()
     env = getEnv()
     cred = credentials.Certificate('./firebase-auth-image-server.json')
 
     firebase_admin.initialize_app(cred, {
         'storageBucket': env.firebase_storage_bucket_url
     })
-    # Initialize Pipeline Models
-    ds_instance = DinoSAMSingleton.instance()
+    # fail on a bad output format at startup rather than on the first request
+    get_output_encoder()
+    # Load and warm up the models in the background, /readyz reports progress
+    warmup = get_model_warmup()
+    warmup.start([
+        ("load_models", load_models),
+        ("warmup_inference", warmup_inference),
+    ])
     yield
+    if warmup.status()["load_models"]["status"] == "done":
+        get_inference_scheduler().stop()
+        get_recolor_pool().stop()
+    pool = get_inference_pool()
+    if pool is not None:
+        pool.stop()
+    get_output_encoder().stop()
     print("good bye")
 
 # initialize fastAPI
 app = FastAPI(lifespan=lifespan)
+app.middleware("http")(storage_call_middleware)
 app.include_router(image_processing.router)
+app.include_router(health.router)
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import PIL.Image
+
+from shared.renditions import make_renditions
+
+# output_format setting -> (OpenCV extension, content type)
+OUTPUT_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "progressive_jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+}
+
+
+class OutputEncoder:
+    """
+    Encodes recolored images, and their renditions, on a pool of threads so
+    the colors of a request are encoded in parallel and off the event loop.
+    OpenCV and Pillow release the GIL while encoding.
+
+    Uploads of the encoded images go through `upload`, which keeps at most
+    `max_in_flight_uploads` of them running at once across all requests.
+    """
+
+    def __init__(self, output_format="jpeg", quality=95, num_workers=4, max_in_flight_uploads=16):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unknown output format {output_format!r}, expected one of {list(OUTPUT_FORMATS)}"
+            )
+        self.extension, self.content_type = OUTPUT_FORMATS[output_format]
+        if output_format == "webp":
+            self._params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if output_format == "progressive_jpeg":
+            self._params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="encode"
+        )
+        self._uploads = asyncio.Semaphore(max_in_flight_uploads)
+
+    def stop(self):
+        self._executor.shutdown(wait=True)
+
+    def _encode(self, image_cv) -> bytes:
+        ok, image_bytes = cv2.imencode(self.extension, image_cv, self._params)
+        if not ok:
+            raise RuntimeError(f"Could not encode image as {self.extension}")
+        return image_bytes.tobytes()
+
+    @staticmethod
+    def _renditions(image_cv) -> dict[int, bytes]:
+        return make_renditions(PIL.Image.fromarray(cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)))
+
+    async def encode(self, image_cv) -> bytes:
+        """Encodes a BGR image in the configured format and quality."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._encode, image_cv)
+
+    async def renditions(self, image_cv) -> dict[int, bytes]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._renditions, image_cv)
+
+    async def upload(self, coro):
+        """Awaits the upload `coro` once fewer than the limit are in flight."""
+        async with self._uploads:
+            return await coro
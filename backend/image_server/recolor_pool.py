@@ -0,0 +1,70 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+
+class RecolorPool:
+    """
+    Runs recolors, and the feathering of stored masks, with a
+    `WallRecolorer` on a pool of CPU threads next to the inference scheduler
+    instead of in its queue, so cheap recolors of already segmented images
+    never wait behind multi-second segmentations. The recolorer holds no
+    models, so none are loaded for it. The heavy numpy and OpenCV parts
+    release the GIL, so the threads run in parallel.
+
+    At most `max_queue_size` jobs wait or run at once, further ones are
+    rejected with a 503 like a full inference queue.
+    """
+
+    def __init__(self, recolorer, num_workers=4, max_queue_size=64):
+        self.recolorer = recolorer
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="recolor"
+        )
+        # only touched from the event loop
+        self._pending = 0
+
+    def stop(self):
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.max_queue_size:
+            raise HTTPException(
+                status_code=503, detail="Image server is busy, try again later"
+            )
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def feather_masks(self, image_cv, masks):
+        return await self._run(self.recolorer.feather_masks, image_cv, masks)
+
+    def _cached_output_masks(self, alpha_cache, uid, raw_image_hash, image_cv, feathered_masks):
+        size = self.recolorer.output_size(image_cv, feathered_masks)
+        if size == feathered_masks.size:
+            return feathered_masks
+        output_masks = alpha_cache.get(uid, raw_image_hash, size)
+        if output_masks is None:
+            output_masks = self.recolorer.output_masks(image_cv, feathered_masks)
+            alpha_cache.put(uid, raw_image_hash, output_masks, size=size)
+        return output_masks
+
+    async def output_masks(self, alpha_cache, uid, raw_image_hash, image_cv, feathered_masks):
+        """
+        Returns the feathered masks of a raw image at the output size. Masks
+        that need upsampling are upsampled once and kept in `alpha_cache`.
+        """
+        return await self._run(
+            self._cached_output_masks, alpha_cache, uid, raw_image_hash, image_cv, feathered_masks
+        )
+
+    async def recolor_many(self, image_cv, colors, feathered_masks):
+        """Returns one recolored BGR image per RGB color in `colors`."""
+        return await self._run(
+            self.recolorer.recolor_many, image_cv, colors, feathered_masks
+        )
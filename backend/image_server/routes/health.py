@@ -0,0 +1,28 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+
+from dependencies import get_model_warmup
+from image_server.warmup import ModelWarmup
+
+
+router = APIRouter(
+    # tags are stricly for metadata (helps with openAPI specifications)
+    tags=["health"],
+)
+
+
+@router.get("/healthz")
+async def health(warmup: Annotated['ModelWarmup', Depends(get_model_warmup)]):
+    # liveness: the process is up, even while the models are still loading
+    return {"status": "ok", "ready": warmup.is_ready(), "stages": warmup.status()}
+
+
+@router.get("/readyz")
+async def ready(warmup: Annotated['ModelWarmup', Depends(get_model_warmup)]):
+    # readiness: only route traffic here once every warm-up stage is done
+    ready = warmup.is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "stages": warmup.status()},
+    )
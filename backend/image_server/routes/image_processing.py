@@ -1,11 +1,13 @@
 import PIL.Image
 import numpy as np
 import cv2
-import asyncio
 import time
+import asyncio
 from typing import Annotated
 from pydantic import BaseModel
-from fastapi import APIRouter, Depends, Header
+from fastapi import APIRouter, Depends, Header, Request, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 import sys 
 import os
 import io
@@ -14,10 +16,17 @@ import PIL
 # print(os.path.join(os.getcwd()))
 sys.path.append(os.path.join(os.getcwd()))
 
-from dependencies import get_image_repository
-from shared.data_classes import Image, GetImageResponse, GetJSONResponse, ColorDTO, RGB, ImageData, GetProcessedResponse, GetMaskResponse
-from image_pipeline.dino_sam_singleton import DinoSAMSingleton
+from dependencies import get_image_repository, get_ready_inference_scheduler, get_ready_recolor_pool, get_alpha_mask_cache, get_segmentation_flights, get_output_encoder
+from shared.data_classes import Image, GetImageResponse, GetJSONResponse, ColorDTO, RGB, ImageData, GetProcessedResponse, GetMaskResponse, SegmentData, GetSegmentResponse
 from shared.repository.image_repository import ImageRepository
+from image_server.scheduler import InferenceScheduler
+from image_server.recolor_pool import RecolorPool
+from image_server.output_encoder import OutputEncoder
+from image_server.alpha_cache import AlphaMaskCache
+from image_server.single_flight import SingleFlight
+from image_pipeline.dino_sam_singleton import FeatheredMasks
+from image_pipeline.mask_codec import pack_masks, unpack_masks
+from shared.payloads import NDJSON_CONTENT_TYPE, decode_payload, accepts_msgpack, accepts_ndjson, msgpack_response
 
 
 router = APIRouter(
@@ -29,87 +38,292 @@ router = APIRouter(
     responses={401: {"description": "Improper image or metadata"}},
 )
 
-   
-pipeline_lock = asyncio.Lock()
 
 
-@router.post("/generate", response_model = list[GetProcessedResponse])
-async def generate_image(image_data: ImageData,  
-                     image_repository: Annotated['ImageRepository',Depends(get_image_repository)]):
-    global pipeline_lock
-    
-    image_response : GetImageResponse = image_repository.get_raw_image_by_hash(image_data.uid, image_data.raw_image_hash, True)
-    if image_response == None:
-        pass
+async def encode_and_upload(image_repository: ImageRepository, encoder: OutputEncoder, image_data: ImageData, color: ColorDTO, image_cv):
+    # the image and its renditions are encoded on the encoder's threads
+    processed_image_hash = f"{image_data.raw_image_hash}-{color.paint_id}"
+
+    image_bytes = await encoder.encode(image_cv)
+    stored_image_hash, is_new_image = await encoder.upload(image_repository.upload_processed_image(
+        image_data.uid, image_data.raw_image_hash, image_bytes, color, content_type=encoder.content_type))
+    # an image stored before already has its renditions
+    if is_new_image:
+        renditions = await encoder.renditions(image_cv)
+        await encoder.upload(image_repository.upload_renditions(image_data.uid, processed_image_hash, renditions))
+    return GetProcessedResponse(uid=image_data.uid, processed_image_hash=stored_image_hash, color=color)
+
+
+def read_payload(model):
+    # the Api sends either JSON or msgpack
+    async def read(request: Request):
+        try:
+            return model(**decode_payload(await request.body(), request.headers.get("content-type")))
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid {model.__name__}: {e}")
+    return read
+
+
+def respond(request: Request, response):
+    if accepts_msgpack(request):
+        return msgpack_response(jsonable_encoder(response))
+    return response
+
+
+async def load_image(image_repository: ImageRepository, uid: str, raw_image_hash: str):
+    """Returns the decoded raw image and its json (empty if there is none yet)."""
+    image_response, image_json_response = await asyncio.gather(
+        image_repository.get_raw_image_by_hash(uid, raw_image_hash, True),
+        image_repository.get_json_by_hash(uid, raw_image_hash),
+    )
+    if image_response is None or image_response.image_data is None:
+        raise HTTPException(status_code=404, detail=f"Could not retrieve image with hash: {raw_image_hash}")
         
     json_data = {}
-    image_json_response : GetJSONResponse = image_repository.get_json_by_hash(image_data.uid, image_data.raw_image_hash)
     if image_json_response:
         json_data = image_json_response.json_data
 
     image_bytes = image_response.image_data.image_bytes
     image_cv = cv2.imdecode(np.frombuffer(image_bytes, dtype="uint8") , cv2.IMREAD_COLOR)
+    return image_cv, json_data
+
+
+def _with_defaults(json_data: dict, uid: str, raw_image_hash: str):
+    # First time processing this image
+    json_data.setdefault("uid", uid)
+    json_data.setdefault("raw_image_hash", raw_image_hash)
+    json_data.setdefault("processed", [])
+    return json_data
+
+
+async def store_masks(image_repository: ImageRepository, alpha_cache: AlphaMaskCache,
+                      uid: str, raw_image_hash: str, feathered_masks: FeatheredMasks, masks=None):
+    """
+    Uploads new (packed) masks and feathered masks and records them in the
+    json. `masks` are the masks of a new segmentation, which is recorded
+    even if it found no walls so the image isn't segmented again.
+    """
+    # all masks go into a single packed file
+    mask_uploads = {}
+    if masks is not None and len(masks) > 0:
+        mask_uploads["packed_masks"] = image_repository.upload_packed_masks(uid, raw_image_hash, pack_masks(masks))
     
-    colored_images = []
-    masks = []
+    if len(feathered_masks) > 0:
+        alpha_bytes = feathered_masks.to_bytes()
+        mask_uploads["alpha_masks"] = image_repository.upload_alpha_masks(uid, raw_image_hash, alpha_bytes)
+        alpha_cache.put(uid, raw_image_hash, feathered_masks, alpha_bytes)
     
-    await pipeline_lock.acquire()
+    json_entries = {}
+    if mask_uploads:
+        json_entries = dict(zip(mask_uploads.keys(), await asyncio.gather(*mask_uploads.values())))
+    if masks is not None:
+        json_entries["segmented"] = True
+    if json_entries:
+        await image_repository.update_json(
+            uid, raw_image_hash,
+            lambda stored: {**_with_defaults(stored, uid, raw_image_hash), **json_entries},
+        )
+
+
+async def load_masks(image_repository: ImageRepository, recolor_pool: RecolorPool, alpha_cache: AlphaMaskCache,
+                     uid: str, raw_image_hash: str, image_cv, json_data: dict):
+    """Returns the feathered masks of a segmented raw image, None if it isn't segmented yet."""
+    # "packed_masks" holds all masks in one file, "masks" lists the per-mask
+    # BMPs of images segmented before that. "segmented" is also set when no
+    # walls were found
+    is_segmented = bool(json_data and (json_data.get("segmented") or json_data.get("packed_masks") or json_data.get("masks")))
+    if not is_segmented:
+        return None
     
-    ds_instance = DinoSAMSingleton.instance()
-        
-    if json_data and json_data["masks"]:
-        mask_responses : list[GetMaskResponse] = image_repository.get_masks_by_hash(image_data.uid, image_data.raw_image_hash, json_data["masks"])
+    # feathered masks are all the recolor needs, try the local cache first
+    feathered_masks = alpha_cache.get(uid, raw_image_hash)
+    if feathered_masks is None and json_data.get("alpha_masks"):
+        alpha_bytes = await image_repository.get_alpha_masks_by_hash(uid, raw_image_hash, json_data["alpha_masks"])
+        if alpha_bytes is not None:
+            feathered_masks = FeatheredMasks.from_bytes(alpha_bytes)
+            alpha_cache.put(uid, raw_image_hash, feathered_masks, alpha_bytes)
+    if feathered_masks is not None:
+        return feathered_masks
+
+    if json_data.get("packed_masks"):
+        packed_masks = await image_repository.get_packed_masks_by_hash(uid, raw_image_hash, json_data["packed_masks"])
+        stored_masks = list(unpack_masks(packed_masks))
+    elif json_data.get("masks"):
+        mask_responses : list[GetMaskResponse] = await image_repository.get_masks_by_hash(uid, raw_image_hash, json_data["masks"])
         
+        stored_masks = []
         for reponse in mask_responses:
             pil_mask = PIL.Image.open(reponse.mask_data)
             mask = np.array(pil_mask)
             mask = (mask > 0).astype(np.uint8)
-            masks.append(mask)
-            
-        for color in image_data.colors:
-            rgb = [color.rgb.r, color.rgb.g, color.rgb.b]
-            recolored_image = ds_instance.recolor(image_cv, rgb, masks)
-            colored_images.append(recolored_image)
+            stored_masks.append(mask)
     else:
-        rgb_colors = [[color.rgb.r, color.rgb.g, color.rgb.b] for color in image_data.colors]
-        masks, colored_images = ds_instance.run_pipeline(image_cv, image_data.raw_image_hash, rgb_colors)
-    
-    if pipeline_lock.locked():
-        pipeline_lock.release()
-    # First time processing this image
-    bmp_buffers = []
-    if not json_data:
-        for i in range(len(masks)):
-            masks[i][masks[i] > 0] = 1
-            masks[i] = (masks[i] * 255).astype(np.uint8)
-            pil_mask = PIL.Image.fromarray(masks[i])
-            masks[i] = pil_mask.convert('1')
-            buffer = io.BytesIO()
-            masks[i].save(buffer, format="BMP")
-            bmp_buffers.append(buffer)
-        
-        mask_hashes = await image_repository.upload_masks(image_data.uid, image_data.raw_image_hash, bmp_buffers)
-        
-        json_data["masks"] = mask_hashes
-        json_data["uid"] = image_data.uid
-        json_data["raw_image_hash"] = image_data.raw_image_hash
-        json_data["processed"] = []
-    
+        # segmented, but there are no walls to recolor
+        return FeatheredMasks.from_masks(image_cv, [])
+
+    # images segmented before feathered masks were stored get them on first recolor
+    feathered_masks = await recolor_pool.feather_masks(image_cv, stored_masks)
+    await store_masks(image_repository, alpha_cache, uid, raw_image_hash, feathered_masks)
+    return feathered_masks
+
+
+async def load_current_masks(image_repository: ImageRepository, recolor_pool: RecolorPool, alpha_cache: AlphaMaskCache,
+                             uid: str, raw_image_hash: str, image_cv, json_data: dict):
+    """
+    `load_masks`, reading the json again if the copy read before says the
+    image isn't segmented: a segmentation may have finished since.
+    """
+    feathered_masks = await load_masks(image_repository, recolor_pool, alpha_cache, uid, raw_image_hash, image_cv, json_data)
+    if feathered_masks is not None:
+        return feathered_masks
+
+    image_json_response = await image_repository.get_json_by_hash(uid, raw_image_hash)
+    if image_json_response is None:
+        return None
+    return await load_masks(image_repository, recolor_pool, alpha_cache, uid, raw_image_hash, image_cv, image_json_response.json_data)
+
+
+async def load_or_segment(image_repository: ImageRepository, scheduler: InferenceScheduler, recolor_pool: RecolorPool,
+                          alpha_cache: AlphaMaskCache, uid: str, raw_image_hash: str, image_cv, json_data: dict):
+    """
+    Returns the feathered masks of a raw image, segmenting it first if it
+    has no stored masks. New masks are uploaded and recorded in its json.
+    """
+    # `json_data` was read before this ran, a segmentation that finished in
+    # between must not run again and replace the stored masks
+    feathered_masks = await load_current_masks(image_repository, recolor_pool, alpha_cache, uid, raw_image_hash, image_cv, json_data)
+    if feathered_masks is not None:
+        return feathered_masks
+
+    # runs on the inference worker thread, micro-batched with other requests
+    masks, feathered_masks = await scheduler.submit(image_cv, raw_image_hash)
+    await store_masks(image_repository, alpha_cache, uid, raw_image_hash, feathered_masks, masks)
+    return feathered_masks
+
+
+async def store_each(image_repository: ImageRepository, encoder: OutputEncoder, image_data: ImageData, colored_images):
+    """
+    Uploads the recolored images with their renditions and records them in
+    the json. Yields `(color index, GetProcessedResponse)` for every color as
+    soon as its image is stored, in the order they finish.
+    """
+    processed_entries = []
     for i in range(len(image_data.colors)):
         color_item = image_data.colors[i]
         rgb = [color_item.rgb.r, color_item.rgb.g, color_item.rgb.b]
-        json_data["processed"].append({
+        processed_entries.append({
             "paint_id" :  color_item.paint_id,
             "rgb" : rgb,
             "timestamp": time.time(),
         }) 
     
-    await image_repository.upload_json(image_data.uid, image_data.raw_image_hash, json_data)
-    response = []
+    def record_processed(stored: dict):
+        # merged into the latest json, a color processed again replaces its entry
+        stored = _with_defaults(stored, image_data.uid, image_data.raw_image_hash)
+        paint_ids = {entry["paint_id"] for entry in processed_entries}
+        stored["processed"] = [entry for entry in stored["processed"] if entry["paint_id"] not in paint_ids]
+        stored["processed"].extend(processed_entries)
+        return stored
+    
+    async def store(i):
+        return i, await encode_and_upload(image_repository, encoder, image_data, image_data.colors[i], colored_images[i])
+    
+    # the metadata, every processed image and their renditions are uploaded
+    # concurrently. The uploads are tasks, so they finish even if the
+    # client stops reading
+    json_update = asyncio.ensure_future(image_repository.update_json(image_data.uid, image_data.raw_image_hash, record_processed))
+    for stored in asyncio.as_completed([store(i) for i in range(len(colored_images))]):
+        yield await stored
+    await json_update
+
+
+async def recolor(recolor_pool: RecolorPool, alpha_cache: AlphaMaskCache, image_data: ImageData, image_cv, feathered_masks: FeatheredMasks):
+    rgb_colors = [[color.rgb.r, color.rgb.g, color.rgb.b] for color in image_data.colors]
+    # full resolution output needs the masks upsampled, which is cached per image
+    feathered_masks = await recolor_pool.output_masks(alpha_cache, image_data.uid, image_data.raw_image_hash, image_cv, feathered_masks)
+    return await recolor_pool.recolor_many(image_cv, rgb_colors, feathered_masks)
+
+
+async def _ndjson_lines(stored):
+    async for _, response in stored:
+        yield response.model_dump_json() + "\n"
+
 
-    for i in range(len(colored_images)):
-        _, image_bytes = cv2.imencode('.jpg', colored_images[i])
-        processed_image_hash = await image_repository.upload_processed_image(image_data.uid, image_data.raw_image_hash, image_bytes.tobytes(), image_data.colors[i])
-        response.append(GetProcessedResponse(uid=image_data.uid, processed_image_hash=processed_image_hash, color=image_data.colors[i]))
+async def respond_processed(request: Request, image_repository: ImageRepository, encoder: OutputEncoder, image_data: ImageData, colored_images):
+    """
+    Stores the recolored images. Clients accepting NDJSON get one line per
+    color as soon as it is stored, everybody else the whole list at the end.
+    """
+    stored = store_each(image_repository, encoder, image_data, colored_images)
+    if accepts_ndjson(request):
+        return StreamingResponse(_ndjson_lines(stored), media_type=NDJSON_CONTENT_TYPE)
     
-    return response
+    response = [None] * len(colored_images)
+    async for i, processed in stored:
+        response[i] = processed
+    return respond(request, response)
+
+
+@router.post("/segment", response_model = GetSegmentResponse)
+async def segment_image(request: Request,
+                     segment_data: Annotated[SegmentData, Depends(read_payload(SegmentData))],
+                     image_repository: Annotated['ImageRepository',Depends(get_image_repository)],
+                     scheduler: Annotated['InferenceScheduler', Depends(get_ready_inference_scheduler)],
+                     recolor_pool: Annotated['RecolorPool', Depends(get_ready_recolor_pool)],
+                     alpha_cache: Annotated['AlphaMaskCache', Depends(get_alpha_mask_cache)],
+                     segmentations: Annotated['SingleFlight', Depends(get_segmentation_flights)]):
+    image_cv, json_data = await load_image(image_repository, segment_data.uid, segment_data.raw_image_hash)
+    
+    # concurrent requests for the same image share one segmentation
+    feathered_masks = await segmentations.do(
+        (segment_data.uid, segment_data.raw_image_hash),
+        lambda: load_or_segment(image_repository, scheduler, recolor_pool, alpha_cache, segment_data.uid, segment_data.raw_image_hash, image_cv, json_data),
+    )
+    response = GetSegmentResponse(uid=segment_data.uid, raw_image_hash=segment_data.raw_image_hash, mask_count=len(feathered_masks))
+    return respond(request, response)
+
+
+@router.post("/recolor", response_model = list[GetProcessedResponse])
+async def recolor_image(request: Request,
+                     image_data: Annotated[ImageData, Depends(read_payload(ImageData))],
+                     image_repository: Annotated['ImageRepository',Depends(get_image_repository)],
+                     recolor_pool: Annotated['RecolorPool', Depends(get_ready_recolor_pool)],
+                     encoder: Annotated['OutputEncoder', Depends(get_output_encoder)],
+                     alpha_cache: Annotated['AlphaMaskCache', Depends(get_alpha_mask_cache)],
+                     segmentations: Annotated['SingleFlight', Depends(get_segmentation_flights)]):
+    image_cv, json_data = await load_image(image_repository, image_data.uid, image_data.raw_image_hash)
+    
+    # the image may be being segmented right now, then wait for its masks
+    feathered_masks = await segmentations.join((image_data.uid, image_data.raw_image_hash))
+    if feathered_masks is None:
+        feathered_masks = await load_current_masks(image_repository, recolor_pool, alpha_cache, image_data.uid, image_data.raw_image_hash, image_cv, json_data)
+    if feathered_masks is None:
+        raise HTTPException(status_code=409, detail=f"Image {image_data.raw_image_hash} is not segmented yet, call /image/segment first")
+    
+    colored_images = await recolor(recolor_pool, alpha_cache, image_data, image_cv, feathered_masks)
+    return await respond_processed(request, image_repository, encoder, image_data, colored_images)
+
+
+@router.post("/generate", response_model = list[GetProcessedResponse])
+async def generate_image(request: Request,
+                     image_data: Annotated[ImageData, Depends(read_payload(ImageData))],
+                     image_repository: Annotated['ImageRepository',Depends(get_image_repository)],
+                     scheduler: Annotated['InferenceScheduler', Depends(get_ready_inference_scheduler)],
+                     recolor_pool: Annotated['RecolorPool', Depends(get_ready_recolor_pool)],
+                     encoder: Annotated['OutputEncoder', Depends(get_output_encoder)],
+                     alpha_cache: Annotated['AlphaMaskCache', Depends(get_alpha_mask_cache)],
+                     segmentations: Annotated['SingleFlight', Depends(get_segmentation_flights)]):
+    # segments the image if needed, then recolors it: /image/segment and /image/recolor in one call
+    image_cv, json_data = await load_image(image_repository, image_data.uid, image_data.raw_image_hash)
+    
+    # concurrent requests for the same image share one segmentation
+    key = (image_data.uid, image_data.raw_image_hash)
+    if segmentations.in_flight(key):
+        print(f"Joining in-flight segmentation of {image_data.raw_image_hash}")
+    feathered_masks = await segmentations.do(
+        key,
+        lambda: load_or_segment(image_repository, scheduler, recolor_pool, alpha_cache, image_data.uid, image_data.raw_image_hash, image_cv, json_data),
+    )
+    
+    colored_images = await recolor(recolor_pool, alpha_cache, image_data, image_cv, feathered_masks)
+    return await respond_processed(request, image_repository, encoder, image_data, colored_images)
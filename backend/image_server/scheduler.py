@@ -0,0 +1,146 @@
+import asyncio
+import queue
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+
+
+@dataclass
+class InferenceJob:
+    image_cv: object
+    raw_image_hash: str
+    loop: asyncio.AbstractEventLoop
+    future: asyncio.Future
+
+
+class InferenceScheduler:
+    """
+    Runs the DINO + SAM pipeline on a dedicated worker thread. Only
+    segmentation goes through here, recolors run on the `RecolorPool`.
+
+    FastAPI handlers `submit` jobs into a bounded queue and await a future.
+    The worker drains the queue into micro-batches of up to `max_batch_size`
+    jobs, waiting at most `max_wait_ms` for a batch to fill, so the event loop
+    keeps serving storage I/O while the models run.
+
+    With `num_workers > 1` several threads drain the queue, which is only
+    useful when `pipeline` dispatches to an `InferenceProcessPool`.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        max_queue_size=32,
+        max_batch_size=4,
+        max_wait_ms=50,
+        num_workers=1,
+    ):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_workers = num_workers
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = []
+
+    def start(self):
+        if self._workers:
+            return
+        for i in range(self.num_workers):
+            worker = threading.Thread(
+                target=self._run, name=f"inference-worker-{i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        if not self._workers:
+            return
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    async def submit(self, image_cv, raw_image_hash):
+        """
+        Queues an image for segmentation and returns
+        `(masks, feathered_masks)` once the worker is done.
+        """
+        loop = asyncio.get_running_loop()
+        job = InferenceJob(
+            image_cv=image_cv,
+            raw_image_hash=raw_image_hash,
+            loop=loop,
+            future=loop.create_future(),
+        )
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise HTTPException(
+                status_code=503, detail="Image server is busy, try again later"
+            )
+        return await job.future
+
+    def _next_batch(self):
+        job = self._queue.get()
+        if job is None:
+            return None
+        batch = [job]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                # finish the current batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run_segment(batch)
+
+    def _run_segment(self, jobs):
+        try:
+            if len(jobs) == 1:
+                job = jobs[0]
+                results = [
+                    self.pipeline.run_pipeline(job.image_cv, job.raw_image_hash, [])
+                ]
+            else:
+                print(f"Running segmentation micro-batch of {len(jobs)} images")
+                results = self.pipeline.run_pipeline_batch(
+                    [job.image_cv for job in jobs],
+                    [job.raw_image_hash for job in jobs],
+                    [[] for _ in jobs],
+                )
+        except Exception as e:
+            for job in jobs:
+                self._resolve(job, exception=e)
+            return
+        for job, (masks, feathered_masks, _) in zip(jobs, results):
+            self._resolve(job, result=(masks, feathered_masks))
+
+    @staticmethod
+    def _resolve(job, result=None, exception=None):
+        def set_future():
+            if job.future.done():
+                # the request was cancelled while waiting
+                return
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+        job.loop.call_soon_threadsafe(set_future)
@@ -0,0 +1,39 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts
+    the work, callers arriving while it runs await the same result (or
+    exception) instead of starting it again. Once it finishes the key is
+    free, so later calls run the work anew.
+
+    The work runs as its own task, so a caller that is cancelled (e.g. its
+    client disconnected) doesn't cancel it for the others.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {}
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    async def do(self, key, fn):
+        """Returns the result of `await fn()`, shared with concurrent calls for `key`."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task)
+
+    async def join(self, key, default=None):
+        """Awaits the call in flight for `key`, returns `default` if there is none."""
+        task = self._calls.get(key)
+        if task is None:
+            return default
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class ModelWarmup:
+    """
+    Runs the image server start-up stages (model loading, dummy inference)
+    on a background thread and records the status and duration of every
+    stage for the health endpoints.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._thread = None
+
+    def start(self, stages):
+        """`stages` is an ordered list of `(name, callable)` pairs."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            for name, _ in stages:
+                self._stages[name] = {"status": "pending", "seconds": None}
+        self._thread = threading.Thread(
+            target=self._run, args=(stages,), name="model-warmup", daemon=True
+        )
+        self._thread.start()
+
+    def _update(self, name, **values):
+        with self._lock:
+            self._stages[name].update(values)
+
+    def _run(self, stages):
+        for name, stage in stages:
+            self._update(name, status="running")
+            start = time.monotonic()
+            try:
+                stage()
+            except Exception as e:
+                print(f"Warm-up stage {name} failed: {e}")
+                self._update(
+                    name,
+                    status="failed",
+                    seconds=time.monotonic() - start,
+                    error=str(e),
+                )
+                return
+            seconds = time.monotonic() - start
+            self._update(name, status="done", seconds=seconds)
+            print(f"Warm-up stage {name} finished in {seconds:.1f} seconds")
+
+    def is_ready(self):
+        with self._lock:
+            return bool(self._stages) and all(
+                stage["status"] == "done" for stage in self._stages.values()
+            )
+
+    def status(self):
+        with self._lock:
+            return {name: dict(stage) for name, stage in self._stages.items()}
@@ -0,0 +1,149 @@
+import gc
+import multiprocessing
+import os
+import threading
+import traceback
+
+import torch
+
+from image_pipeline.checkpoint_utils import mmap_checkpoint_path
+from image_pipeline.dino_sam_singleton import DinoSAMSingleton, SAM_DEVICE, GD_FILENAME, SAM_FILENAME
+
+
+# set in every worker by _init_worker
+_warm_barrier = None
+_init_error = None
+
+
+def _init_worker(num_threads, max_megapixels, full_resolution_output, warmup_size, warm_barrier):
+    global _warm_barrier, _init_error
+    _warm_barrier = warm_barrier
+    # split the cores between the pool processes instead of oversubscribing
+    torch.set_num_threads(num_threads)
+    try:
+        # every worker loads its own models. From converted checkpoints they
+        # are memory-mapped, so the weights share the page cache across processes
+        pipeline = DinoSAMSingleton.instance()
+        pipeline.set_resolution_policy(max_megapixels, full_resolution_output)
+        # warmed up before the worker takes any job, so a replacement for a
+        # crashed worker is warm too
+        pipeline.warmup(*warmup_size)
+    except Exception:
+        # the pool replaces a worker whose initializer raises with a new one
+        # failing the same way, forever. Keep it and report the error instead
+        _init_error = traceback.format_exc()
+        print(f"Inference worker {os.getpid()} failed to start:\n{_init_error}")
+
+
+def _wait_for_workers():
+    """Returns the start-up error of this worker, None if it is warm."""
+    if _init_error is not None:
+        # wake up the workers waiting for this one
+        _warm_barrier.abort()
+        return _init_error
+    # blocks until every worker runs this, so each worker runs it once
+    try:
+        _warm_barrier.wait()
+    except threading.BrokenBarrierError:
+        # another worker failed, it reports the error
+        pass
+    return None
+
+
+def _call_pipeline(method, args):
+    if _init_error is not None:
+        raise RuntimeError(f"Inference worker failed to start:\n{_init_error}")
+    return getattr(DinoSAMSingleton.instance(), method)(*args)
+
+
+class InferenceProcessPool:
+    """
+    Runs the ML part of the pipeline in `pool_size` forked processes. Every
+    worker warms its models up on a `warmup_size` (width, height) image
+    before it takes jobs.
+
+    The pool is forked at start-up before the server starts any threads, as
+    a forked copy of a multi-threaded process can inherit locks that are
+    held by threads that no longer exist. Each worker then loads the models
+    in its initializer from the memory-mapped checkpoints of
+    `checkpoint_utils`, so the read-only weights are shared through the page
+    cache instead of being held once per process. Without converted
+    checkpoints the pool refuses to start.
+    Recoloring does not touch the models and runs on the `RecolorPool`.
+    """
+
+    def __init__(self, pool_size, max_megapixels, full_resolution_output, warmup_size):
+        self.pool_size = pool_size
+        self.max_megapixels = max_megapixels
+        self.full_resolution_output = full_resolution_output
+        self.warmup_size = warmup_size
+        self._pool = None
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if SAM_DEVICE.type != "cpu":
+            raise RuntimeError("The inference process pool only supports CPU models")
+        missing = [
+            path for path in map(mmap_checkpoint_path, (GD_FILENAME, SAM_FILENAME))
+            if not os.path.exists(path)
+        ]
+        if missing:
+            # every worker would read its own full copy of the weights
+            raise RuntimeError(
+                f"The inference process pool needs memory-mapped checkpoints, "
+                f"{', '.join(missing)} not found. Convert them with "
+                f"`python image_pipeline/checkpoint_utils.py` or set inference_pool_size to 1"
+            )
+        num_threads = max(1, (os.cpu_count() or 1) // self.pool_size)
+
+        # move everything allocated so far (the imported modules) out of the
+        # collector's reach so gc passes in the workers don't dirty the
+        # shared pages
+        gc.collect()
+        gc.freeze()
+
+        context = multiprocessing.get_context("fork")
+        self._pool = context.Pool(
+            self.pool_size,
+            initializer=_init_worker,
+            initargs=(
+                num_threads,
+                self.max_megapixels,
+                self.full_resolution_output,
+                self.warmup_size,
+                context.Barrier(self.pool_size),
+            ),
+        )
+        print(f"Started {self.pool_size} inference processes")
+
+    def stop(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        gc.unfreeze()
+
+    def wait_until_warm(self):
+        """
+        Blocks until every worker has loaded and warmed up its models. Raises
+        a RuntimeError if a worker failed to.
+        """
+        # a worker only takes a task after its initializer, and a worker
+        # waiting at the barrier can't take another one
+        errors = self._pool.starmap(_wait_for_workers, [()] * self.pool_size, chunksize=1)
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise RuntimeError(f"An inference worker failed to start:\n{errors[0]}")
+
+    def run_pipeline(self, image_cv, image_name, colors):
+        return self._pool.apply(
+            _call_pipeline, ("run_pipeline", (image_cv, image_name, colors))
+        )
+
+    def run_pipeline_batch(self, images_cv, image_names, colors_per_image):
+        return self._pool.apply(
+            _call_pipeline,
+            ("run_pipeline_batch", (images_cv, image_names, colors_per_image)),
+        )
@@ -43,4 +43,15 @@ class GetMaskResponse(BaseModel):
 class ImageData(BaseModel):
     uid: str
     colors: list[ColorDTO]
-    raw_image_hash: str
\ No newline at end of file
+    raw_image_hash: str
+
+
+class SegmentData(BaseModel):
+    uid: str
+    raw_image_hash: str
+
+
+class GetSegmentResponse(BaseModel):
+    uid: str
+    raw_image_hash: str
+    mask_count: int
\ No newline at end of file
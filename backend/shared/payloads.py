@@ -0,0 +1,42 @@
+import json
+
+import msgpack
+from fastapi import Request, Response
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+# one JSON document per line, for results streamed as they are ready
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+PAYLOAD_CONTENT_TYPES = {"json": JSON_CONTENT_TYPE, "msgpack": MSGPACK_CONTENT_TYPE}
+
+
+def _media_type(content_type: str | None) -> str:
+    return (content_type or JSON_CONTENT_TYPE).split(";")[0].strip().lower()
+
+
+def encode_payload(data, content_type: str) -> bytes:
+    """Serializes plain python data (dicts, lists, str, numbers) as `content_type`."""
+    if _media_type(content_type) == MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(data)
+    return json.dumps(data).encode("utf-8")
+
+
+def decode_payload(body: bytes, content_type: str | None):
+    if _media_type(content_type) == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(body)
+    return json.loads(body)
+
+
+def accepts_msgpack(request: Request) -> bool:
+    return MSGPACK_CONTENT_TYPE in request.headers.get("accept", "")
+
+
+def accepts_ndjson(request: Request) -> bool:
+    return NDJSON_CONTENT_TYPE in request.headers.get("accept", "")
+
+
+def msgpack_response(data) -> Response:
+    return Response(
+        content=encode_payload(data, MSGPACK_CONTENT_TYPE),
+        media_type=MSGPACK_CONTENT_TYPE,
+    )
@@ -0,0 +1,37 @@
+import io
+
+import PIL.Image
+import PIL.ImageOps
+
+# longest side in pixels of the downscaled variants stored for every image
+RENDITION_SIZES = (256, 1024)
+RENDITION_CONTENT_TYPE = "image/webp"
+RENDITION_QUALITY = 80
+
+
+def make_renditions(image: PIL.Image.Image) -> dict[int, bytes]:
+    """
+    Encodes a WebP variant of `image` for every size in `RENDITION_SIZES`.
+    Images smaller than a size are encoded at their own resolution.
+    """
+    image = PIL.ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    renditions = {}
+    # largest first, so every smaller variant is resized from a smaller image
+    for size in sorted(RENDITION_SIZES, reverse=True):
+        image = image.copy()
+        image.thumbnail((size, size), PIL.Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="WEBP", quality=RENDITION_QUALITY)
+        renditions[size] = buffer.getvalue()
+    return renditions
+
+
+def make_renditions_from_bytes(image_bytes: bytes) -> dict[int, bytes]:
+    with PIL.Image.open(io.BytesIO(image_bytes)) as image:
+        # let the JPEG decoder skip detail we throw away anyway
+        largest = max(RENDITION_SIZES)
+        image.draft("RGB", (largest, largest))
+        return make_renditions(image)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# length of the json header that precedes the blob bytes in a cache file
+_HEADER_SIZE = struct.Struct("<I")
+
+
+@dataclass
+class CachedBlob:
+    data: bytes
+    content_type: str | None = None
+    metadata: dict | None = None
+
+
+class BlobCache:
+    """
+    Local read-through cache for immutable storage objects (raw images,
+    processed images and masks), keyed by object path.
+
+    Recently used blobs are kept in memory up to `max_memory_bytes`. Every
+    blob is also written to `cache_dir` together with its content type and
+    custom metadata, up to `max_disk_bytes` with least recently used files
+    evicted first. Several processes can share `cache_dir`: files are written
+    to a temp file and renamed into place, and a file that disappears because
+    another process evicted it is just a miss.
+    """
+
+    def __init__(
+        self, cache_dir, max_memory_bytes=64 << 20, max_disk_bytes=2 << 30
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        # rough running total of the disk usage, rescanned when it overflows
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _file_path(self, path):
+        key = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.blob")
+
+    def get(self, path) -> CachedBlob | None:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                return entry
+
+        file_path = self._file_path(path)
+        try:
+            with open(file_path, "rb") as f:
+                (header_size,) = _HEADER_SIZE.unpack(f.read(_HEADER_SIZE.size))
+                header = json.loads(f.read(header_size).decode("utf-8"))
+                data = f.read()
+            # touch the file so disk eviction follows last use
+            os.utime(file_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Discarding unreadable blob cache entry for {path}: {e}")
+            return None
+        entry = CachedBlob(data, header.get("content_type"), header.get("metadata"))
+        self._remember(path, entry)
+        return entry
+
+    def put(self, path, data, content_type=None, metadata=None):
+        entry = CachedBlob(bytes(data), content_type, metadata)
+        self._remember(path, entry)
+
+        header = json.dumps(
+            {"content_type": content_type, "metadata": metadata}
+        ).encode("utf-8")
+        file_path = self._file_path(path)
+        # write to a temp file first so concurrent readers never see partial data
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER_SIZE.pack(len(header)))
+                f.write(header)
+                f.write(entry.data)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            print(f"Could not cache blob {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._track_disk(_HEADER_SIZE.size + len(header) + len(entry.data))
+
+    def _remember(self, path, entry):
+        size = len(entry.data)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous.data)
+            self._entries[path] = entry
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= len(evicted.data)
+
+    def _track_disk(self, size):
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += size
+            if self._disk_bytes is not None and self._disk_bytes <= self.max_disk_bytes:
+                return
+        # other processes write to the same directory, so the real usage is
+        # only known after a scan
+        disk_bytes = self._evict_disk()
+        with self._lock:
+            self._disk_bytes = disk_bytes
+
+    def _evict_disk(self):
+        files = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for dir_entry in it:
+                    if not dir_entry.name.endswith(".blob"):
+                        continue
+                    try:
+                        stat = dir_entry.stat()
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        except OSError:
+            return None
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, file_path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                # already evicted by another process
+                pass
+            total -= size
+        return total
@@ -1,11 +1,21 @@
+import asyncio
+import functools
+import itertools
 import hashlib
 import io
 import json
+import weakref
 import zipfile
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List
 from firebase_admin import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud.storage import Blob
 from fastapi import UploadFile, HTTPException
+from shared.repository.storage_calls import count_storage_call
+from shared.repository.blob_cache import BlobCache, CachedBlob
+from shared.renditions import RENDITION_CONTENT_TYPE
 from shared.data_classes import (
     RGB,
     GetImageResponse,
@@ -15,18 +25,67 @@ from shared.data_classes import (
     GetMaskResponse,
 )
 
+# the google-cloud-storage client is blocking, every call is offloaded to
+# this pool so a slow request never stalls the event loop. Shared by all
+# repository instances to bound the number of concurrent storage calls
+STORAGE_IO_WORKERS = 16
+# every object is created private, so reads never have to touch the ACL
+PRIVATE_ACL = "private"
+# number of blobs downloaded ahead while streaming a zip
+ZIP_PREFETCH = 4
+# read-modify-write rounds of a metadata json update before giving up
+JSON_UPDATE_ATTEMPTS = 10
+# serializes json updates within this process, so the generation check only
+# has to catch writers in other processes
+_json_update_locks = weakref.WeakValueDictionary()
+_storage_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_IO_WORKERS, thread_name_prefix="storage-io"
+)
+
 
 class ImageRepository:
-    def __init__(self) -> None:
+    def __init__(self, blob_cache: BlobCache | None = None) -> None:
         self.bucket = storage.bucket()
+        # raw images, processed images and masks never change once written,
+        # so reads of those go through the local cache
+        self.blob_cache = blob_cache
         self.base_collection_name = "images"
         self.processed_image_path = "processed"
         self.masks_path = "masks"
+        self.renditions_path = "renditions"
         self.metadata_exception = HTTPException(
             status_code=500, detail="Error encountered: invalid metadata"
         )
 
+    @staticmethod
+    async def _offload(fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _storage_executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    @classmethod
+    async def _run(cls, fn, *args, **kwargs):
+        # each call is a single storage request
+        count_storage_call()
+        return await cls._offload(fn, *args, **kwargs)
+
+    async def _cache_get(self, path: str) -> CachedBlob | None:
+        if self.blob_cache is None:
+            return None
+        return await self._offload(self.blob_cache.get, path)
+
+    def _cache_put(self, path: str, data, content_type=None, metadata=None):
+        if self.blob_cache is None:
+            return
+        # written in the background, callers don't wait for the disk
+        asyncio.get_running_loop().run_in_executor(
+            _storage_executor,
+            functools.partial(self.blob_cache.put, path, data, content_type, metadata),
+        )
+
     async def upload_unprocessed_image(self, uid: str, file: UploadFile):
+        """Returns the image hash and whether the image was new."""
         await file.seek(0)
         content = await file.read()
         image_hash = hashlib.sha256(content).hexdigest()
@@ -35,12 +94,19 @@ class ImageRepository:
         blob = self.bucket.blob(image_path)
 
         # TODO Update History here (Add New entry or update existing one)
-        if blob.exists():
-            return image_hash
-        content_file = io.BytesIO(content)
-        blob.upload_from_file(content_file, content_type=file.content_type)
-        blob.make_private()
-        return image_hash
+        try:
+            # a single request, it fails if the image was uploaded before
+            await self._run(
+                blob.upload_from_string,
+                content,
+                content_type=file.content_type,
+                predefined_acl=PRIVATE_ACL,
+                if_generation_match=0,
+            )
+        except PreconditionFailed:
+            return image_hash, False
+        self._cache_put(image_path, content, file.content_type)
+        return image_hash, True
 
     @staticmethod
     def _create_metadata(upload_request: ColorDTO):
@@ -52,9 +118,8 @@ class ImageRepository:
         }
 
     @staticmethod
-    def _parse_metadata_from_blob(blob: Blob):
-        blob.reload()
-        metadata = blob.metadata
+    def _parse_metadata(metadata: dict | None):
+        # from get_blob, list_blobs or the cache, plain blob() has no metadata
         if metadata is None:
             return None, None, None, None
         r = metadata.get("r", None)
@@ -64,68 +129,137 @@ class ImageRepository:
         return r, g, b, paintId
 
     async def upload_processed_image(
-        self, uid: str, raw_image_hash: str, image_bytes, dto: ColorDTO
+        self, uid: str, raw_image_hash: str, image_bytes, dto: ColorDTO, content_type="image/jpg"
     ):
+        """Returns the processed image hash and whether the image was new."""
         base_path = f"{self.base_collection_name}/{uid}/{raw_image_hash}/{self.processed_image_path}"
         processed_image_hash = f"{raw_image_hash}-{dto.paint_id}"
         image_path = f"{base_path}/{processed_image_hash}"
         blob = self.bucket.blob(image_path)
-        if blob.exists():
-            return processed_image_hash
         blob.metadata = self._create_metadata(dto)
-        blob.upload_from_string(image_bytes, content_type="image/jpg")
-        blob.make_private()
+        try:
+            # only create the object if it doesn't exist yet
+            await self._run(
+                blob.upload_from_string,
+                image_bytes,
+                content_type=content_type,
+                predefined_acl=PRIVATE_ACL,
+                if_generation_match=0,
+            )
+        except PreconditionFailed:
+            return processed_image_hash, False
+        self._cache_put(image_path, image_bytes, content_type, blob.metadata)
 
-        return processed_image_hash
+        return processed_image_hash, True
 
-    async def upload_masks(
-        self, uid: str, raw_image_hash: str, buffers: list[io.BytesIO]
-    ):
-        uploaded_mask_hashes = []
-        for i in range(len(buffers)):
-            base_path = (
-                f"{self.base_collection_name}/{uid}/{raw_image_hash}/{self.masks_path}"
+    async def _upload_masks_file(self, uid: str, raw_image_hash: str, file_name: str, data: bytes):
+        base_path = (
+            f"{self.base_collection_name}/{uid}/{raw_image_hash}/{self.masks_path}"
+        )
+        blob = self.bucket.blob(f"{base_path}/{file_name}")
+        try:
+            # mask files are cached as immutable, so an image keeps the
+            # masks it was first stored with
+            await self._run(
+                blob.upload_from_string,
+                data,
+                content_type="application/octet-stream",
+                predefined_acl=PRIVATE_ACL,
+                if_generation_match=0,
             )
-            file_name = f"{raw_image_hash}-{i}"
-            image_path = f"{base_path}/{file_name}"
+        except PreconditionFailed:
+            return file_name
+        self._cache_put(blob.name, data, "application/octet-stream")
+        return file_name
 
-            buffers[i].seek(0)
-            blob = self.bucket.blob(image_path)
+    async def upload_packed_masks(self, uid: str, raw_image_hash: str, data: bytes):
+        return await self._upload_masks_file(uid, raw_image_hash, f"{raw_image_hash}-masks", data)
 
-            blob.upload_from_file(buffers[i], content_type="image/bmp")
-            blob.make_private()
-            uploaded_mask_hashes.append(file_name)
-
-        return uploaded_mask_hashes
+    async def get_packed_masks_by_hash(
+        self, uid: str, image_hash: str, file_name: str
+    ) -> None | bytes:
+        base_path = f"{self.base_collection_name}/{uid}/{image_hash}/{self.masks_path}"
+        cached = await self._download_cached(f"{base_path}/{file_name}")
+        return cached.data if cached is not None else None
+
+    async def _download_or_none(self, blob: Blob) -> None | bytes:
+        # a single GET, a missing object shows up as NotFound
+        try:
+            return await self._run(blob.download_as_bytes)
+        except NotFound:
+            return None
 
-    @staticmethod
-    def _get_mask_from_blob(blob: Blob):
-        bmp_buffer = io.BytesIO()
-        blob.download_to_file(bmp_buffer)
-        bmp_buffer.seek(0)
+    async def _download_cached(self, path: str, metadata=None) -> None | CachedBlob:
+        """Downloads an immutable object through the local blob cache."""
+        cached = await self._cache_get(path)
+        if cached is not None:
+            return cached
+        blob = self.bucket.blob(path)
+        data = await self._download_or_none(blob)
+        if data is None:
+            return None
+        self._cache_put(path, data, blob.content_type, metadata)
+        return CachedBlob(data, blob.content_type, metadata)
 
-        return bmp_buffer
+    async def _get_mask_by_path(self, image_hash: str, mask_path: str):
+        cached = await self._download_cached(mask_path)
+        buffer = io.BytesIO(cached.data) if cached is not None else None
+        return GetMaskResponse(image_hash=image_hash, mask_data=buffer)
 
-    def get_masks_by_hash(
+    async def get_masks_by_hash(
         self, uid: str, image_hash: str, mask_hashes: list[str]
     ) -> None | List[GetMaskResponse]:
-        mask_responses = []
+        base_path = f"{self.base_collection_name}/{uid}/{image_hash}/{self.masks_path}"
 
+        # fetch all masks concurrently, gather keeps their order
+        return await asyncio.gather(
+            *[
+                self._get_mask_by_path(image_hash, f"{base_path}/{mask_hash}")
+                for mask_hash in mask_hashes
+            ]
+        )
+
+    async def upload_alpha_masks(self, uid: str, raw_image_hash: str, data: bytes):
+        return await self._upload_masks_file(uid, raw_image_hash, f"{raw_image_hash}-alpha", data)
+
+    async def get_alpha_masks_by_hash(
+        self, uid: str, image_hash: str, file_name: str
+    ) -> None | bytes:
         base_path = f"{self.base_collection_name}/{uid}/{image_hash}/{self.masks_path}"
+        cached = await self._download_cached(f"{base_path}/{file_name}")
+        return cached.data if cached is not None else None
 
-        for i in range(len(mask_hashes)):
-            file_name = f"{mask_hashes[i]}"
-            mask_path = f"{base_path}/{file_name}"
-            blob = self.bucket.blob(mask_path)
-            if not blob.exists():
-                pass
-            buffer = self._get_mask_from_blob(blob)
-            blob.make_private()
+    def _rendition_path(self, uid: str, image_hash: str, size: int):
+        # renditions of the raw image and of every processed image live
+        # next to the raw image
+        raw_hash = image_hash.split("-")[0]
+        return f"{self.base_collection_name}/{uid}/{raw_hash}/{self.renditions_path}/{image_hash}-{size}"
 
-            response = GetMaskResponse(image_hash=image_hash, mask_data=buffer)
-            mask_responses.append(response)
+    async def _upload_rendition(self, path: str, data: bytes):
+        blob = self.bucket.blob(path)
+        await self._run(
+            blob.upload_from_string,
+            data,
+            content_type=RENDITION_CONTENT_TYPE,
+            predefined_acl=PRIVATE_ACL,
+        )
+        self._cache_put(path, data, RENDITION_CONTENT_TYPE)
 
-        return mask_responses
+    async def upload_renditions(
+        self, uid: str, image_hash: str, renditions: dict[int, bytes]
+    ):
+        """`image_hash` is a raw image hash or a processed image hash."""
+        await asyncio.gather(
+            *[
+                self._upload_rendition(self._rendition_path(uid, image_hash, size), data)
+                for size, data in renditions.items()
+            ]
+        )
+
+    async def get_rendition(
+        self, uid: str, image_hash: str, size: int
+    ) -> None | Image:
+        return await self._get_image(self._rendition_path(uid, image_hash, size))
 
     async def upload_json(self, uid: str, raw_image_hash: str, json_dict: dict):
         base_path = f"{self.base_collection_name}/{uid}/{raw_image_hash}"
@@ -135,75 +269,122 @@ class ImageRepository:
         json_str = json.dumps(json_dict)
         blob = self.bucket.blob(image_path)
 
-        blob.upload_from_string(
-            json_str.encode("utf-8"), content_type="application/json"
+        await self._run(
+            blob.upload_from_string,
+            json_str.encode("utf-8"),
+            content_type="application/json",
+            predefined_acl=PRIVATE_ACL,
         )
-        blob.make_private()
         return GetJSONResponse(image_hash=raw_image_hash)
 
-    @staticmethod
-    def _get_json_from_blob(blob: Blob) -> dict:
-        json_string = blob.download_as_string().decode("utf-8")
-        dict_obj = json.loads(json_string)
+    async def update_json(self, uid: str, raw_image_hash: str, update):
+        """
+        Atomically applies `update` (a function from the current json dict,
+        `{}` if there is none yet, to the new one) to the metadata json of
+        a raw image and returns the stored result.
 
-        return dict_obj
+        The upload is conditional on the generation that was read, so when
+        another request or server wrote the json in between, the update is
+        retried on top of its version instead of overwriting it.
+        """
+        base_path = f"{self.base_collection_name}/{uid}/{raw_image_hash}"
+        image_path = f"{base_path}/{raw_image_hash}.json"
+
+        async with _json_update_locks.setdefault(image_path, asyncio.Lock()):
+            return await self._update_json(image_path, raw_image_hash, update)
+
+    async def _update_json(self, image_path: str, raw_image_hash: str, update):
+        for _ in range(JSON_UPDATE_ATTEMPTS):
+            blob = self.bucket.blob(image_path)
+            json_bytes = await self._download_or_none(blob)
+            # the download fills in the generation it read, 0 only matches
+            # if the json still doesn't exist
+            generation = blob.generation if json_bytes is not None else 0
+            json_dict = json.loads(json_bytes.decode("utf-8")) if json_bytes else {}
+            json_dict = update(json_dict)
+            try:
+                await self._run(
+                    blob.upload_from_string,
+                    json.dumps(json_dict).encode("utf-8"),
+                    content_type="application/json",
+                    predefined_acl=PRIVATE_ACL,
+                    if_generation_match=generation,
+                )
+            except PreconditionFailed:
+                print(f"Metadata of {raw_image_hash} changed concurrently, retrying update")
+                continue
+            return json_dict
+        raise HTTPException(
+            status_code=503,
+            detail=f"Could not update metadata of {raw_image_hash}, try again later",
+        )
 
-    def get_json_by_hash(self, uid: str, image_hash: str) -> None | GetJSONResponse:
+    async def get_json_by_hash(
+        self, uid: str, image_hash: str
+    ) -> None | GetJSONResponse:
         base_path = f"{self.base_collection_name}/{uid}/{image_hash}/"
         file_name = f"{image_hash}.json"
         base_path += file_name
-        blob = self.bucket.blob(base_path)
-        if not blob.exists():
+        json_bytes = await self._download_or_none(self.bucket.blob(base_path))
+        if json_bytes is None:
             return None
-        obj = self._get_json_from_blob(blob)
-        blob.make_private()
+        obj = json.loads(json_bytes.decode("utf-8"))
 
         return GetJSONResponse(image_hash=image_hash, json_data=obj)
 
-    @staticmethod
-    def _get_image_from_blob(blob: Blob) -> Image:
-        image_bytes = blob.download_as_bytes()
-
-        return Image(image_bytes=image_bytes, contentType=blob.content_type)
+    async def _get_image(self, path: str, metadata=None) -> None | Image:
+        cached = await self._download_cached(path, metadata)
+        if cached is None:
+            return None
+        # the download response fills in the content type
+        return Image(image_bytes=cached.data, contentType=cached.content_type)
 
-    def get_raw_image_by_hash(
+    async def get_raw_image_by_hash(
         self, uid: str, image_hash: str, download_image: bool = False
     ) -> None | GetImageResponse:
         base_path = f"{self.base_collection_name}/{uid}/{image_hash}/"
         file_name = f"{image_hash}"
         base_path += file_name
-        blob = self.bucket.blob(base_path)
-        if not blob.exists():
-            return None
         if download_image:
-            raw_image = self._get_image_from_blob(blob)
+            raw_image = await self._get_image(base_path)
+            if raw_image is None:
+                return None
         else:
+            cached = await self._cache_get(base_path)
+            if cached is None and await self._run(self.bucket.get_blob, base_path) is None:
+                return None
             raw_image = None
-        blob.make_private()
         return GetImageResponse(
             image_hash=image_hash, rgb=None, paintId=None, image_data=raw_image
         )
 
-    def get_processed_image_by_hash(
+    async def get_processed_image_by_hash(
         self, uid: str, image_hash: str, download_image: bool = False
     ) -> None | GetImageResponse:
         raw_hash = image_hash.split("-")[0]
         path = f"{self.base_collection_name}/{uid}/{raw_hash}/{self.processed_image_path}/{image_hash}"
-        blob = self.bucket.blob(path)
-        if not blob.exists():
-            return None
+        cached = await self._cache_get(path)
+        if cached is not None and cached.metadata is not None:
+            metadata = cached.metadata
+        else:
+            # one metadata GET, returns None if the object doesn't exist
+            blob = await self._run(self.bucket.get_blob, path)
+            if blob is None:
+                return None
+            metadata = blob.metadata
         # If Image exists with no metadata, what do we do? (probably wouldn't even)
         # Get data we can?
         # Cancel the request?
         # Dont return images without metadata?
-        r, g, b, paintId = self._parse_metadata_from_blob(blob)
+        r, g, b, paintId = self._parse_metadata(metadata)
         if not r or not g or not b or not paintId:
             raise self.metadata_exception
         if download_image:
-            raw_image = self._get_image_from_blob(blob)
+            raw_image = await self._get_image(path, metadata)
+            if raw_image is None:
+                return None
         else:
             raw_image = None
-        blob.make_private()
         return GetImageResponse(
             image_hash=image_hash,
             rgb=RGB(r=r, g=g, b=b),
@@ -211,22 +392,22 @@ class ImageRepository:
             image_data=raw_image,
         )
 
-    def check_image_exists_for_id(self, uid: str, image_hash: str, dto: ColorDTO):
+    async def check_image_exists_for_id(self, uid: str, image_hash: str, dto: ColorDTO):
         file_name = f"{image_hash}-{dto.paint_id}"
-        return self.get_processed_image_by_hash(uid, file_name)
+        return await self.get_processed_image_by_hash(uid, file_name)
 
-    def get_all_processed_images(self, uid: str, raw_hash: str):
+    async def get_all_processed_images(self, uid: str, raw_hash: str):
         path = (
             f"{self.base_collection_name}/{uid}/{raw_hash}/{self.processed_image_path}"
         )
-        blobs = self.bucket.list_blobs(prefix=path)
+        blobs = await self._list_blobs(path)
         if not blobs:
             return []
         ret: List[GetImageResponse] = []
         for blob in blobs:
             filename = blob.name.split("/")[-1]
-            r, g, b, paintId = self._parse_metadata_from_blob(blob)
-            blob.make_private()
+            # the list response already carries each object's metadata
+            r, g, b, paintId = self._parse_metadata(blob.metadata)
             ret.append(
                 GetImageResponse(
                     image_hash=filename, rgb=RGB(r=r, g=g, b=b), paintId=paintId
@@ -237,31 +418,82 @@ class ImageRepository:
     def _get_content_type_extension(content_type: str):
         # expect type of type/file_extension
         return content_type.split("/")[-1]
-    def bulk_retrieve_images_from_raw_image_hash(self, uid: str, raw_image_hash: str) -> io.BytesIO | None:
+
+    async def _list_blobs(self, prefix: str) -> List[Blob]:
+        return await self._run(lambda: list(self.bucket.list_blobs(prefix=prefix)))
+
+    async def stream_images_zip_from_raw_image_hash(
+        self, uid: str, raw_image_hash: str
+    ) -> AsyncIterator[bytes] | None:
+        """
+        Returns an async iterator over the bytes of a zip holding the raw image
+        and all of its processed images, or None if the raw image doesn't exist.
+        """
         base_path = f"{self.base_collection_name}/{uid}/{raw_image_hash}"
         file_name = f"{raw_image_hash}"
         raw_image_path = f"{base_path}/{file_name}"
-        raw_image_blob = self.bucket.blob(raw_image_path)
-        if not raw_image_blob.exists():
-            return None
         processed_image_collection_path = f"{base_path}/{self.processed_image_path}"
-        processed_image_blobs = self.bucket.list_blobs(prefix=processed_image_collection_path)
-
-        zip_data = io.BytesIO()
-        with zipfile.ZipFile(zip_data, mode="w", compression=zipfile.ZIP_DEFLATED) as zipf:
-            raw_image_blob.reload()
-            file_type = self._get_content_type_extension(raw_image_blob.content_type)
-            raw_image_content = raw_image_blob.download_as_bytes()
-
-            zipf.writestr(zipfile.ZipInfo(f"{raw_image_hash}.{file_type}"), raw_image_content)
-
-            for processed_blob in processed_image_blobs:
-                processed_blob.reload()
-                file_type = self._get_content_type_extension(processed_blob.content_type)
-                filename = processed_blob.name.split("/")[-1]
-                blob_content = processed_blob.download_as_bytes()
-                zip_info = zipfile.ZipInfo(f"{filename}.{file_type}")
-                zipf.writestr(zip_info, blob_content)
-        
-        zip_data.seek(0)
-        return zip_data
\ No newline at end of file
+        raw_image_blob, processed_image_blobs = await asyncio.gather(
+            self._run(self.bucket.get_blob, raw_image_path),
+            self._list_blobs(processed_image_collection_path),
+        )
+        if raw_image_blob is None:
+            return None
+
+        named_blobs = [(raw_image_hash, raw_image_blob)] + [
+            (blob.name.split("/")[-1], blob) for blob in processed_image_blobs
+        ]
+        return self._stream_zip(named_blobs)
+
+    async def _stream_zip(self, named_blobs):
+        # downloads run at most ZIP_PREFETCH blobs ahead of the entry being
+        # written, so memory stays bounded no matter how many images there are
+        remaining = iter(named_blobs)
+        pending = deque()
+
+        def prefetch():
+            for name, blob in itertools.islice(remaining, ZIP_PREFETCH - len(pending)):
+                download = asyncio.ensure_future(
+                    self._download_cached(blob.name, blob.metadata)
+                )
+                pending.append((name, blob, download))
+
+        writer = _ZipChunkWriter()
+        try:
+            # images are already compressed, so entries are stored as is
+            with zipfile.ZipFile(writer, mode="w", compression=zipfile.ZIP_STORED) as zipf:
+                prefetch()
+                while pending:
+                    name, blob, download = pending.popleft()
+                    cached = await download
+                    prefetch()
+                    if cached is None:
+                        # deleted since it was listed
+                        continue
+                    file_type = self._get_content_type_extension(blob.content_type)
+                    zipf.writestr(zipfile.ZipInfo(f"{name}.{file_type}"), cached.data)
+                    yield writer.pop()
+            # central directory
+            yield writer.pop()
+        finally:
+            for _, _, download in pending:
+                download.cancel()
+
+
+class _ZipChunkWriter:
+    """Write-only file object that hands the bytes zipfile writes back out."""
+
+    def __init__(self) -> None:
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,46 @@
+from contextvars import ContextVar
+
+from fastapi import Request
+
+
+class StorageCallCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+
+# one counter per API request. The counter object is shared with every task
+# the request spawns, so concurrent storage calls are all counted
+_request_counter: ContextVar[StorageCallCounter | None] = ContextVar(
+    "storage_call_counter", default=None
+)
+
+
+def count_storage_call():
+    counter = _request_counter.get()
+    if counter is not None:
+        counter.count += 1
+
+
+async def storage_call_middleware(request: Request, call_next):
+    """
+    Counts the Firebase Storage calls made while handling a request and
+    reports them in the log once the response body has been sent. Streamed
+    responses (zips, NDJSON, SSE) keep calling storage while their body is
+    produced, so the count is only final at the end of the body.
+    """
+    counter = StorageCallCounter()
+    token = _request_counter.set(counter)
+    try:
+        response = await call_next(request)
+    finally:
+        _request_counter.reset(token)
+    response.body_iterator = _report_after_body(request, response.body_iterator, counter)
+    return response
+
+
+async def _report_after_body(request: Request, body_iterator, counter: StorageCallCounter):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        print(f"{request.method} {request.url.path}: {counter.count} storage calls")
@@ -1,10 +1,13 @@
+import asyncio
 from shared.repository.image_repository import ImageRepository
 from fastapi import UploadFile, HTTPException
 from typing import List
 from shared.data_classes import ColorDTO, ImageData, GetProcessedResponse, RGB
 from Api.data_classes import ImageRequestListResponse
 from Api.client.image_server_client import ImageServerClient
-from shared.data_classes import GetImageResponse, GetProcessedResponse, ColorDTO
+from Api.job_store import JobStore
+from shared.data_classes import GetImageResponse, GetProcessedResponse, ColorDTO, Image
+from shared.renditions import RENDITION_CONTENT_TYPE, make_renditions_from_bytes
 
 
 class ImageService:
@@ -14,9 +17,14 @@ class ImageService:
         self.repository = repository
         self.client = image_server_client
 
-    async def upload_and_process_image(
+    async def _upload_and_check_colors(
         self, uid: str, file: UploadFile, colors: List[ColorDTO]
     ):
+        """
+        Stores the raw image and returns its hash, the colors that are
+        already processed, the colors that still need processing and the
+        rendition task of a new image (or None).
+        """
         # validate that file is image
         if not file.content_type.startswith("image"):
             raise HTTPException(
@@ -24,17 +32,28 @@ class ImageService:
                 detail=f"Expected image file but received: {file.content_type}",
             )
 
-        image_hash = await self.repository.upload_unprocessed_image(uid, file)
+        image_hash, is_new_image = await self.repository.upload_unprocessed_image(uid, file)
+
+        renditions = None
+        if is_new_image:
+            # downscaled previews are made while the colors are processed
+            await file.seek(0)
+            renditions = asyncio.ensure_future(
+                self._create_renditions(uid, image_hash, await file.read())
+            )
 
         to_process = []
         processed_images = []
 
         # go through RGB
-        # check if image exists
-        for dto in colors:
-            image_response = self.repository.check_image_exists_for_id(
-                uid, image_hash, dto
-            )
+        # check if image exists, all colors at once
+        image_responses = await asyncio.gather(
+            *[
+                self.repository.check_image_exists_for_id(uid, image_hash, dto)
+                for dto in colors
+            ]
+        )
+        for dto, image_response in zip(colors, image_responses):
             if image_response is not None:
                 response = GetProcessedResponse(
                     uid=uid,
@@ -51,26 +70,97 @@ class ImageService:
                 processed_images.append(response)
             else:
                 to_process.append(dto)
+        return image_hash, processed_images, to_process, renditions
+
+    async def upload_and_process_image(
+        self, uid: str, file: UploadFile, colors: List[ColorDTO]
+    ):
+        image_hash, processed_images, to_process, renditions = (
+            await self._upload_and_check_colors(uid, file, colors)
+        )
         if len(to_process) > 0:
             image_data = ImageData(
                 uid=uid, colors=to_process, raw_image_hash=image_hash
             )
             resp = await self.client.send_image_process_request(image_data)
             processed_images.extend(resp)
+        if renditions is not None:
+            await renditions
 
         return ImageRequestListResponse(
             original_image=image_hash, processed_images=processed_images
         )
 
-    def get_image_by_hash(self, uid: str, hash: str):
+    async def submit_processing_job(
+        self, uid: str, file: UploadFile, colors: List[ColorDTO], job_store: JobStore
+    ):
+        """
+        Stores the raw image and returns a job that processes the missing
+        colors in the background. Every color is added to the job as soon
+        as the image server has recolored it.
+        """
+        # reject before anything is uploaded when the store is full
+        job_store.ensure_capacity()
+        image_hash, processed_images, to_process, renditions = (
+            await self._upload_and_check_colors(uid, file, colors)
+        )
+        job = job_store.create(uid, image_hash, processed_images)
+
+        async def process():
+            if len(to_process) > 0:
+                image_data = ImageData(
+                    uid=uid, colors=to_process, raw_image_hash=image_hash
+                )
+                # the image server streams every color once it is stored
+                async for processed in self.client.stream_image_process_request(image_data):
+                    job.add_processed([processed])
+            if renditions is not None:
+                await renditions
+
+        job_store.run(job, process())
+        return job
+
+    async def _create_renditions(self, uid: str, hash: str, image_bytes: bytes):
+        try:
+            loop = asyncio.get_running_loop()
+            renditions = await loop.run_in_executor(
+                None, make_renditions_from_bytes, image_bytes
+            )
+        except Exception as e:
+            print(f"Could not create renditions for {hash}: {e}")
+            return None
+        try:
+            await self.repository.upload_renditions(uid, hash, renditions)
+        except Exception as e:
+            # they are still correct, the next request tries storing them again
+            print(f"Could not store renditions for {hash}: {e}")
+        return renditions
+
+    async def _get_rendition(self, uid: str, hash: str, size: int):
+        rendition = await self.repository.get_rendition(uid, hash, size)
+        if rendition is not None:
+            return rendition
+
+        # images stored before renditions existed get them on first request
+        image = await self.get_image_by_hash(uid, hash)
+        renditions = await self._create_renditions(uid, hash, image.image_bytes)
+        if renditions is None:
+            # never the full image in place of a rendition, the client would
+            # cache it under the rendition's ETag for good
+            raise HTTPException(status_code=500, detail=f"Could not create a {size}px rendition of image: {hash}")
+        return Image(image_bytes=renditions[size], contentType=RENDITION_CONTENT_TYPE)
+
+    async def get_image_by_hash(self, uid: str, hash: str, size: int | None = None):
+        if size is not None:
+            return await self._get_rendition(uid, hash, size)
         is_raw_image = len(hash.split("-")) == 1
         if is_raw_image:
-            image = self.repository.get_raw_image_by_hash(uid, hash, True)
+            image = await self.repository.get_raw_image_by_hash(uid, hash, True)
             if image is None or image.image_data is None:
                 raise HTTPException(status_code=404)
             return image.image_data
         else:
-            image = self.repository.get_processed_image_by_hash(uid, hash, True)
+            image = await self.repository.get_processed_image_by_hash(uid, hash, True)
             if image is None or image.image_data is None:
                 raise HTTPException(status_code=404)
             return image.image_data
@@ -89,12 +179,14 @@ class ImageService:
             ret.append(processed_response)
         return ret
 
-    def get_image_summary_by_hash(self, uid: str, hash: str):
-        raw_image = self.repository.get_raw_image_by_hash(uid, hash)
+    async def get_image_summary_by_hash(self, uid: str, hash: str):
+        raw_image, processed_files = await asyncio.gather(
+            self.repository.get_raw_image_by_hash(uid, hash),
+            self.repository.get_all_processed_images(uid, hash),
+        )
         if raw_image is None:
             raise HTTPException(status_code=404, detail=f"Could not retrieve image with hash: {hash}")
 
-        processed_files = self.repository.get_all_processed_images(uid, hash)
         processed_response = self._get_image_response_to_get_processed_response(
             uid, processed_files
         )
@@ -102,8 +194,8 @@ class ImageService:
             original_image=raw_image.image_hash, processed_images=processed_response
         )
 
-    def get_image_zip_from_raw_hash(self, uid:str, raw_image_hash: str):
-        zip_data = self.repository.bulk_retrieve_images_from_raw_image_hash(uid, raw_image_hash)
-        if zip_data is None:
+    async def get_image_zip_from_raw_hash(self, uid:str, raw_image_hash: str):
+        zip_stream = await self.repository.stream_images_zip_from_raw_image_hash(uid, raw_image_hash)
+        if zip_stream is None:
             raise HTTPException(status_code=404, detail=f"Could not bulk retrieve image with hash: {raw_image_hash}")
-        return zip_data
\ No newline at end of file
+        return zip_stream
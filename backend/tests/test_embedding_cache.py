@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from image_pipeline.embedding_cache import EmbeddingCache
+
+ORIGINAL_SIZE = (1200, 1600)
+INPUT_SIZE = (768, 1024)
+
+
+def make_features(seed):
+    return np.random.default_rng(seed).standard_normal((1, 8, 4, 4)).astype(np.float32)
+
+
+def test_miss_then_hit(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    features = make_features(0)
+
+    assert cache.get("image") is None
+    cache.put("image", features, ORIGINAL_SIZE, INPUT_SIZE)
+    cached_features, original_size, input_size = cache.get("image")
+
+    np.testing.assert_array_equal(cached_features, features)
+    assert original_size == ORIGINAL_SIZE
+    assert input_size == INPUT_SIZE
+
+
+def test_memory_entries_are_evicted_least_recently_used_first(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_memory_entries=2)
+    for name in ("a", "b"):
+        cache.put(name, make_features(0), ORIGINAL_SIZE, INPUT_SIZE)
+    # a was used last, so c evicts b
+    cache.get("a")
+    cache.put("c", make_features(0), ORIGINAL_SIZE, INPUT_SIZE)
+
+    assert list(cache._entries) == ["a", "c"]
+
+
+def test_entries_spill_to_memory_mapped_npy_files(tmp_path):
+    features = make_features(1)
+    EmbeddingCache(str(tmp_path)).put("image", features, ORIGINAL_SIZE, INPUT_SIZE)
+    assert sorted(os.listdir(tmp_path)) == ["image.json", "image.npy"]
+
+    # a fresh cache, like after a restart, only has the files
+    cached_features, original_size, input_size = EmbeddingCache(str(tmp_path)).get("image")
+
+    assert isinstance(cached_features, np.memmap)
+    np.testing.assert_array_equal(cached_features, features)
+    assert cached_features.dtype == np.float32
+    assert original_size == ORIGINAL_SIZE
+    assert input_size == INPUT_SIZE
+
+
+def test_disk_entries_are_evicted_least_recently_used_first(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_memory_entries=1, max_disk_entries=2)
+    cache.put("a", make_features(0), ORIGINAL_SIZE, INPUT_SIZE)
+    cache.put("b", make_features(0), ORIGINAL_SIZE, INPUT_SIZE)
+    # make a older than b on disk, whatever the file system's time resolution
+    os.utime(tmp_path / "a.npy", (0, 0))
+    cache.put("c", make_features(0), ORIGINAL_SIZE, INPUT_SIZE)
+
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "b.npy", "c.json", "c.npy"]
+    assert EmbeddingCache(str(tmp_path)).get("a") is None
@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from Api.http_caching import _parse_range, image_etag, image_response, not_modified_response
+from shared.data_classes import Image
+
+IMAGE_HASH = "abc123"
+CONTENT = bytes(range(100))
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=90-200", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-200", (0, 99)),
+    ("BYTES = 5-5", (5, 5)),
+    # ignored: invalid syntax, other units and multiple ranges
+    ("bytes=5-3", None),
+    ("bytes=a-3", None),
+    ("bytes=-", None),
+    ("items=0-9", None),
+    ("bytes=0-1,5-6", None),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, len(CONTENT)) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=150-200", "bytes=-0"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        _parse_range(header, len(CONTENT))
+
+
+def make_client():
+    app = FastAPI()
+
+    @app.get("/image")
+    async def get_image(request: Request):
+        etag = image_etag(IMAGE_HASH)
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+        return image_response(request, Image(image_bytes=CONTENT, contentType="image/jpeg"), etag)
+
+    return TestClient(app)
+
+
+def test_full_response_is_cacheable():
+    response = make_client().get("/image")
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["etag"] == f'"{IMAGE_HASH}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+@pytest.mark.parametrize("if_none_match", [f'"{IMAGE_HASH}"', f'W/"{IMAGE_HASH}"', f'"other", "{IMAGE_HASH}"', "*"])
+def test_matching_if_none_match_is_not_modified(if_none_match):
+    response = make_client().get("/image", headers={"If-None-Match": if_none_match})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == f'"{IMAGE_HASH}"'
+
+
+def test_other_if_none_match_gets_the_image():
+    response = make_client().get("/image", headers={"If-None-Match": '"other"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_range_gets_partial_content():
+    response = make_client().get("/image", headers={"Range": "bytes=10-19"})
+
+    assert response.status_code == 206
+    assert response.content == CONTENT[10:20]
+    assert response.headers["content-range"] == "bytes 10-19/100"
+
+
+def test_invalid_range_gets_the_whole_image():
+    response = make_client().get("/image", headers={"Range": "bytes=5-3"})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_range_past_the_end_is_not_satisfiable():
+    response = make_client().get("/image", headers={"Range": "bytes=100-"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */100"
+
+
+def test_stale_if_range_gets_the_whole_image():
+    headers = {"Range": "bytes=10-19", "If-Range": '"other"'}
+    response = make_client().get("/image", headers=headers)
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+    headers["If-Range"] = f'"{IMAGE_HASH}"'
+    assert make_client().get("/image", headers=headers).status_code == 206
@@ -0,0 +1,205 @@
+import asyncio
+import io
+import os
+import sys
+
+import numpy as np
+import PIL.Image
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "image_server"))
+
+from image_server.alpha_cache import AlphaMaskCache
+from image_server.output_encoder import OutputEncoder
+from image_server.recolor_pool import RecolorPool
+from image_server.routes import image_processing
+from image_pipeline.wall_recolorer import WallRecolorer
+from image_pipeline.mask_codec import pack_masks
+from shared.data_classes import RGB, ColorDTO, GetJSONResponse, GetMaskResponse, ImageData
+
+UID = "user"
+RAW_HASH = "abc123"
+
+
+class FakeRepository:
+    """Records uploads and serves the stored json of one raw image."""
+
+    def __init__(self, json_data=None, files=None):
+        self.json_data = json_data
+        # mask and processed image files by name
+        self.files = files or {}
+        self.uploads = []
+
+    async def get_json_by_hash(self, uid, image_hash):
+        if self.json_data is None:
+            return None
+        return GetJSONResponse(image_hash=image_hash, json_data=dict(self.json_data))
+
+    async def update_json(self, uid, image_hash, update):
+        self.json_data = update(dict(self.json_data or {}))
+        return self.json_data
+
+    async def upload_packed_masks(self, uid, raw_image_hash, data):
+        self.uploads.append("packed_masks")
+        return f"{raw_image_hash}-masks"
+
+    async def upload_alpha_masks(self, uid, raw_image_hash, data):
+        self.uploads.append("alpha_masks")
+        return f"{raw_image_hash}-alpha"
+
+    async def upload_processed_image(self, uid, raw_image_hash, image_bytes, dto, content_type="image/jpg"):
+        processed_image_hash = f"{raw_image_hash}-{dto.paint_id}"
+        if processed_image_hash in self.files:
+            return processed_image_hash, False
+        self.uploads.append("processed_image")
+        self.files[processed_image_hash] = image_bytes
+        return processed_image_hash, True
+
+    async def upload_renditions(self, uid, image_hash, renditions):
+        self.uploads.append("renditions")
+
+    async def get_packed_masks_by_hash(self, uid, image_hash, file_name):
+        return self.files.get(file_name)
+
+    async def get_alpha_masks_by_hash(self, uid, image_hash, file_name):
+        return self.files.get(file_name)
+
+    async def get_masks_by_hash(self, uid, image_hash, mask_hashes):
+        return [
+            GetMaskResponse(image_hash=image_hash, mask_data=io.BytesIO(self.files[mask_hash]))
+            for mask_hash in mask_hashes
+        ]
+
+
+class FakeScheduler:
+    def __init__(self, masks):
+        self.masks = masks
+        self.submitted = 0
+
+    async def submit(self, image_cv, raw_image_hash):
+        self.submitted += 1
+        recolorer = WallRecolorer(None, True)
+        return self.masks, recolorer.feather_masks(image_cv, self.masks)
+
+
+@pytest.fixture
+def recolor_pool():
+    recolor_pool = RecolorPool(WallRecolorer(None, True))
+    yield recolor_pool
+    recolor_pool.stop()
+
+
+@pytest.fixture
+def alpha_cache(tmp_path):
+    return AlphaMaskCache(str(tmp_path))
+
+
+def make_image():
+    return np.full((40, 60, 3), 128, dtype=np.uint8)
+
+
+def make_mask():
+    mask = np.zeros((40, 60), dtype=bool)
+    mask[10:30, 10:50] = True
+    return mask
+
+
+def test_segmentation_finished_after_the_json_was_read_is_not_repeated(recolor_pool, alpha_cache):
+    # another request segmented the image (no walls) after this one read the json
+    repository = FakeRepository({"uid": UID, "raw_image_hash": RAW_HASH, "processed": [], "segmented": True})
+    scheduler = FakeScheduler([make_mask()])
+
+    feathered_masks = asyncio.run(image_processing.load_or_segment(
+        repository, scheduler, recolor_pool, alpha_cache, UID, RAW_HASH, make_image(), {}
+    ))
+
+    assert scheduler.submitted == 0
+    assert len(feathered_masks) == 0
+    assert repository.uploads == []
+
+
+def test_unsegmented_image_is_segmented_and_recorded(recolor_pool, alpha_cache):
+    repository = FakeRepository()
+    scheduler = FakeScheduler([make_mask()])
+
+    feathered_masks = asyncio.run(image_processing.load_or_segment(
+        repository, scheduler, recolor_pool, alpha_cache, UID, RAW_HASH, make_image(), {}
+    ))
+
+    assert scheduler.submitted == 1
+    assert len(feathered_masks) == 1
+    assert sorted(repository.uploads) == ["alpha_masks", "packed_masks"]
+    assert repository.json_data["segmented"] is True
+    assert repository.json_data["packed_masks"] == f"{RAW_HASH}-masks"
+
+
+def bmp_bytes(mask):
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(mask.astype(np.uint8) * 255).save(buffer, format="BMP")
+    return buffer.getvalue()
+
+
+def load_masks(repository, recolor_pool, alpha_cache):
+    return asyncio.run(image_processing.load_masks(
+        repository, recolor_pool, alpha_cache, UID, RAW_HASH, make_image(), repository.json_data
+    ))
+
+
+def test_unsegmented_image_has_no_masks(recolor_pool, alpha_cache):
+    repository = FakeRepository({"uid": UID, "raw_image_hash": RAW_HASH, "processed": []})
+
+    assert load_masks(repository, recolor_pool, alpha_cache) is None
+
+
+def test_segmentation_without_walls_loads_zero_masks(recolor_pool, alpha_cache):
+    repository = FakeRepository({"segmented": True})
+
+    feathered_masks = load_masks(repository, recolor_pool, alpha_cache)
+
+    assert len(feathered_masks) == 0
+    assert feathered_masks.size == (60, 40)
+    assert repository.uploads == []
+
+
+@pytest.mark.parametrize("stored_as", ["packed", "legacy_bmp"])
+def test_stored_masks_are_feathered_once(recolor_pool, alpha_cache, stored_as):
+    masks = [make_mask(), ~make_mask()]
+    if stored_as == "packed":
+        json_data = {"segmented": True, "packed_masks": f"{RAW_HASH}-masks"}
+        files = {f"{RAW_HASH}-masks": pack_masks(masks)}
+    else:
+        # images segmented before packed masks list one BMP per mask
+        json_data = {"masks": [f"{RAW_HASH}-0", f"{RAW_HASH}-1"]}
+        files = {f"{RAW_HASH}-{i}": bmp_bytes(mask) for i, mask in enumerate(masks)}
+    repository = FakeRepository(json_data, files)
+
+    feathered_masks = load_masks(repository, recolor_pool, alpha_cache)
+    expected = WallRecolorer(None, True).feather_masks(make_image(), masks)
+
+    np.testing.assert_array_equal(feathered_masks.alphas, expected.alphas)
+    np.testing.assert_array_equal(feathered_masks.ave_colors, expected.ave_colors)
+    # the feathered masks are stored, the next recolor only reads those
+    assert repository.uploads == ["alpha_masks"]
+    assert repository.json_data["alpha_masks"] == f"{RAW_HASH}-alpha"
+    assert alpha_cache.get(UID, RAW_HASH) is not None
+
+
+def test_renditions_are_only_stored_with_new_images():
+    encoder = OutputEncoder("jpeg", num_workers=1)
+    repository = FakeRepository()
+    color = ColorDTO(paint_id="paint", rgb=RGB(r=1, g=2, b=3))
+    image_data = ImageData(uid=UID, colors=[color], raw_image_hash=RAW_HASH)
+
+    async def store():
+        return await image_processing.encode_and_upload(repository, encoder, image_data, color, make_image())
+
+    try:
+        first = asyncio.run(store())
+        # processed again, e.g. by a concurrent request for the same color
+        second = asyncio.run(store())
+    finally:
+        encoder.stop()
+
+    assert first.processed_image_hash == second.processed_image_hash == f"{RAW_HASH}-paint"
+    assert repository.uploads == ["processed_image", "renditions"]
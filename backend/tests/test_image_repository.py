@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import io
+import os
+import sys
+import threading
+
+import pytest
+from fastapi import UploadFile
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from starlette.datastructures import Headers
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import shared.repository.image_repository as image_repository_module
+from shared.data_classes import RGB, ColorDTO
+from shared.repository.image_repository import ImageRepository
+
+UID = "user"
+RAW_HASH = "abc123"
+
+
+class FakeBlob:
+    """In-memory stand-in for `google.cloud.storage.Blob`."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.generation = None
+
+    def _record(self, call):
+        self.bucket.calls.append((call, self.name, threading.current_thread().name))
+
+    def upload_from_string(self, data, content_type=None, predefined_acl=None, if_generation_match=None):
+        self._record("upload")
+        stored = self.bucket.objects.get(self.name)
+        generation = stored["generation"] if stored else 0
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed("generation mismatch")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.objects[self.name] = {
+            "data": bytes(data),
+            "content_type": content_type,
+            "metadata": self.metadata,
+            "generation": generation + 1,
+        }
+
+    def download_as_bytes(self):
+        self._record("download")
+        if self.bucket.download_barrier is not None:
+            self.bucket.download_barrier.wait()
+        stored = self.bucket.objects.get(self.name)
+        if stored is None:
+            raise NotFound(self.name)
+        self.content_type = stored["content_type"]
+        self.generation = stored["generation"]
+        return stored["data"]
+
+
+class FakeBucket:
+    """In-memory stand-in for `google.cloud.storage.Bucket`."""
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+        # set to make every download wait for the others
+        self.download_barrier = None
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def _loaded_blob(self, name):
+        stored = self.objects[name]
+        blob = FakeBlob(self, name)
+        blob.metadata = stored["metadata"]
+        blob.content_type = stored["content_type"]
+        blob.generation = stored["generation"]
+        return blob
+
+    def get_blob(self, name):
+        self.calls.append(("get_blob", name, threading.current_thread().name))
+        if name not in self.objects:
+            return None
+        return self._loaded_blob(name)
+
+    def list_blobs(self, prefix=None):
+        self.calls.append(("list_blobs", prefix, threading.current_thread().name))
+        return [self._loaded_blob(name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = FakeBucket()
+    monkeypatch.setattr(image_repository_module.storage, "bucket", lambda: bucket)
+    return bucket
+
+
+@pytest.fixture
+def repository(bucket):
+    return ImageRepository()
+
+
+def test_storage_calls_run_off_the_event_loop(bucket, repository):
+    dto = ColorDTO(rgb=RGB(r=1, g=2, b=3), paint_id="paint")
+
+    async def run():
+        await repository.upload_processed_image(UID, RAW_HASH, b"image", dto)
+        return await repository.get_processed_image_by_hash(UID, f"{RAW_HASH}-paint", True)
+
+    response = asyncio.run(run())
+
+    assert response.image_data.image_bytes == b"image"
+    assert response.paintId == "paint"
+    assert bucket.calls
+    assert all(thread.startswith("storage-io") for _, _, thread in bucket.calls)
+
+
+def test_raw_image_upload_is_one_call(bucket, repository):
+    content = b"raw image"
+    image_hash = hashlib.sha256(content).hexdigest()
+
+    async def upload():
+        file = UploadFile(io.BytesIO(content), headers=Headers({"content-type": "image/jpeg"}))
+        return await repository.upload_unprocessed_image(UID, file)
+
+    assert asyncio.run(upload()) == (image_hash, True)
+    assert asyncio.run(upload()) == (image_hash, False)
+    assert [call for call, _, _ in bucket.calls] == ["upload", "upload"]
+    stored = bucket.objects[f"images/{UID}/{image_hash}/{image_hash}"]
+    assert stored["data"] == content
+    assert stored["content_type"] == "image/jpeg"
+
+
+def test_processed_image_upload_only_creates_new_objects(bucket, repository):
+    dto = ColorDTO(rgb=RGB(r=1, g=2, b=3), paint_id="paint")
+
+    async def run():
+        first = await repository.upload_processed_image(UID, RAW_HASH, b"first", dto)
+        second = await repository.upload_processed_image(UID, RAW_HASH, b"second", dto)
+        return first, second
+
+    assert asyncio.run(run()) == ((f"{RAW_HASH}-paint", True), (f"{RAW_HASH}-paint", False))
+    path = f"images/{UID}/{RAW_HASH}/processed/{RAW_HASH}-paint"
+    assert bucket.objects[path]["data"] == b"first"
+
+
+def test_mask_uploads_only_create_new_objects(bucket, repository):
+    async def run():
+        names = []
+        for data in (b"first", b"second"):
+            names.append(await repository.upload_packed_masks(UID, RAW_HASH, data))
+            names.append(await repository.upload_alpha_masks(UID, RAW_HASH, data))
+        return names
+
+    assert asyncio.run(run()) == [f"{RAW_HASH}-masks", f"{RAW_HASH}-alpha"] * 2
+    base_path = f"images/{UID}/{RAW_HASH}/masks"
+    assert bucket.objects[f"{base_path}/{RAW_HASH}-masks"]["data"] == b"first"
+    assert bucket.objects[f"{base_path}/{RAW_HASH}-alpha"]["data"] == b"first"
+
+
+def test_masks_are_downloaded_concurrently_in_order(bucket, repository):
+    mask_hashes = [f"{RAW_HASH}-{i}" for i in range(4)]
+    for i, mask_hash in enumerate(mask_hashes):
+        bucket.objects[f"images/{UID}/{RAW_HASH}/masks/{mask_hash}"] = {
+            "data": bytes([i]),
+            "content_type": "image/bmp",
+            "metadata": None,
+            "generation": 1,
+        }
+    # sequential downloads would never all reach the barrier together
+    bucket.download_barrier = threading.Barrier(len(mask_hashes), timeout=5)
+
+    responses = asyncio.run(repository.get_masks_by_hash(UID, RAW_HASH, mask_hashes))
+
+    assert [response.mask_data.read() for response in responses] == [bytes([i]) for i in range(4)]
+
+
+def test_missing_objects_return_none(bucket, repository):
+    async def run():
+        return await asyncio.gather(
+            repository.get_json_by_hash(UID, RAW_HASH),
+            repository.get_raw_image_by_hash(UID, RAW_HASH),
+            repository.get_raw_image_by_hash(UID, RAW_HASH, True),
+            repository.get_processed_image_by_hash(UID, f"{RAW_HASH}-paint"),
+            repository.get_packed_masks_by_hash(UID, RAW_HASH, f"{RAW_HASH}-masks"),
+            repository.stream_images_zip_from_raw_image_hash(UID, RAW_HASH),
+        )
+
+    assert asyncio.run(run()) == [None] * 6
+
+
+def test_update_json_retries_on_concurrent_writes(bucket, repository):
+    path = f"images/{UID}/{RAW_HASH}/{RAW_HASH}.json"
+    interfered = []
+
+    def update(stored):
+        if not interfered:
+            # another server writes the json between our read and our write
+            interfered.append(True)
+            bucket.blob(path).upload_from_string(b'{"other": true}')
+        return {**stored, "ours": True}
+
+    async def run():
+        await repository.update_json(UID, RAW_HASH, lambda stored: {"start": True})
+        return await repository.update_json(UID, RAW_HASH, update)
+
+    result = asyncio.run(run())
+
+    assert result == {"other": True, "ours": True}
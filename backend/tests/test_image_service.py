@@ -0,0 +1,71 @@
+import asyncio
+import io
+import os
+import sys
+
+import PIL.Image
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from shared.data_classes import RGB, GetImageResponse, Image
+from shared.renditions import RENDITION_CONTENT_TYPE
+from shared.service.image_service import ImageService
+
+UID = "user"
+PROCESSED_HASH = "abc123-paint"
+
+
+class FakeRepository:
+    """A processed image without stored renditions."""
+
+    def __init__(self, image_bytes, fail_uploads=False):
+        self.image_bytes = image_bytes
+        self.fail_uploads = fail_uploads
+        self.renditions = None
+
+    async def get_rendition(self, uid, image_hash, size):
+        return None
+
+    async def get_processed_image_by_hash(self, uid, image_hash, download_image=False):
+        image = Image(image_bytes=self.image_bytes, contentType="image/jpeg")
+        return GetImageResponse(image_hash=image_hash, rgb=RGB(r=1, g=2, b=3), paintId="paint", image_data=image)
+
+    async def upload_renditions(self, uid, image_hash, renditions):
+        if self.fail_uploads:
+            raise ConnectionError("storage unavailable")
+        self.renditions = renditions
+
+
+def jpeg_bytes(width, height):
+    buffer = io.BytesIO()
+    PIL.Image.new("RGB", (width, height), (120, 80, 40)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_missing_rendition_is_created_and_stored():
+    repository = FakeRepository(jpeg_bytes(2000, 1000))
+
+    image = asyncio.run(ImageService(repository, None).get_image_by_hash(UID, PROCESSED_HASH, 256))
+
+    assert image.contentType == RENDITION_CONTENT_TYPE
+    assert PIL.Image.open(io.BytesIO(image.image_bytes)).size == (256, 128)
+    assert repository.renditions[256] == image.image_bytes
+
+
+def test_rendition_is_served_when_storing_it_fails():
+    repository = FakeRepository(jpeg_bytes(2000, 1000), fail_uploads=True)
+
+    image = asyncio.run(ImageService(repository, None).get_image_by_hash(UID, PROCESSED_HASH, 256))
+
+    assert PIL.Image.open(io.BytesIO(image.image_bytes)).size == (256, 128)
+
+
+def test_undecodable_image_is_not_served_as_its_rendition():
+    repository = FakeRepository(b"not an image")
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(ImageService(repository, None).get_image_by_hash(UID, PROCESSED_HASH, 256))
+
+    assert e.value.status_code == 500
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from Api.job_store import JobStore
+
+
+def test_rejects_jobs_while_max_jobs_are_unfinished():
+    job_store = JobStore(max_jobs=2)
+    job_store.create("user", "hash1", [])
+    job_store.create("user", "hash2", [])
+
+    with pytest.raises(HTTPException) as e:
+        job_store.create("user", "hash3", [])
+
+    assert e.value.status_code == 503
+    assert len(job_store._jobs) == 2
+
+
+def test_finished_jobs_make_room_for_new_ones():
+    job_store = JobStore(max_jobs=2)
+    first = job_store.create("user", "hash1", [])
+    second = job_store.create("user", "hash2", [])
+    first.finish()
+
+    third = job_store.create("user", "hash3", [])
+
+    assert job_store.get("user", first.job_id) is None
+    assert job_store.get("user", second.job_id) is second
+    assert job_store.get("user", third.job_id) is third
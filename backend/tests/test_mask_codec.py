@@ -0,0 +1,48 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from image_pipeline.mask_codec import pack_masks, unpack_masks
+
+
+def make_masks(count, height, width):
+    rng = np.random.default_rng(count)
+    return [rng.random((height, width)) > 0.5 for _ in range(count)]
+
+
+@pytest.mark.parametrize("count, height, width", [(1, 40, 60), (3, 37, 53), (2, 1, 1)])
+def test_round_trip(count, height, width):
+    # widths that aren't a multiple of 8 need the padding bits dropped
+    masks = make_masks(count, height, width)
+
+    unpacked = unpack_masks(pack_masks(masks))
+
+    assert unpacked.dtype == bool
+    np.testing.assert_array_equal(unpacked, np.stack(masks))
+
+
+def test_non_bool_masks_are_binarized():
+    # SAM masks arrive as bool, stored BMP masks as 0/1 or 0/255 uint8
+    masks = [np.array([[0, 1], [255, 0]], dtype=np.uint8)]
+
+    np.testing.assert_array_equal(unpack_masks(pack_masks(masks)), [[[False, True], [True, False]]])
+
+
+def test_zero_masks_are_not_packed():
+    # store_masks only packs segmentations that found walls
+    with pytest.raises(ValueError):
+        pack_masks([])
+
+
+def test_unknown_format_is_rejected():
+    data = bytearray(pack_masks(make_masks(1, 4, 4)))
+    # the format version follows the magic
+    struct.pack_into("<H", data, 4, 99)
+
+    with pytest.raises(ValueError):
+        unpack_masks(bytes(data))
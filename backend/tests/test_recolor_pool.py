@@ -0,0 +1,98 @@
+import asyncio
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from image_server.alpha_cache import AlphaMaskCache
+from image_server.recolor_pool import RecolorPool
+from image_pipeline.wall_recolorer import WallRecolorer
+
+UID = "user"
+RAW_HASH = "abc123"
+
+
+def make_image():
+    gradient = np.linspace(0, 255, 400, dtype=np.uint8)
+    image_cv = np.dstack([np.tile(gradient, (300, 1))] * 3)
+    # 0.03 megapixels segments at 200x150
+    recolorer = WallRecolorer(0.03, True)
+    mask = np.zeros((150, 200), dtype=bool)
+    mask[30:120, 40:160] = True
+    return recolorer, image_cv, recolorer.feather_masks(image_cv, [mask])
+
+
+class CountingRecolorer(WallRecolorer):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.upsampled = 0
+
+    def output_masks(self, image_cv, masks):
+        self.upsampled += 1
+        return super().output_masks(image_cv, masks)
+
+
+def test_output_masks_are_upsampled_once_per_image(tmp_path):
+    _, image_cv, feathered_masks = make_image()
+    recolorer = CountingRecolorer(0.03, True)
+    recolor_pool = RecolorPool(recolorer, num_workers=2)
+    alpha_cache = AlphaMaskCache(str(tmp_path), max_memory_entries=1)
+
+    async def run():
+        first = await recolor_pool.output_masks(alpha_cache, UID, RAW_HASH, image_cv, feathered_masks)
+        again = await recolor_pool.output_masks(alpha_cache, UID, RAW_HASH, image_cv, feathered_masks)
+        # pushes the upsampled masks out of memory, they are read from disk
+        alpha_cache.put(UID, "other", feathered_masks)
+        from_disk = await recolor_pool.output_masks(alpha_cache, UID, RAW_HASH, image_cv, feathered_masks)
+        return first, again, from_disk
+
+    try:
+        first, again, from_disk = asyncio.run(run())
+    finally:
+        recolor_pool.stop()
+
+    assert recolorer.upsampled == 1
+    assert first.size == (400, 300)
+    assert again is first
+    np.testing.assert_array_equal(from_disk.alphas, first.alphas)
+    # the stored working size masks are a separate entry
+    assert alpha_cache.get(UID, RAW_HASH) is None
+
+
+def test_cached_output_masks_recolor_like_stored_masks(tmp_path):
+    recolorer, image_cv, feathered_masks = make_image()
+    recolor_pool = RecolorPool(recolorer, num_workers=2)
+    alpha_cache = AlphaMaskCache(str(tmp_path))
+
+    async def run():
+        output_masks = await recolor_pool.output_masks(alpha_cache, UID, RAW_HASH, image_cv, feathered_masks)
+        return await asyncio.gather(
+            recolor_pool.recolor_many(image_cv, [[10, 200, 30]], feathered_masks),
+            recolor_pool.recolor_many(image_cv, [[10, 200, 30]], output_masks),
+        )
+
+    try:
+        from_stored, from_output = asyncio.run(run())
+    finally:
+        recolor_pool.stop()
+
+    assert from_output[0].shape == image_cv.shape
+    np.testing.assert_array_equal(from_output[0], from_stored[0])
+
+
+def test_working_size_output_needs_no_upsampling(tmp_path):
+    _, image_cv, feathered_masks = make_image()
+    recolor_pool = RecolorPool(WallRecolorer(0.03, False))
+    alpha_cache = AlphaMaskCache(str(tmp_path))
+
+    try:
+        output_masks = asyncio.run(
+            recolor_pool.output_masks(alpha_cache, UID, RAW_HASH, image_cv, feathered_masks)
+        )
+    finally:
+        recolor_pool.stop()
+
+    assert output_masks is feathered_masks
+    assert os.listdir(tmp_path) == []
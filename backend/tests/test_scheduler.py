@@ -0,0 +1,94 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from image_server.scheduler import InferenceScheduler
+
+
+class FakePipeline:
+    """Segments an "image" into masks named after it and records the calls."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.batches = []
+
+    def run_pipeline(self, image_cv, image_name, colors):
+        return self.run_pipeline_batch([image_cv], [image_name], [colors])[0]
+
+    def run_pipeline_batch(self, images_cv, image_names, colors_per_image):
+        self.batches.append(list(image_names))
+        if self.error is not None:
+            raise self.error
+        return [
+            ([f"{image_cv}-mask"], f"{image_cv}-feathered", [])
+            for image_cv in images_cv
+        ]
+
+
+def run_submits(scheduler, names):
+    async def run():
+        return await asyncio.gather(
+            *[scheduler.submit(name, f"{name}-hash") for name in names],
+            return_exceptions=True,
+        )
+
+    scheduler.start()
+    try:
+        return asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+
+def test_concurrent_submits_share_a_batch():
+    pipeline = FakePipeline()
+    scheduler = InferenceScheduler(pipeline, max_batch_size=4, max_wait_ms=500)
+
+    results = run_submits(scheduler, ["a", "b", "c"])
+
+    assert pipeline.batches == [["a-hash", "b-hash", "c-hash"]]
+    assert results == [
+        (["a-mask"], "a-feathered"),
+        (["b-mask"], "b-feathered"),
+        (["c-mask"], "c-feathered"),
+    ]
+
+
+def test_batches_are_capped_at_max_batch_size():
+    pipeline = FakePipeline()
+    scheduler = InferenceScheduler(pipeline, max_batch_size=2, max_wait_ms=500)
+
+    results = run_submits(scheduler, ["a", "b", "c"])
+
+    assert pipeline.batches == [["a-hash", "b-hash"], ["c-hash"]]
+    assert [masks for masks, _ in results] == [["a-mask"], ["b-mask"], ["c-mask"]]
+
+
+def test_failing_batch_fails_every_job():
+    error = RuntimeError("out of memory")
+    pipeline = FakePipeline(error)
+    scheduler = InferenceScheduler(pipeline, max_batch_size=4, max_wait_ms=500)
+
+    results = run_submits(scheduler, ["a", "b", "c"])
+
+    assert pipeline.batches == [["a-hash", "b-hash", "c-hash"]]
+    assert results == [error, error, error]
+
+
+def test_full_queue_rejects_jobs():
+    # not started, so nothing drains the queue
+    scheduler = InferenceScheduler(FakePipeline(), max_queue_size=1)
+
+    async def run():
+        first = asyncio.ensure_future(scheduler.submit("a", "a-hash"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as e:
+            await scheduler.submit("b", "b-hash")
+        first.cancel()
+        return e.value
+
+    assert asyncio.run(run()).status_code == 503
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from image_server.single_flight import SingleFlight
+
+
+class Work:
+    """Counts its runs and finishes once `release` is set."""
+
+    def __init__(self, result="masks", error=None):
+        self.result = result
+        self.error = error
+        self.runs = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_calls_share_one_execution():
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        callers = [asyncio.ensure_future(flights.do("image", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert flights.in_flight("image")
+        work.release.set()
+        results = await asyncio.gather(*callers)
+        return work.runs, results, flights.in_flight("image")
+
+    runs, results, in_flight = asyncio.run(run())
+
+    assert runs == 1
+    assert results == ["masks"] * 3
+    # finished, the next call runs the work again
+    assert not in_flight
+
+
+def test_different_keys_run_separately():
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        work.release.set()
+        return await asyncio.gather(flights.do("a", work), flights.do("b", work)), work.runs
+
+    results, runs = asyncio.run(run())
+
+    assert results == ["masks", "masks"]
+    assert runs == 2
+
+
+def test_errors_are_shared():
+    async def run():
+        flights = SingleFlight()
+        work = Work(error=RuntimeError("segmentation failed"))
+        callers = [asyncio.ensure_future(flights.do("image", work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        work.release.set()
+        return await asyncio.gather(*callers, return_exceptions=True), work.runs
+
+    results, runs = asyncio.run(run())
+
+    assert runs == 1
+    assert [str(result) for result in results] == ["segmentation failed"] * 2
+
+
+def test_cancelled_caller_does_not_cancel_the_work():
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        first = asyncio.ensure_future(flights.do("image", work))
+        second = asyncio.ensure_future(flights.do("image", work))
+        await asyncio.sleep(0)
+        # the client of the request that started the work disconnects
+        first.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, work.runs
+
+    result, runs = asyncio.run(run())
+
+    assert result == "masks"
+    assert runs == 1
+
+
+def test_join_waits_for_the_call_in_flight():
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        assert await flights.join("image") is None
+        started = asyncio.ensure_future(flights.do("image", work))
+        await asyncio.sleep(0)
+        joined = asyncio.ensure_future(flights.join("image"))
+        await asyncio.sleep(0)
+        work.release.set()
+        return await asyncio.gather(started, joined), work.runs
+
+    results, runs = asyncio.run(run())
+
+    assert results == ["masks", "masks"]
+    assert runs == 1
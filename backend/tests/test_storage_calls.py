@@ -0,0 +1,49 @@
+import os
+import sys
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from shared.repository.storage_calls import count_storage_call, storage_call_middleware
+
+
+def make_app():
+    app = FastAPI()
+    app.middleware("http")(storage_call_middleware)
+
+    @app.get("/plain")
+    async def plain():
+        count_storage_call()
+        count_storage_call()
+        return {"ok": True}
+
+    @app.get("/streamed")
+    async def streamed():
+        count_storage_call()
+
+        async def body():
+            # like the bulk zip, every chunk downloads another blob
+            for i in range(3):
+                count_storage_call()
+                yield f"{i}\\n"
+
+        return StreamingResponse(body(), media_type="text/plain")
+
+    return app
+
+
+def test_counts_calls_of_plain_responses(capsys):
+    response = TestClient(make_app()).get("/plain")
+
+    assert response.status_code == 200
+    assert "GET /plain: 2 storage calls" in capsys.readouterr().out
+
+
+def test_counts_calls_made_while_streaming_the_body(capsys):
+    response = TestClient(make_app()).get("/streamed")
+
+    assert response.text == "0\\n1\\n2\\n"
+    assert "GET /streamed: 4 storage calls" in capsys.readouterr().out